@@ -1,24 +1,71 @@
 from flask import Flask
 from config import Config
 from flask_login import LoginManager
-from app.models import User
+from werkzeug.middleware.proxy_fix import ProxyFix
+from app.models import User, configure_password_hashing, configure_storage
+from app.cache import GeoIndex, TTLCache, PersistentCache, SingleFlight
+from app.weather_client import WeatherClient
+from app.rate_limit import LoginThrottle
+from app.metrics import Metrics, init_metrics
+from app.http_cache import init_http_cache
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 login = LoginManager()
 login.login_view = 'auth.login'
 
-def create_app():
+def create_app(config_class=Config):
     app = Flask(__name__)
-    app.config.from_object(Config)
+    app.config.from_object(config_class)
+    if app.config['PROXY_FIX_X_FOR']:
+        # request.remote_addr is the client, not the proxy
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
+
+    metrics = Metrics() if app.config['METRICS_ENABLED'] else None
+    configure_storage(app.config, metrics)
+    configure_password_hashing(app.config)
 
     login.init_app(app)
 
+    app.extensions['weather_cache'] = TTLCache(maxsize=app.config['WEATHER_CACHE_SIZE'],
+                                               ttl=app.config['WEATHER_CACHE_TTL'],
+                                               stale_ttl=app.config['WEATHER_STALE_TTL'])
+    # Serialized /api/current_weather bodies, one per observation and view
+    app.extensions['response_cache'] = TTLCache(maxsize=app.config['WEATHER_CACHE_SIZE'],
+                                                ttl=app.config['WEATHER_CACHE_TTL'])
+    # Points of the cached coordinate lookups, for answering nearby ones
+    app.extensions['geo_index'] = GeoIndex(cell_km=max(app.config['WEATHER_NEARBY_RADIUS_KM'], 1.0),
+                                           maxsize=app.config['WEATHER_CACHE_SIZE'])
+    app.extensions['single_flight'] = SingleFlight()
+    app.extensions['geocode_cache'] = PersistentCache(app.config['GEOCODE_CACHE_PATH'])
+    app.extensions['history_cache'] = PersistentCache(app.config['HISTORY_CACHE_PATH'])
+    app.extensions['weather_client'] = WeatherClient.from_config(app.config, metrics)
+    app.extensions['login_throttle'] = LoginThrottle(ip_limit=app.config['LOGIN_MAX_FAILURES_PER_IP'],
+                                                     email_limit=app.config['LOGIN_MAX_FAILURES_PER_EMAIL'],
+                                                     window=app.config['LOGIN_THROTTLE_WINDOW'])
+    app.extensions['upstream_executor'] = ThreadPoolExecutor(max_workers=app.config['UPSTREAM_MAX_WORKERS'],
+                                                             thread_name_prefix='upstream')
+
+    if metrics is not None:
+        init_metrics(app, metrics)
+    init_http_cache(app)
+
     from app.routes import bp as main_bp
     app.register_blueprint(main_bp)
 
     from app.auth import bp as auth_bp
     app.register_blueprint(auth_bp, url_prefix='/auth')
 
+    if app.config['GEOCODE_WARM_ON_STARTUP']:
+        from app.routes import warm_geocode_cache
+        warm_geocode_cache(app)
+
+    if app.config['FAVORITES_REFRESH_ENABLED']:
+        from app.refresher import FavoritesRefresher
+        app.extensions['favorites_refresher'] = FavoritesRefresher(
+            app, interval=app.config['FAVORITES_REFRESH_INTERVAL'],
+            budget=app.config['FAVORITES_REFRESH_BUDGET']).start()
+
     @login.user_loader
     def load_user(user_id):
         return User.get(user_id)
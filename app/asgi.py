@@ -0,0 +1,326 @@
+import asyncio
+import contextvars
+import functools
+import io
+import random
+import sys
+import time
+import httpx
+import requests
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+from flask import current_app, jsonify, render_template, request
+from flask_login import current_user
+from app import create_app
+from app.http_cache import WEATHER_VIEWS, weather_response
+from app.models import FavoriteLocation
+from app.routes import (HISTORY_UNAVAILABLE, WEATHER_UNAVAILABLE, cached_geocode, cached_history, cached_weather,
+                        geocode_request, history_location_error, history_range_request, history_result,
+                        mark_favorites_viewed, record_weather_history, stale_weather, store_current_weather,
+                        store_geocode, store_history, upstream_priority, weather_request)
+from app.weather_client import CircuitOpenError, RateLimitedError, WeatherClient
+from config import Config
+
+UPSTREAM_ERRORS = (httpx.HTTPError, requests.RequestException, ValueError)
+
+
+class AsyncWeatherClient:
+    # Non-blocking counterpart of WeatherClient sharing its circuit breaker
+    def __init__(self, sync_client, pool_size=100):
+        self.timeout = httpx.Timeout(sync_client.timeout[1], connect=sync_client.timeout[0])
+        self.retries = sync_client.retries
+        self.backoff = sync_client.backoff
+        self.breaker = sync_client.breaker
+        self.acquire = sync_client.acquire
+        self.observe = sync_client.observe
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self._client = None
+
+    async def get(self, url, params=None, call='other', priority='interactive'):
+        if self._client is None:
+            # Created lazily so it binds to the server's event loop
+            self._client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits)
+        started = time.perf_counter()
+        if not self.breaker.allow():
+            self.observe(call, started, 'circuit_open')
+            raise CircuitOpenError(f'Circuit open, not calling {url}')
+
+        response, error = None, None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+            if not await run_blocking(self.acquire, priority):
+                if attempt:
+                    break
+                self.observe(call, started, 'rate_limited')
+                raise RateLimitedError(f'Rate limit reached, not calling {url}')
+            try:
+                response = await self._client.get(url, params=params)
+            except httpx.TransportError as e:
+                response, error = None, e
+                continue
+            if response.status_code not in WeatherClient.RETRY_STATUSES:
+                self.breaker.record_success()
+                self.observe(call, started, str(response.status_code))
+                return response
+
+        self.breaker.record_failure()
+        if response is not None:
+            self.observe(call, started, str(response.status_code))
+            return response
+        self.observe(call, started, 'error')
+        raise error
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class AsyncSingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    async def do(self, key, fn):
+        task = self._calls.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.executed += 1
+            # The call runs as its own task, so cancelling the caller that
+            # started it (e.g. at the /favorites deadline) leaves it running
+            # for the others waiting on the same key
+            task = self._calls[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        return await asyncio.shield(task)
+
+
+class AsyncWeatherApp:
+    # ASGI application serving the weather endpoints on the event loop, so one
+    # process keeps many upstream calls in flight. Everything else is handed
+    # to the Flask app running in a thread pool.
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.client = AsyncWeatherClient(flask_app.extensions['weather_client'],
+                                         pool_size=flask_app.config['ASYNC_UPSTREAM_POOL_SIZE'])
+        self.flight = AsyncSingleFlight()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        # uvicorn starts the next request of a kept-alive connection inside the
+        # previous request's context, whose asgiref state would make the WSGI
+        # call fail or hang, so every request gets a fresh one
+        await contextvars.Context().run(asyncio.ensure_future, self.handle(scope, receive, send))
+
+    async def handle(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['method'] == 'GET':
+            if scope['path'] == '/api/current_weather':
+                return await self.current_weather(scope, send)
+            if scope['path'] == '/favorites' and await self.favorites(scope, send):
+                return
+        # Each Flask request gets its own thread instead of sharing one
+        async with ThreadSensitiveContext():
+            await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.client.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def request_context(self, scope):
+        return self.flask_app.request_context(build_environ(scope))
+
+    async def send_response(self, send, response):
+        body = response.get_data()
+        headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in response.headers.items()]
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def current_weather(self, scope, send):
+        with self.request_context(scope):
+            self.flask_app.preprocess_request()
+            await load_user()
+            location = request.args.get('location')
+            lat = request.args.get('lat')
+            lon = request.args.get('lon')
+            view = request.args.get('view', 'full')
+
+            if view not in WEATHER_VIEWS:
+                response = jsonify({"error": f"Unknown view, use one of: {', '.join(WEATHER_VIEWS)}"})
+                response.status_code = 400
+            elif location:
+                response = weather_response(await self.get_weather_data(location=location), view)
+            elif lat and lon:
+                response = weather_response(await self.get_weather_data(lat=lat, lon=lon), view)
+            else:
+                response = jsonify({"error": "Location or coordinates are required"})
+                response.status_code = 400
+            response = self.flask_app.process_response(response)
+        await self.send_response(send, response)
+
+    async def favorites(self, scope, send):
+        # Returns False for anonymous or unsubscribed users, Flask redirects them
+        with self.request_context(scope):
+            await load_user()
+            if not current_user.is_authenticated or not current_user.is_subscribed:
+                return False
+            self.flask_app.preprocess_request()
+
+            favorites = await run_blocking(FavoriteLocation.get_by_user_id, current_user.id)
+            mark_favorites_viewed(favorites)
+            jobs = []
+            for favorite in favorites:
+                location = f"{favorite['city']},{favorite['country']}"
+                jobs.append((favorite,
+                             asyncio.ensure_future(self.get_weather_data(location)),
+                             asyncio.ensure_future(self.get_weather_history(location))))
+
+            tasks = [task for _, weather_task, history_task in jobs for task in (weather_task, history_task)]
+            if tasks:
+                _, pending = await asyncio.wait(tasks, timeout=current_app.config['FAVORITES_DEADLINE'])
+                for task in pending:
+                    task.cancel()
+
+            favorite_weather = []
+            for favorite, weather_task, history_task in jobs:
+                favorite_weather.append({
+                    'city': favorite['city'],
+                    'country': favorite['country'],
+                    'weather': task_result(weather_task, WEATHER_UNAVAILABLE),
+                    'history': task_result(history_task, HISTORY_UNAVAILABLE)
+                })
+            response = current_app.make_response(render_template('favorites.html', favorite_weather=favorite_weather))
+            response = self.flask_app.process_response(response)
+        await self.send_response(send, response)
+        return True
+
+    async def get_weather_data(self, location=None, lat=None, lon=None):
+        cache_key, url, params = weather_request(location, lat, lon)
+        if cache_key is None:
+            return params
+
+        data = cached_weather(cache_key, url, params, (lat, lon))
+        if data is None:
+            data = await self.flight.do(cache_key, lambda: self.fetch_current_weather(cache_key, url, params))
+            if 'error' in data:
+                return data
+
+        if current_user.is_authenticated:
+            await run_blocking(record_weather_history, current_user.id, data)
+
+        return data
+
+    async def fetch_current_weather(self, cache_key, url, params):
+        data = current_app.extensions['weather_cache'].get(cache_key, count=False)
+        if data is not None:
+            return data
+
+        try:
+            response = await self.client.get(url, params=params, call='weather',
+                                             priority=upstream_priority())
+            data = response.json()
+        except UPSTREAM_ERRORS:
+            return stale_weather(cache_key)
+        if response.status_code in WeatherClient.RETRY_STATUSES:
+            return stale_weather(cache_key)
+        return store_current_weather(cache_key, response.status_code, data)
+
+    async def get_weather_history(self, location):
+        geocode_data = await self.geocode_location(location)
+        error = history_location_error(geocode_data)
+        if error:
+            return error
+
+        lat = geocode_data[0]['lat']
+        lon = geocode_data[0]['lon']
+        keys, records, missing = await run_blocking(cached_history, lat, lon)
+        if missing:
+            url, params = history_range_request(lat, lon, [target for _, target in missing])
+            try:
+                response = await self.client.get(url, params=params, call='history',
+                                                 priority=upstream_priority())
+                hourly = response.json().get('list', []) if response.status_code == 200 else []
+            except UPSTREAM_ERRORS:
+                hourly = []
+            await run_blocking(store_history, records, missing, hourly)
+
+        return history_result(keys, records)
+
+    async def geocode_location(self, location):
+        geocode_data = await run_blocking(cached_geocode, location)
+        if geocode_data is not None:
+            return geocode_data
+
+        url, params = geocode_request(location)
+        try:
+            geocode_response = await self.client.get(url, params=params, call='geocode',
+                                                     priority=upstream_priority())
+            geocode_data = geocode_response.json()
+        except UPSTREAM_ERRORS:
+            return []
+        return await run_blocking(store_geocode, location, geocode_response.status_code, geocode_data)
+
+
+def build_environ(scope):
+    # WSGI environ for a body-less ASGI request, enough for Flask's request
+    # context, session and Flask-Login
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    server = scope.get('server') or ('localhost', 80)
+    environ['SERVER_NAME'], environ['SERVER_PORT'] = server[0], str(server[1])
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f'HTTP_{name}'
+        value = value.decode('latin1')
+        if name in environ:
+            value = environ[name] + ('; ' if name == 'HTTP_COOKIE' else ',') + value
+        environ[name] = value
+    return environ
+
+
+async def run_blocking(fn, *args):
+    # Storage, the SQLite caches and the shared token bucket wait on disk and
+    # on locks held by worker threads, so they run on the default executor in
+    # the caller's context (asyncio.to_thread once Python 3.8 is dropped)
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(context.run, fn, *args))
+
+
+async def load_user():
+    # Flask-Login keeps the loaded user on g, later current_user lookups of
+    # the request don't touch storage
+    await run_blocking(current_user._get_current_object)
+
+
+def task_result(task, placeholder):
+    if not task.done() or task.cancelled() or task.exception() is not None:
+        return placeholder
+    return task.result()
+
+
+def create_asgi_app(config_class=Config):
+    return AsyncWeatherApp(create_app(config_class))
@@ -1,4 +1,4 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request
+from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app
 from flask_login import login_user, logout_user, login_required, current_user
 from app.models import User
 from urllib.parse import urlparse
@@ -11,10 +11,18 @@ def login():
     if request.method == 'POST':
         email = request.form['email']
         password = request.form['password']
+        # Checked before the password is hashed, which is what makes guessing expensive for us
+        throttle = current_app.extensions['login_throttle']
+        retry_after = throttle.retry_after(request.remote_addr, email)
+        if retry_after:
+            flash('Too many failed login attempts, try again later')
+            return render_template('auth/login.html'), 429, {'Retry-After': str(retry_after)}
         user = User.get_by_email(email)
         if user is None or not user.check_password(password):
+            throttle.failed(request.remote_addr, email)
             flash('Invalid email or password')
             return redirect(url_for('auth.login'))
+        throttle.succeeded(email)
         login_user(user, remember=True)
         next_page = request.args.get('next')
         if not next_page or urlparse(next_page).netloc != '':
@@ -0,0 +1,269 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from math import asin, ceil, cos, floor, isfinite, radians, sin, sqrt
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.195
+
+
+class TTLCache:
+    def __init__(self, maxsize=1024, ttl=600, stale_ttl=0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # Expired entries are kept this many seconds longer for get_stale
+        self.stale_ttl = stale_ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, count=True):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += count
+                return None
+            value, expires_at, _ = entry
+            now = time.monotonic()
+            if expires_at <= now:
+                if expires_at + self.stale_ttl <= now:
+                    del self._data[key]
+                self.misses += count
+                return None
+            self._data.move_to_end(key)
+            self.hits += count
+            return value
+
+    def get_stale(self, key, within=None):
+        # (value, age in seconds) of an entry, including one that expired less
+        # than `within` (default stale_ttl) seconds ago. Not counted in the stats.
+        if within is None:
+            within = self.stale_ttl
+        with self._lock:
+            entry = self._data.get(key)
+            now = time.monotonic()
+            if entry is None or entry[1] + min(within, self.stale_ttl) <= now:
+                return None
+            return entry[0], now - entry[2]
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            now = time.monotonic()
+            self._data[key] = (value, now + ttl, now)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+            }
+
+
+class PersistentCache:
+    # Key-value store in SQLite with a TTLCache in front, entries without a
+    # ttl never expire. Without a path it only keeps the in-memory part.
+    # Expired rows are deleted by a write at most every purge_interval seconds.
+    def __init__(self, path=None, maxsize=4096, purge_interval=3600):
+        self.path = path
+        self.memory = TTLCache(maxsize=maxsize, ttl=float('inf'))
+        self.purge_interval = purge_interval
+        self._purged_at = 0
+        self._local = threading.local()
+        if path:
+            directory = os.path.dirname(path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            conn = self._connection()
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)')
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_expires_at ON cache (expires_at)')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None or not self.path:
+            return value
+        row = self._connection().execute('SELECT value, expires_at FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires_at = json.loads(row[0]), row[1]
+        if expires_at is None:
+            self.memory.set(key, value)
+        elif expires_at > time.time():
+            self.memory.set(key, value, ttl=expires_at - time.time())
+        else:
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.memory.set(key, value, ttl=ttl)
+        if self.path:
+            now = time.time()
+            expires_at = None if ttl is None else now + ttl
+            conn = self._connection()
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+                             (key, json.dumps(value), expires_at))
+                if now - self._purged_at >= self.purge_interval:
+                    self._purged_at = now
+                    conn.execute('DELETE FROM cache WHERE expires_at < ?', (now,))
+
+    def stats(self):
+        return self.memory.stats()
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share the result of the first one
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+                self.executed += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = fn()
+        except BaseException as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+        return call['result']
+
+    def running(self, key):
+        with self._lock:
+            return key in self._calls
+
+    def stats(self):
+        return {'executed': self.executed, 'coalesced': self.coalesced}
+
+
+class GeoIndex:
+    # Points of recently cached lookups in a grid of cells about cell_km
+    # wide, so a search only looks at the cells around the searched point.
+    # The oldest points are dropped past maxsize.
+    def __init__(self, cell_km=5.0, maxsize=1024):
+        self.cell = cell_km / KM_PER_DEGREE
+        self.maxsize = maxsize
+        # Cells per turn of longitude, the grid wraps around at 180 degrees
+        self.lon_cells = ceil(360 / self.cell)
+        self._points = OrderedDict()
+        self._cells = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, lat, lon):
+        with self._lock:
+            self._remove(key)
+            cell = self._cell(lat, lon)
+            self._points[key] = (lat, lon, cell)
+            self._cells.setdefault(cell, set()).add(key)
+            while len(self._points) > self.maxsize:
+                self._remove(next(iter(self._points)))
+
+    def discard(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def nearby(self, lat, lon, radius_km):
+        # (distance in km, key) of the points within radius_km, nearest first
+        lat_span = ceil(radius_km / KM_PER_DEGREE / self.cell)
+        # A degree of longitude gets shorter towards the poles
+        lon_span = min(ceil(lat_span / max(cos(radians(lat)), 0.01)), self.lon_cells // 2)
+        lat_cell, lon_cell = self._cell(lat, lon)
+        columns = {j % self.lon_cells for j in range(lon_cell - lon_span, lon_cell + lon_span + 1)}
+        found = []
+        with self._lock:
+            for i in range(lat_cell - lat_span, lat_cell + lat_span + 1):
+                for j in columns:
+                    for key in self._cells.get((i, j), ()):
+                        point_lat, point_lon, _ = self._points[key]
+                        distance = distance_km(lat, lon, point_lat, point_lon)
+                        if distance <= radius_km:
+                            found.append((distance, key))
+        found.sort()
+        return found
+
+    def _cell(self, lat, lon):
+        return floor(lat / self.cell), floor(lon / self.cell) % self.lon_cells
+
+    def _remove(self, key):
+        point = self._points.pop(key, None)
+        if point is not None:
+            keys = self._cells[point[2]]
+            keys.discard(key)
+            if not keys:
+                del self._cells[point[2]]
+
+    def __len__(self):
+        return len(self._points)
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    # Great-circle distance (haversine)
+    lat1, lon1, lat2, lon2 = map(radians, (lat1, lon1, lat2, lon2))
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * asin(min(1.0, sqrt(a)))
+
+
+def normalize_location(location):
+    return ' '.join(location.split()).casefold()
+
+
+def snap_coordinates(lat, lon, grid):
+    # Nearby browser geolocations land in the same grid cell and share one entry
+    lat, lon = float(lat), float(lon)
+    if not isfinite(lat) or not isfinite(lon):
+        raise ValueError('Coordinates must be finite numbers')
+    lat_cell = round(lat / grid)
+    lon_cell = round(lon / grid)
+    return lat_cell, lon_cell, round(lat_cell * grid, 6), round(lon_cell * grid, 6)
+
@@ -0,0 +1,405 @@
+import calendar
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from contextlib import contextmanager
+from itertools import chain, compress, filterfalse, islice, repeat
+from math import isnan, nan
+from operator import eq, lshift, or_
+from app.storage import file_lock, summarize_history
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+SEGMENT_MAGIC = b'WXHIST01'
+SEGMENT_HEADER = struct.Struct('=8sQ')
+# Column names and array typecodes, the 8 byte ones first so every column of
+# a segment file starts aligned
+COLUMNS = (('date', 'q'), ('temperature', 'd'), ('user', 'I'), ('city', 'I'), ('country', 'I'), ('description', 'I'))
+# A row of the tail log, the columns in the same order
+TAIL_ROW = struct.Struct('=qdIIII')
+# Extra columns of a segment: the city and country key of every row in
+# sorted order and the temperatures in that order, so the rows of one city
+# are a single slice
+LOCATION_COLUMNS = (('location', 'Q'), ('location_temperature', 'd'))
+# Storage methods served by the archive, the rest goes to the wrapped backend
+HISTORY_METHODS = ('get_history', 'get_history_page', 'add_history', 'add_history_batch',
+                   'get_history_stats', 'get_city_stats', 'get_top_cities')
+
+
+class Segment:
+    # Immutable block of rows sorted by user and date, its columns are views
+    # into the memory-mapped file and are paged in only when read
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.rows = SEGMENT_HEADER.unpack_from(self._mmap)
+        if magic != SEGMENT_MAGIC:
+            raise ValueError(f'Not a history segment: {path}')
+        view = memoryview(self._mmap)
+        offset = SEGMENT_HEADER.size
+        self.columns = {}
+        for name, typecode in COLUMNS + LOCATION_COLUMNS:
+            size = self.rows * array(typecode).itemsize
+            self.columns[name] = view[offset:offset + size].cast(typecode)
+            offset += size
+        self._location_counts = None
+
+    def user_range(self, user):
+        users = self.columns['user']
+        return bisect_left(users, user), bisect_left(users, user + 1)
+
+    def location_range(self, key):
+        locations = self.columns['location']
+        return bisect_left(locations, key), bisect_right(locations, key)
+
+    def location_counts(self):
+        # Rows per city, found by jumping from one run of the sorted keys to
+        # the next; kept since the segment never changes
+        if self._location_counts is None:
+            locations = self.columns['location']
+            counts = {}
+            start = 0
+            while start < self.rows:
+                key = locations[start]
+                end = bisect_right(locations, key, start)
+                counts[key] = end - start
+                start = end
+            self._location_counts = counts
+        return self._location_counts
+
+
+class HistoryArchive:
+    # Weather history kept in columns: dates (epoch seconds) and temperatures
+    # in typed arrays, city, country and description as ids into a table of
+    # distinct strings. New rows are appended to a tail log and kept in
+    # memory grouped by user; every segment_size rows they are written out as
+    # a segment file that is memory-mapped instead of loaded.
+    def __init__(self, directory, segment_size=16384):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.strings_file = os.path.join(directory, 'strings.jsonl')
+        self.lock_file = os.path.join(directory, 'archive')
+        self._lock = threading.Lock()
+        self._strings = []
+        self._string_ids = {}
+        self._strings_read = 0
+        self._segments = []
+        # user -> columns of the rows not in a segment yet
+        self._tail = {}
+        self._tail_rows = 0
+        self._tail_read = 0
+        with self._reading():
+            pass
+
+    @contextmanager
+    def _reading(self):
+        with self._lock, file_lock(self.lock_file, shared=True):
+            self._refresh()
+            yield
+
+    @contextmanager
+    def _writing(self):
+        with self._lock, file_lock(self.lock_file):
+            self._refresh()
+            yield
+
+    def get_history(self, user_id, offset=0):
+        with self._reading():
+            parts = self._user_parts(int(user_id))
+            return self._records(parts, offset, parts_length(parts))
+
+    def get_history_page(self, user_id, cursor=None, limit=50, start=None, end=None):
+        # Same paging as JsonStorage: newest first, cursor is the position in
+        # the user's history where the previous page stopped
+        with self._reading():
+            parts = self._user_parts(int(user_id))
+            low = self._position(parts, to_timestamp(start)) if start else 0
+            high = self._position(parts, to_timestamp(end)) if end else parts_length(parts)
+            if cursor is not None:
+                high = min(high, cursor)
+            first = max(low, high - limit)
+            page = self._records(parts, first, high)
+        page.reverse()
+        return page, (first if first > low else None)
+
+    def add_history(self, user_id, record):
+        self.add_history_batch([(user_id, record)])
+
+    def add_history_batch(self, records):
+        with self._writing():
+            self._append(records)
+
+    def import_history(self, storage):
+        # One-off copy of the history kept by the storage backend, skipped once done
+        marker = os.path.join(self.directory, 'imported')
+        if os.path.exists(marker):
+            return
+        with self._writing():
+            if os.path.exists(marker):
+                return
+            records = iter(storage.get_all_history())
+            batch = list(islice(records, self.segment_size))
+            while batch:
+                self._append(batch)
+                batch = list(islice(records, self.segment_size))
+            open(marker, 'w').close()
+
+    def get_history_stats(self, user_id, top=10):
+        # Searches of one user: temperatures overall and of the most searched cities
+        with self._reading():
+            parts = self._user_parts(int(user_id))
+            stats = self._summarize(parts)
+            counts = Counter()
+            for columns, lo, hi in parts:
+                counts.update(location_keys(columns, lo, hi))
+            stats['cities'] = self._top_cities(counts, top)
+            for city in stats['cities']:
+                city.update(self._summarize(parts, city.pop('key')))
+        return stats
+
+    def get_city_stats(self, city, country):
+        # Searches of one city by all users
+        with self._reading():
+            city_id, country_id = self._string_ids.get(city), self._string_ids.get(country)
+            if city_id is None or country_id is None:
+                return summarize_history(0, [])
+            key = city_id << 32 | country_id
+            temperatures = []
+            for segment in self._segments:
+                lo, hi = segment.location_range(key)
+                temperatures.append(segment.columns['location_temperature'][lo:hi])
+            temperatures.extend(location_temperatures(columns, 0, len(columns['date']), key)
+                                for columns in self._tail.values())
+            return summarize_temperatures(temperatures)
+
+    def get_top_cities(self, limit=10):
+        with self._reading():
+            counts = Counter()
+            for segment in self._segments:
+                counts.update(segment.location_counts())
+            for columns in self._tail.values():
+                counts.update(location_keys(columns, 0, len(columns['date'])))
+            cities = self._top_cities(counts, limit)
+        for city in cities:
+            del city['key']
+        return cities
+
+    def _summarize(self, parts, key=None):
+        if key is None:
+            return summarize_temperatures(columns['temperature'][lo:hi] for columns, lo, hi in parts)
+        return summarize_temperatures(location_temperatures(columns, lo, hi, key) for columns, lo, hi in parts)
+
+    def _top_cities(self, counts, limit):
+        cities = [{'city': self._strings[key >> 32], 'country': self._strings[key & 0xFFFFFFFF],
+                   'count': count, 'key': key} for key, count in counts.items()]
+        cities.sort(key=lambda city: (-city['count'], city['city'], city['country']))
+        return cities[:limit]
+
+    def _user_parts(self, user):
+        # (columns, lo, hi) slices holding the user's rows, oldest first
+        parts = []
+        for segment in self._segments:
+            lo, hi = segment.user_range(user)
+            if lo < hi:
+                parts.append((segment.columns, lo, hi))
+        tail = self._tail.get(user)
+        if tail is not None:
+            parts.append((tail, 0, len(tail['date'])))
+        return parts
+
+    def _all_parts(self):
+        parts = [(segment.columns, 0, segment.rows) for segment in self._segments]
+        parts.extend((columns, 0, len(columns['date'])) for columns in self._tail.values())
+        return parts
+
+    def _position(self, parts, timestamp):
+        # Position of the user's first row dated timestamp or later
+        position = 0
+        for columns, lo, hi in parts:
+            index = bisect_left(columns['date'], timestamp, lo, hi)
+            if index < hi:
+                return position + index - lo
+            position += hi - lo
+        return position
+
+    def _records(self, parts, first, last):
+        records = []
+        position = 0
+        for columns, lo, hi in parts:
+            start = lo + max(first - position, 0)
+            stop = lo + min(last - position, hi - lo)
+            records.extend(self._record(columns, index) for index in range(start, stop))
+            position += hi - lo
+            if position >= last:
+                break
+        return records
+
+    def _record(self, columns, index):
+        strings = self._strings
+        temperature = columns['temperature'][index]
+        return {'city': strings[columns['city'][index]], 'country': strings[columns['country'][index]],
+                'temperature': None if isnan(temperature) else temperature,
+                'description': strings[columns['description'][index]],
+                'date': time.strftime(DATE_FORMAT, time.gmtime(columns['date'][index]))}
+
+    def _append(self, records):
+        new_strings = []
+        rows = [self._row(user_id, record, new_strings) for user_id, record in records]
+        if new_strings:
+            self._strings_read += write_at(self.strings_file, self._strings_read,
+                                           ''.join(json.dumps(string) + '\n' for string in new_strings).encode())
+        self._tail_read += write_at(self._tail_path(), self._tail_read,
+                                    b''.join(TAIL_ROW.pack(*row) for row in rows))
+        for row in rows:
+            self._add_tail_row(row)
+        if self._tail_rows >= self.segment_size:
+            self._write_segment()
+
+    def _row(self, user_id, record, new_strings):
+        temperature = record['temperature']
+        return (to_timestamp(record['date']), nan if temperature is None else float(temperature), int(user_id),
+                self._intern(record['city'], new_strings), self._intern(record['country'], new_strings),
+                self._intern(record['description'], new_strings))
+
+    def _intern(self, string, new_strings):
+        string_id = self._string_ids.get(string)
+        if string_id is None:
+            string_id = self._string_ids[string] = len(self._strings)
+            self._strings.append(string)
+            new_strings.append(string)
+        return string_id
+
+    def _add_tail_row(self, row):
+        columns = self._tail.get(row[2])
+        if columns is None:
+            columns = self._tail[row[2]] = {name: array(typecode) for name, typecode in COLUMNS}
+        for (name, _), value in zip(COLUMNS, row):
+            columns[name].append(value)
+        self._tail_rows += 1
+
+    def _write_segment(self):
+        # Users in order and each user's rows in date order, so the rows of
+        # a user are one slice of the segment
+        path = self._segment_path(len(self._segments))
+        users = sorted(self._tail)
+        columns = {}
+        for name, typecode in COLUMNS:
+            columns[name] = array(typecode)
+            for user in users:
+                columns[name].extend(self._tail[user][name])
+        locations = array('Q', location_keys(columns, 0, self._tail_rows))
+        order = sorted(range(self._tail_rows), key=locations.__getitem__)
+        columns['location'] = array('Q', map(locations.__getitem__, order))
+        columns['location_temperature'] = array('d', map(columns['temperature'].__getitem__, order))
+        with open(path + '.tmp', 'wb') as file:
+            file.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, self._tail_rows))
+            for name, _ in COLUMNS + LOCATION_COLUMNS:
+                file.write(columns[name].tobytes())
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + '.tmp', path)
+        tail_path = self._tail_path()
+        self._segments.append(Segment(path))
+        os.remove(tail_path)
+        self._tail, self._tail_rows, self._tail_read = {}, 0, 0
+
+    def _segment_path(self, index):
+        return os.path.join(self.directory, f'{index:08d}.seg')
+
+    def _tail_path(self):
+        # Named after the segment it turns into, so a tail left behind by a
+        # crash right after its segment was written is never read again
+        return os.path.join(self.directory, f'{len(self._segments):08d}.tail')
+
+    def _refresh(self):
+        # Picks up strings, rows and segments written by other processes
+        self._read_strings()
+        if os.path.exists(self._segment_path(len(self._segments))):
+            while os.path.exists(self._segment_path(len(self._segments))):
+                self._segments.append(Segment(self._segment_path(len(self._segments))))
+            self._tail, self._tail_rows, self._tail_read = {}, 0, 0
+        self._read_tail()
+
+    def _read_strings(self):
+        data = read_from(self.strings_file, self._strings_read)
+        # A line cut short by a crash is overwritten by the next writer
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            string = json.loads(line)
+            self._string_ids[string] = len(self._strings)
+            self._strings.append(string)
+        self._strings_read += end
+
+    def _read_tail(self):
+        data = read_from(self._tail_path(), self._tail_read)
+        end = len(data) - len(data) % TAIL_ROW.size
+        for row in TAIL_ROW.iter_unpack(data[:end]):
+            self._add_tail_row(row)
+        self._tail_read += end
+
+
+class ArchivedHistoryStorage:
+    # Storage backend wrapper that keeps weather history in a HistoryArchive
+    def __init__(self, storage, archive):
+        self._storage = storage
+        self.archive = archive
+
+    def __getattr__(self, name):
+        return getattr(self.archive if name in HISTORY_METHODS else self._storage, name)
+
+
+def archive_history(storage, directory, segment_size=16384):
+    archive = HistoryArchive(directory, segment_size=segment_size)
+    archive.import_history(storage)
+    return ArchivedHistoryStorage(storage, archive)
+
+
+def location_keys(columns, lo, hi):
+    # city and country ids of each row packed into one int
+    return map(or_, map(lshift, columns['city'][lo:hi], repeat(32)), columns['country'][lo:hi])
+
+
+def location_temperatures(columns, lo, hi, key):
+    return compress(columns['temperature'][lo:hi], map(eq, location_keys(columns, lo, hi), repeat(key)))
+
+
+def summarize_temperatures(slices):
+    # Column slices are filtered and reduced by itertools, map and the
+    # builtins, without a Python-level loop over the rows. Unknown
+    # temperatures are stored as NaN.
+    values = array('d', chain.from_iterable(slices))
+    return summarize_history(len(values), array('d', filterfalse(isnan, values)))
+
+
+def parts_length(parts):
+    return sum(hi - lo for _, lo, hi in parts)
+
+
+def to_timestamp(date):
+    # Dates are naive UTC, stored as epoch seconds; bounds may be bare days
+    date_format = '%Y-%m-%d' if len(date) == 10 else DATE_FORMAT
+    return calendar.timegm(time.strptime(date, date_format))
+
+
+def read_from(path, offset):
+    if not os.path.exists(path):
+        return b''
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        return file.read()
+
+
+def write_at(path, offset, data):
+    # Overwrites whatever a crashed writer left after the last complete entry
+    with open(path, 'r+b' if os.path.exists(path) else 'wb') as file:
+        file.seek(offset)
+        file.truncate()
+        file.write(data)
+    return len(data)
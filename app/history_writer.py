@@ -0,0 +1,106 @@
+import atexit
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryWriter:
+    def __init__(self, storage, batch_size=100, flush_interval=1.0):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        # The batch being written and a sequence bumped when a batch is taken
+        # from the queue and when its write ends, readers compare it
+        self._writing = []
+        self._flushes = 0
+        self._lock = threading.Lock()
+        # Held while a batch is written, one flush at a time
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self.failures = 0
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='history-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def enqueue(self, user_id, record):
+        with self._lock:
+            self._pending.append((str(user_id), record))
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def read(self, user_id, read_storage, attempts=3):
+        # Calls read_storage with the user's queued records, oldest first, so
+        # each record is either queued or stored. Storage is read outside of
+        # any lock and read again when a flush started or ended meanwhile.
+        # Only a write of the user's own records is waited for, it is unknown
+        # whether they are stored until it ends.
+        user_id = str(user_id)
+        for _ in range(attempts):
+            with self._lock:
+                flushes = self._flushes
+                writing = any(uid == user_id for uid, _ in self._writing)
+                queued = [dict(record) for uid, record in self._pending if uid == user_id]
+            if writing:
+                with self._flush_lock:
+                    continue
+            result = read_storage(queued)
+            with self._lock:
+                if self._flushes == flushes:
+                    return result
+        # Flushes keep overlapping the read, so it runs while none can start
+        with self._flush_lock:
+            with self._lock:
+                queued = [dict(record) for uid, record in self._pending if uid == user_id]
+            return read_storage(queued)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                if not batch:
+                    return
+                self._writing = batch
+                self._flushes += 1
+            try:
+                self.storage.add_history_batch(batch)
+            except Exception:
+                # Keep the records queued so the next flush retries them
+                with self._lock:
+                    self._pending[:0] = batch
+                raise
+            finally:
+                with self._lock:
+                    self._writing = []
+                    self._flushes += 1
+
+    def stats(self):
+        with self._lock:
+            return {'pending': len(self._pending), 'failures': self.failures}
+
+    def stop(self):
+        if self._stopped:
+            return
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        atexit.unregister(self.stop)
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('History flush failed, %d records stay queued', len(self._pending))
+                self.failures += 1
@@ -0,0 +1,134 @@
+import hashlib
+import os
+import time
+from flask import current_app, jsonify, request
+from flask_login import current_user
+from werkzeug.security import safe_join
+
+# Fingerprinted static URLs change whenever the file does, so they can be kept for a year
+IMMUTABLE_MAX_AGE = 365 * 86400
+# Lower bound on the max-age of an observation whose successor is already overdue
+MIN_WEATHER_MAX_AGE = 60
+
+
+def init_http_cache(app):
+    fingerprints = {}
+
+    def fingerprint(filename):
+        # Content hash of a static file, recomputed when its mtime changes
+        path = safe_join(app.static_folder, filename) if filename else None
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except (OSError, TypeError):
+            return None
+        cached = fingerprints.get(filename)
+        if cached is None or cached[0] != mtime:
+            with open(path, 'rb') as file:
+                cached = fingerprints[filename] = (mtime, hashlib.md5(file.read()).hexdigest()[:12])
+        return cached[1]
+
+    @app.url_defaults
+    def fingerprint_static_urls(endpoint, values):
+        if endpoint == 'static' and 'v' not in values:
+            version = fingerprint(values.get('filename', ''))
+            if version is not None:
+                values['v'] = version
+
+    @app.after_request
+    def cache_fingerprinted_static(response):
+        # Only when the version matches, an outdated link must not pin new content
+        if request.endpoint != 'static' or response.status_code not in (200, 304):
+            return response
+        version = request.args.get('v')
+        if version is not None and version == fingerprint(request.view_args.get('filename', '')):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+            response.expires = int(time.time() + IMMUTABLE_MAX_AGE)
+        return response
+
+
+def page_response(html):
+    # Rendered pages depend on the signed-in user, they are only revalidated
+    response = current_app.response_class(html, mimetype='text/html')
+    response.add_etag()
+    response.cache_control.no_cache = True
+    response.cache_control.private = True
+    response.vary.add('Cookie')
+    return response.make_conditional(request)
+
+
+def slim_weather(data):
+    # Only what script.js reads, in the upstream structure
+    slim = {
+        'name': data['name'],
+        'sys': {'country': data['sys']['country']},
+        'main': {'temp': data['main']['temp']},
+        'weather': [{'description': data['weather'][0]['description']}],
+    }
+    for field in ('dt', 'stale', 'age'):
+        if field in data:
+            slim[field] = data[field]
+    return slim
+
+
+# Response bodies of /api/current_weather by ?view=
+WEATHER_VIEWS = {'full': lambda data: data, 'slim': slim_weather}
+
+
+def weather_response(data, view='full'):
+    # Current weather as JSON with a weak ETag of the observation, answering
+    # a matching If-None-Match with an empty 304
+    if 'error' in data or 'dt' not in data:
+        return jsonify(data)
+
+    etag = weather_etag(data)
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.response_class(weather_body(data, view, etag), mimetype='application/json')
+    response.set_etag(etag, weak=True)
+    response.vary.add('Cookie')
+
+    if current_user.is_authenticated or data.get('stale'):
+        # Lookups of signed-in users are recorded in their history and stale
+        # data is being refreshed, so both are revalidated on every use
+        response.cache_control.no_cache = True
+        response.cache_control.private = current_user.is_authenticated or None
+    else:
+        response.cache_control.public = True
+        response.cache_control.max_age = weather_max_age(data)
+    return response
+
+
+def weather_body(data, view, etag):
+    # Serialized once per observation and view, hot entries skip the encoding.
+    # Stale copies carry their age and are encoded every time.
+    if data.get('stale'):
+        return encode_weather(data, view)
+    cache = current_app.extensions['response_cache']
+    body = cache.get((view, etag))
+    if body is None:
+        body = encode_weather(data, view)
+        cache.set((view, etag), body)
+    return body
+
+
+def encode_weather(data, view):
+    # Same encoding as jsonify
+    return (current_app.json.dumps(WEATHER_VIEWS[view](data)) + '\n').encode()
+
+
+def weather_etag(data):
+    # The same observation of the same place, 'age' and the like may differ.
+    # Also keys the encoded bodies, so every part identifying the place counts.
+    place = (data.get('id'), data.get('name'), data.get('sys', {}).get('country'), data.get('coord'))
+    return hashlib.md5(f'{place}|{data["dt"]}'.encode()).hexdigest()[:16]
+
+
+def weather_max_age(data):
+    # Until the next observation is due, upstream publishes one every WEATHER_UPDATE_INTERVAL seconds
+    interval = current_app.config['WEATHER_UPDATE_INTERVAL']
+    due = data['dt'] + interval - time.time()
+    return int(min(interval, max(MIN_WEATHER_MAX_AGE, due)))
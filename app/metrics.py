@@ -0,0 +1,258 @@
+import threading
+import time
+from bisect import bisect_left
+from flask import g, request
+
+# Upper bounds in seconds, from cache hits to slow upstream calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds in km, for observations served in place of a nearby point
+DISTANCE_BUCKETS = (0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 25.0)
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [count per bucket (last one is +Inf), sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def samples(self):
+        with self._lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+        for labels, counts, total in sorted(series):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield '_bucket', labels + (format_bound(bound),), self.labelnames + ('le',), cumulative
+            yield '_sum', labels, self.labelnames, total
+            yield '_count', labels, self.labelnames, cumulative
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield '', labels, self.labelnames, value
+
+
+class CollectedMetric:
+    # Values are read from a callback when the metrics are scraped
+    def __init__(self, name, documentation, labelnames, collect):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.collect = collect
+
+    def samples(self):
+        for labels, value in sorted(self.collect().items()):
+            yield '', labels, self.labelnames, value
+
+
+class Metrics:
+    # Per-process registry rendered in the Prometheus text format, each
+    # worker process exposes its own numbers
+    def __init__(self, prefix='weather_app'):
+        self.prefix = prefix
+        self._metrics = []
+        self._types = {}
+        self.requests = self.histogram('request_duration_seconds', 'Time spent serving a request',
+                                       ('endpoint', 'method'))
+        self.responses = self.counter('responses_total', 'Responses by status code',
+                                      ('endpoint', 'method', 'status'))
+        self.upstream = self.histogram('upstream_duration_seconds', 'Time spent in upstream API calls, retries included',
+                                       ('call',))
+        self.upstream_results = self.counter('upstream_requests_total', 'Upstream API calls by outcome',
+                                             ('call', 'outcome'))
+        self.storage = self.histogram('storage_duration_seconds', 'Time spent in storage operations',
+                                      ('operation',))
+        self.storage_errors = self.counter('storage_errors_total', 'Storage operations that raised',
+                                           ('operation',))
+        self.nearby_distance = self.histogram('weather_nearby_distance_km',
+                                              'Distance between a coordinate lookup and the cached nearby '
+                                              'observation served for it', (), DISTANCE_BUCKETS)
+
+    def histogram(self, name, documentation, labelnames, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(f'{self.prefix}_{name}', documentation, labelnames, buckets), 'histogram')
+
+    def counter(self, name, documentation, labelnames):
+        return self._register(Counter(f'{self.prefix}_{name}', documentation, labelnames), 'counter')
+
+    def collected(self, name, documentation, labelnames, collect, kind='gauge'):
+        return self._register(CollectedMetric(f'{self.prefix}_{name}', documentation, labelnames, collect), kind)
+
+    def _register(self, metric, kind):
+        self._metrics.append(metric)
+        self._types[metric.name] = kind
+        return metric
+
+    def observe_upstream(self, call, started, outcome):
+        self.upstream.observe(time.perf_counter() - started, call)
+        self.upstream_results.inc(call, outcome)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {self._types[metric.name]}')
+            for suffix, labels, labelnames, value in metric.samples():
+                lines.append(f'{metric.name}{suffix}{format_labels(labelnames, labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class InstrumentedStorage:
+    # Times every public method of the wrapped storage backend
+    def __init__(self, storage, metrics):
+        self._storage = storage
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        method = getattr(self._storage, name)
+        if name.startswith('_') or not callable(method):
+            return method
+        histogram, errors = self._metrics.storage, self._metrics.storage_errors
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            except Exception:
+                errors.inc(name)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started, name)
+        # Cached on the instance so the next call skips __getattr__
+        setattr(self, name, timed)
+        return timed
+
+
+CACHES = ('weather_cache', 'response_cache', 'geocode_cache', 'history_cache')
+
+
+def init_metrics(app, metrics):
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('request_started', None)
+        if started is not None:
+            # Unknown URLs share one label so they can't blow up the series count
+            endpoint = request.endpoint or 'unmatched'
+            metrics.requests.observe(time.perf_counter() - started, endpoint, request.method)
+            metrics.responses.inc(endpoint, request.method, str(response.status_code))
+        return response
+
+    def cache_stat(stat):
+        return lambda: {(name,): app.extensions[name].stats()[stat] for name in CACHES if name in app.extensions}
+
+    def hit_ratio():
+        ratios = {}
+        for name in CACHES:
+            if name in app.extensions:
+                stats = app.extensions[name].stats()
+                lookups = stats['hits'] + stats['misses']
+                ratios[(name,)] = stats['hits'] / lookups if lookups else 0.0
+        return ratios
+
+    def single_flight():
+        stats = app.extensions['single_flight'].stats()
+        return {(outcome,): count for outcome, count in stats.items()}
+
+    metrics.collected('cache_hits_total', 'Cache lookups that found an entry', ('cache',), cache_stat('hits'),
+                      kind='counter')
+    metrics.collected('cache_misses_total', 'Cache lookups that found nothing', ('cache',), cache_stat('misses'),
+                      kind='counter')
+    metrics.collected('cache_evictions_total', 'Entries evicted to make room', ('cache',), cache_stat('evictions'),
+                      kind='counter')
+    metrics.collected('cache_entries', 'Entries held in memory', ('cache',), cache_stat('size'))
+    metrics.collected('cache_hit_ratio', 'Share of cache lookups that found an entry', ('cache',), hit_ratio)
+    metrics.collected('single_flight_calls_total', 'Weather lookups that called upstream or joined a running call',
+                      ('outcome',), single_flight, kind='counter')
+    def rate_limit_tokens():
+        limiter = app.extensions['weather_client'].limiter
+        return {} if limiter is None else {(): limiter.tokens()}
+
+    def rate_limit_decisions():
+        limiter = app.extensions['weather_client'].limiter
+        return {} if limiter is None else limiter.stats()
+
+    metrics.collected('upstream_rate_limit_tokens', 'Upstream calls left in the shared rate limit bucket', (),
+                      rate_limit_tokens)
+    metrics.collected('upstream_rate_limit_decisions_total', 'Upstream calls let through or denied by the rate limit',
+                      ('priority', 'decision'), rate_limit_decisions, kind='counter')
+    def refresher():
+        if 'favorites_refresher' not in app.extensions:
+            return {}
+        stats = app.extensions['favorites_refresher'].stats()
+        return {(outcome,): stats[outcome] for outcome in ('refreshed', 'skipped')}
+
+    def refresher_errors():
+        if 'favorites_refresher' not in app.extensions:
+            return {}
+        return {(): app.extensions['favorites_refresher'].stats()['errors']}
+
+    def history_writer_stat(stat):
+        def collect():
+            # Looked up on every scrape, the writer is replaced whenever the storage is configured
+            from app import models
+            return {} if models.history_writer is None else {(): models.history_writer.stats()[stat]}
+        return collect
+
+    def login_throttle():
+        return {(): app.extensions['login_throttle'].stats()['rejected']}
+
+    metrics.collected('history_write_queue', 'History records waiting for the write-behind flush', (),
+                      history_writer_stat('pending'))
+    metrics.collected('history_flush_failures_total', 'Write-behind history flushes that raised', (),
+                      history_writer_stat('failures'), kind='counter')
+    metrics.collected('login_throttled_total', 'Login attempts refused by the failed login throttle', (),
+                      login_throttle, kind='counter')
+    metrics.collected('favorites_refresh_locations_total', 'Favorited locations refreshed or skipped for lack of budget',
+                      ('outcome',), refresher, kind='counter')
+    metrics.collected('favorites_refresh_errors_total', 'Favorited location refreshes and refresh cycles that raised',
+                      (), refresher_errors, kind='counter')
+    app.extensions['metrics'] = metrics
+    return metrics
+
+
+def format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+def format_labels(labelnames, labels):
+    if not labelnames:
+        return ''
+    pairs = ','.join(f'{name}="{escape_label(value)}"' for name, value in zip(labelnames, labels))
+    return '{' + pairs + '}'
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -1,40 +1,62 @@
-import json
-import os
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import lru_cache
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
+from app.storage import JsonStorage, create_storage
+from app.history_writer import HistoryWriter
+from app.history_archive import archive_history
+from app.metrics import InstrumentedStorage
 
 DATA_DIR = 'data'
 
-if not os.path.exists(DATA_DIR):
-    os.makedirs(DATA_DIR)
-
-USERS_FILE = os.path.join(DATA_DIR, 'users.json')
-FAVORITES_FILE = os.path.join(DATA_DIR, 'favorites.json')
-HISTORY_FILE = os.path.join(DATA_DIR, 'history.json')
-
-# Initialize JSON files if they don't exist or are empty
-def initialize_json_file(file_path):
-    if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
-        with open(file_path, 'w') as file:
-            json.dump({}, file)
-
-initialize_json_file(USERS_FILE)
-initialize_json_file(FAVORITES_FILE)
-initialize_json_file(HISTORY_FILE)
-
-def read_json_file(file_path):
-    try:
-        if os.path.exists(file_path):
-            with open(file_path, 'r') as file:
-                return json.load(file)
-        return {}
-    except json.JSONDecodeError:
-        return {}
-
-def write_json_file(file_path, data):
-    with open(file_path, 'w') as file:
-        json.dump(data, file, indent=4)
+# Storage backend used by the models, replaced by create_app() from the config
+storage = JsonStorage(DATA_DIR)
+# Write-behind queue for weather history, None writes synchronously
+history_writer = None
+
+# Hashing scheme for passwords in werkzeug's notation, set from PASSWORD_HASH_METHOD
+password_hash_method = 'scrypt:32768:8:1'
+
+EPOCH = datetime(1970, 1, 1)
+ONE_SECOND = timedelta(seconds=1)
+
+def configure_password_hashing(config):
+    global password_hash_method
+    password_hash_method = config.get('PASSWORD_HASH_METHOD', password_hash_method)
+
+@lru_cache(maxsize=8)
+def hash_parameters(method):
+    # The method with werkzeug's defaults filled in ('scrypt' is stored as
+    # 'scrypt:32768:8:1'), as it appears in front of the first '$' of a hash
+    return generate_password_hash('', method=method).split('$', 1)[0]
+
+def configure_storage(config, metrics=None):
+    global storage, history_writer
+    if history_writer is not None:
+        history_writer.stop()
+        history_writer = None
+    storage = create_storage(config)
+    if config.get('HISTORY_ARCHIVE_PATH'):
+        storage = archive_history(storage, config['HISTORY_ARCHIVE_PATH'],
+                                  segment_size=config.get('HISTORY_SEGMENT_SIZE', 16384))
+    if metrics is not None:
+        storage = InstrumentedStorage(storage, metrics)
+    if config.get('HISTORY_WRITE_BEHIND'):
+        history_writer = HistoryWriter(storage,
+                                       batch_size=config.get('HISTORY_BATCH_SIZE', 100),
+                                       flush_interval=config.get('HISTORY_FLUSH_INTERVAL', 1.0)).start()
+    return storage
+
+def read_queued(user_id, read):
+    # read() gets the user's records still queued by the write-behind writer,
+    # which are newer than anything stored
+    if history_writer is None:
+        return read([])
+    return history_writer.read(user_id, read)
+
+def in_date_range(record, start, end):
+    # Same bounds as the storage backends, end exclusive
+    return (not start or record['date'] >= start) and (not end or record['date'] < end)
 
 class User(UserMixin):
     def __init__(self, id, username, email, password_hash, is_subscribed=False):
@@ -46,41 +68,39 @@ class User(UserMixin):
 
     @staticmethod
     def get(user_id):
-        users = read_json_file(USERS_FILE)
-        user_data = users.get(str(user_id))
+        user_data = storage.get_user(user_id)
         if user_data:
             return User(user_id, user_data['username'], user_data['email'], user_data['password_hash'], user_data.get('is_subscribed', False))
         return None
 
     @staticmethod
     def get_by_email(email):
-        users = read_json_file(USERS_FILE)
-        for user_id, user_data in users.items():
-            if user_data['email'] == email:
-                return User(user_id, user_data['username'], user_data['email'], user_data['password_hash'], user_data.get('is_subscribed', False))
+        found = storage.get_user_by_email(email)
+        if found:
+            user_id, user_data = found
+            return User(user_id, user_data['username'], user_data['email'], user_data['password_hash'], user_data.get('is_subscribed', False))
         return None
 
     @staticmethod
     def create(username, email, password):
-        users = read_json_file(USERS_FILE)
-        user_id = len(users) + 1
-        password_hash = generate_password_hash(password)
-        users[user_id] = {'username': username, 'email': email, 'password_hash': password_hash, 'is_subscribed': False}
-        write_json_file(USERS_FILE, users)
+        password_hash = generate_password_hash(password, method=password_hash_method)
+        user_id = storage.create_user(username, email, password_hash)
         return User(user_id, username, email, password_hash)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not check_password_hash(self.password_hash, password):
+            return False
+        # A hash made with other parameters is replaced while the password is at hand
+        if self.password_hash.split('$', 1)[0] != hash_parameters(password_hash_method):
+            self.password_hash = generate_password_hash(password, method=password_hash_method)
+            storage.set_password_hash(self.id, self.password_hash)
+        return True
 
     def subscribe(self):
-        users = read_json_file(USERS_FILE)
-        users[str(self.id)]['is_subscribed'] = True
-        write_json_file(USERS_FILE, users)
+        storage.set_subscribed(self.id, True)
 
     def unsubscribe(self):
-        users = read_json_file(USERS_FILE)
-        users[str(self.id)]['is_subscribed'] = False
-        write_json_file(USERS_FILE, users)
+        storage.set_subscribed(self.id, False)
 
 class FavoriteLocation:
     def __init__(self, user_id, city, country):
@@ -90,48 +110,127 @@ class FavoriteLocation:
 
     @staticmethod
     def get_by_user_id(user_id):
-        favorites = read_json_file(FAVORITES_FILE)
-        return favorites.get(str(user_id), [])
+        return storage.get_favorites(user_id)
+
+    @staticmethod
+    def is_favorite(user_id, city, country):
+        return storage.has_favorite(user_id, city, country)
+
+    @staticmethod
+    def get_all_locations():
+        return storage.get_favorite_locations()
+
+    @staticmethod
+    def get_followers():
+        return storage.get_favorite_followers()
+
+    @staticmethod
+    def get_registry():
+        # Each followed location once, with its coordinates and follower count
+        return storage.get_location_registry()
+
+    @staticmethod
+    def set_coordinates(city, country, lat, lon):
+        storage.set_location_coordinates(city, country, lat, lon)
 
     @staticmethod
     def add(user_id, city, country):
-        favorites = read_json_file(FAVORITES_FILE)
-        user_favorites = favorites.get(str(user_id), [])
-        user_favorites.append({'city': city, 'country': country})
-        favorites[str(user_id)] = user_favorites
-        write_json_file(FAVORITES_FILE, favorites)
+        return storage.add_favorite(user_id, city, country)
 
     @staticmethod
     def delete(user_id, city, country):
-        favorites = read_json_file(FAVORITES_FILE)
-        user_favorites = favorites.get(str(user_id), [])
-        user_favorites = [f for f in user_favorites if not (f['city'] == city and f['country'] == country)]
-        favorites[str(user_id)] = user_favorites
-        write_json_file(FAVORITES_FILE, favorites)
+        return storage.delete_favorite(user_id, city, country)
 
 class WeatherHistory:
-    def __init__(self, user_id, city, country, temperature, description, date):
+    # The date is kept as epoch seconds and turned into a datetime only when
+    # read, most records of a long history are never shown
+    __slots__ = ('user_id', 'city', 'country', 'temperature', 'description', 'timestamp', '_date')
+
+    def __init__(self, user_id, city, country, temperature, description, timestamp):
         self.user_id = user_id
         self.city = city
         self.country = country
         self.temperature = temperature
         self.description = description
-        self.date = date
+        self.timestamp = timestamp
+        self._date = None
+
+    @property
+    def date(self):
+        if self._date is None:
+            self._date = EPOCH + timedelta(seconds=self.timestamp)
+        return self._date
+
+    def __getitem__(self, key):
+        # Readable like the stored records, record['city'] as well as record.city
+        return getattr(self, key)
+
+    @staticmethod
+    def from_record(user_id, record):
+        timestamp = (datetime.fromisoformat(record['date']) - EPOCH) // ONE_SECOND
+        return WeatherHistory(user_id, record['city'], record['country'], record['temperature'],
+                              record['description'], timestamp)
 
     @staticmethod
     def get_by_user_id(user_id):
-        history = read_json_file(HISTORY_FILE)
-        user_history = history.get(str(user_id), [])
-        # Convert date strings back to datetime objects
-        for record in user_history:
-            record['date'] = datetime.strptime(record['date'], '%Y-%m-%d %H:%M:%S')
-        return user_history
+        records = read_queued(user_id, lambda queued: storage.get_history(user_id) + queued)
+        return [WeatherHistory.from_record(user_id, record) for record in records]
+
+    @staticmethod
+    def get_page(user_id, cursor=None, limit=50, start=None, end=None):
+        def read(queued):
+            # Queued records are the newest ones, they lead the first page
+            queued = [record for record in reversed(queued) if in_date_range(record, start, end)]
+            if len(queued) >= limit:
+                return None
+            page, next_cursor = storage.get_history_page(user_id, cursor=cursor, limit=limit - len(queued),
+                                                         start=start, end=end)
+            return queued + page, next_cursor
+
+        result = read_queued(user_id, read) if cursor is None else read([])
+        if result is None:
+            # More queued than a page holds, a cursor can only point into
+            # storage so they are written first
+            history_writer.flush()
+            result = read([])
+        page, next_cursor = result
+        return [WeatherHistory.from_record(user_id, record) for record in page], next_cursor
+
+    @staticmethod
+    def iter_records(user_id, cursor=None, start=None, end=None, page_size=500):
+        # Yields raw records newest first, one page in memory at a time
+        def first_page(queued):
+            queued = [record for record in reversed(queued) if in_date_range(record, start, end)]
+            return queued, storage.get_history_page(user_id, cursor=cursor, limit=page_size, start=start, end=end)
+
+        queued, (page, cursor) = read_queued(user_id, first_page) if cursor is None else first_page([])
+        yield from queued
+        yield from page
+        while cursor is not None:
+            page, cursor = storage.get_history_page(user_id, cursor=cursor, limit=page_size, start=start, end=end)
+            yield from page
+
+    # Aggregates only count stored records, queued ones join them within
+    # HISTORY_FLUSH_INTERVAL
+
+    @staticmethod
+    def get_stats(user_id, top=10):
+        return storage.get_history_stats(user_id, top=top)
+
+    @staticmethod
+    def get_city_stats(city, country):
+        return storage.get_city_stats(city, country)
+
+    @staticmethod
+    def get_top_cities(limit=10):
+        return storage.get_top_cities(limit=limit)
 
     @staticmethod
     def add(user_id, city, country, temperature, description, date):
-        history = read_json_file(HISTORY_FILE)
-        user_history = history.get(str(user_id), [])
-        # Convert datetime object to string before saving
-        user_history.append({'city': city, 'country': country, 'temperature': temperature, 'description': description, 'date': date.strftime('%Y-%m-%d %H:%M:%S')})
-        history[str(user_id)] = user_history
-        write_json_file(HISTORY_FILE, history)
+        # Stored as 'YYYY-MM-DD HH:MM:SS', isoformat writes it without parsing a format string
+        record = {'city': city, 'country': country, 'temperature': temperature, 'description': description,
+                  'date': date.isoformat(' ', 'seconds')}
+        if history_writer is not None:
+            history_writer.enqueue(user_id, record)
+        else:
+            storage.add_history(user_id, record)
@@ -0,0 +1,131 @@
+import struct
+import threading
+import time
+from math import ceil
+from app.cache import TTLCache
+from app.storage import file_lock
+
+# Share of the burst each priority leaves for the ones above it, so
+# background work runs dry first and interactive lookups last
+PRIORITY_RESERVES = {'interactive': 0.0, 'favorites': 0.25, 'background': 0.5}
+
+# Tokens left and the time they were counted
+STATE = struct.Struct('dd')
+
+
+class TokenBucket:
+    # Allows `rate` calls a second on average with bursts of up to `burst`.
+    # With a path the bucket is kept in a small flock-guarded file, so all
+    # worker processes on the host draw from one budget.
+    def __init__(self, rate, burst, path=None, reserves=PRIORITY_RESERVES):
+        self.rate = rate
+        self.burst = burst
+        self.path = path
+        self.reserves = reserves
+        self.decisions = {}
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, priority='interactive'):
+        # Takes a token unless that would leave fewer than the priority's reserve
+        reserve = self.reserves[priority] * self.burst
+        with self._lock:
+            if self.path is None:
+                allowed = self._take(reserve)
+            else:
+                with file_lock(self.path):
+                    self._load()
+                    allowed = self._take(reserve)
+                    self._save()
+            decision = (priority, 'allowed' if allowed else 'denied')
+            self.decisions[decision] = self.decisions.get(decision, 0) + 1
+        return allowed
+
+    def tokens(self):
+        with self._lock:
+            if self.path is not None:
+                with file_lock(self.path, shared=True):
+                    self._load()
+            return min(self.burst, self._tokens + max(0.0, time.time() - self._updated) * self.rate)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.decisions)
+
+    def _take(self, reserve):
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens + max(0.0, now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens - 1 < reserve:
+            return False
+        self._tokens -= 1
+        return True
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as file:
+                self._tokens, self._updated = STATE.unpack(file.read(STATE.size))
+        except (OSError, struct.error):
+            # A missing or truncated file starts out full
+            self._tokens, self._updated = float(self.burst), time.time()
+
+    def _save(self):
+        with open(self.path, 'wb') as file:
+            file.write(STATE.pack(self._tokens, self._updated))
+
+
+class LoginThrottle:
+    # Failed logins per client address and per email. After `limit` of them
+    # within `window` seconds of the first, further attempts are refused
+    # before any password is hashed, until that window ends. A limit of 0
+    # turns the check off. Counters are per process and the least recently
+    # failing keys are dropped past maxsize.
+    def __init__(self, ip_limit=20, email_limit=5, window=300, maxsize=10000):
+        self.limits = {'ip': ip_limit, 'email': email_limit}
+        self.window = window
+        # key -> (failures, monotonic time the window ends)
+        self._failures = TTLCache(maxsize=maxsize, ttl=window)
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def retry_after(self, ip, email):
+        # Seconds until an attempt for this address and email is allowed, 0 if it is now
+        now = time.monotonic()
+        wait = 0.0
+        for key in self._keys(ip, email):
+            entry = self._failures.get(key, count=False)
+            if entry is not None and entry[0] >= self.limits[key[0]]:
+                wait = max(wait, entry[1] - now)
+        if wait > 0:
+            with self._lock:
+                self.rejected += 1
+        return ceil(wait)
+
+    def failed(self, ip, email):
+        now = time.monotonic()
+        with self._lock:
+            for key in self._keys(ip, email):
+                failures, ends = self._failures.get(key, count=False) or (0, now + self.window)
+                self._failures.set(key, (failures + 1, ends), ttl=ends - now)
+
+    def succeeded(self, email):
+        # The address keeps its count, a login to one account must not clear
+        # the failures against others
+        self._failures.delete(('email', normalize_email(email)))
+
+    def stats(self):
+        stats = self._failures.stats()
+        return {'rejected': self.rejected, 'tracked': stats['size']}
+
+    def _keys(self, ip, email):
+        keys = []
+        if self.limits['ip'] > 0 and ip:
+            keys.append(('ip', ip))
+        if self.limits['email'] > 0:
+            keys.append(('email', normalize_email(email)))
+        return keys
+
+
+def normalize_email(email):
+    return email.strip().casefold()
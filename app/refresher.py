@@ -0,0 +1,111 @@
+import atexit
+import logging
+import threading
+import time
+from app.models import FavoriteLocation
+from app.routes import (cached_geocode, cached_history, get_weather_history, history_location_error,
+                        request_current_weather, weather_request)
+
+logger = logging.getLogger(__name__)
+
+
+class FavoritesRefresher:
+    # Keeps the current weather and recent history of every favorited
+    # location in the caches, so /favorites is served from warm data. Each
+    # cycle spends at most `budget` upstream calls, spread over `interval`
+    # seconds, on the locations with the highest priority first.
+    def __init__(self, app, interval=300, budget=120):
+        self.app = app
+        self.interval = interval
+        self.budget = budget
+        self.refreshed = 0
+        self.skipped = 0
+        self.errors = 0
+        self._viewed = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='favorites-refresher', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        atexit.unregister(self.stop)
+
+    def mark_viewed(self, favorites):
+        now = time.monotonic()
+        with self._lock:
+            for favorite in favorites:
+                self._viewed[(favorite['city'], favorite['country'])] = now
+
+    def prioritized(self):
+        # More followers rank higher, a recent view counts up to double and
+        # fades by half every interval
+        now = time.monotonic()
+        with self._lock:
+            viewed = dict(self._viewed)
+
+        def priority(item):
+            location, followers = item
+            recency = 0.0
+            if location in viewed:
+                recency = 2 ** (-(now - viewed[location]) / self.interval)
+            return -followers * (1 + recency), location
+
+        return [location for location, _ in sorted(FavoriteLocation.get_followers().items(), key=priority)]
+
+    def refresh_once(self, pace=False):
+        # Returns the number of upstream calls spent. With pace the calls are
+        # spread over the interval instead of going out in a burst.
+        spent = 0
+        with self.app.app_context():
+            locations = self.prioritized()
+            for position, (city, country) in enumerate(locations):
+                location = f'{city},{country}'
+                cost = upstream_cost(location)
+                if spent + cost > self.budget:
+                    self.skipped += len(locations) - position
+                    break
+                try:
+                    request_current_weather(*weather_request(location))
+                    get_weather_history(location)
+                except Exception:
+                    logger.exception('Favorites refresh of %s failed', location)
+                    self.errors += 1
+                else:
+                    self.refreshed += 1
+                spent += cost
+                if pace and self._stop.wait(cost * self.interval / self.budget):
+                    break
+        return spent
+
+    def stats(self):
+        return {'refreshed': self.refreshed, 'skipped': self.skipped, 'errors': self.errors}
+
+    def _run(self):
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self.refresh_once(pace=True)
+            except Exception:
+                logger.exception('Favorites refresh cycle failed')
+                self.errors += 1
+            self._stop.wait(max(0, self.interval - (time.monotonic() - started)))
+
+
+def upstream_cost(location):
+    # Calls a refresh makes: the current weather, plus geocoding and history
+    # unless they are cached
+    geocode_data = cached_geocode(location)
+    if geocode_data is None:
+        return 3
+    if history_location_error(geocode_data):
+        return 1
+    _, _, missing = cached_history(geocode_data[0]['lat'], geocode_data[0]['lon'])
+    return 2 if missing else 1
@@ -1,21 +1,31 @@
-from flask import Blueprint, request, jsonify, render_template, current_app, redirect, url_for, flash
+from flask import Blueprint, request, jsonify, render_template, current_app, redirect, url_for, flash, copy_current_request_context, Response, stream_with_context, abort, has_request_context
+import json
 import requests
+import time
+from concurrent.futures import Future
 from flask_login import login_required, current_user
 from app.models import FavoriteLocation, WeatherHistory, User
 from config import Config
 from datetime import datetime, timedelta
+from app.cache import distance_km, normalize_location, snap_coordinates
+from app.weather_client import WeatherClient
+from app.http_cache import WEATHER_VIEWS, page_response, weather_response
 
 bp = Blueprint('main', __name__)
 
 @bp.route('/')
 def index():
-    return render_template('index.html')
+    return page_response(render_template('index.html'))
 
 @bp.route('/api/current_weather', methods=['GET'])
 def current_weather():
     location = request.args.get('location')
     lat = request.args.get('lat')
     lon = request.args.get('lon')
+    # view=slim returns only the fields the frontend shows
+    view = request.args.get('view', 'full')
+    if view not in WEATHER_VIEWS:
+        return jsonify({"error": f"Unknown view, use one of: {', '.join(WEATHER_VIEWS)}"}), 400
     
     if location:
         weather_data = get_weather_data(location=location)
@@ -24,8 +34,25 @@ def current_weather():
     else:
         return jsonify({"error": "Location or coordinates are required"}), 400
 
-    
-    return jsonify(weather_data)
+    return weather_response(weather_data, view)
+
+@bp.route('/api/current_weather/batch', methods=['POST'])
+def current_weather_batch():
+    # Body: a list of location names and/or {"lat": ..., "lon": ...} objects,
+    # bare or as {"locations": [...]}; ?format=ndjson streams one line per item
+    payload = request.get_json(silent=True)
+    items = payload.get('locations') if isinstance(payload, dict) else payload
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "A list of locations is required"}), 400
+    max_items = current_app.config['WEATHER_BATCH_MAX_ITEMS']
+    if len(items) > max_items:
+        return jsonify({"error": f"At most {max_items} locations per request"}), 400
+
+    results = get_weather_batch(items)
+    if request.args.get('format') == 'ndjson':
+        return Response(stream_with_context(json.dumps(result) + '\n' for result in results),
+                        mimetype='application/x-ndjson')
+    return jsonify({'results': list(results)})
 
 @bp.route('/favorites', methods=['GET', 'POST'])
 @login_required
@@ -39,16 +66,8 @@ def favorites():
         FavoriteLocation.add(current_user.id, city, country)
 
     favorites = FavoriteLocation.get_by_user_id(current_user.id)
-    favorite_weather = []
-    for favorite in favorites:
-        weather_data = get_weather_data(f"{favorite['city']},{favorite['country']}")
-        weather_history = get_weather_history(f"{favorite['city']},{favorite['country']}")
-        favorite_weather.append({
-            'city': favorite['city'],
-            'country': favorite['country'],
-            'weather': weather_data,
-            'history': weather_history
-        })
+    mark_favorites_viewed(favorites)
+    favorite_weather = get_favorites_weather(favorites)
 
     return render_template('favorites.html', favorite_weather=favorite_weather)
 
@@ -63,8 +82,60 @@ def delete_favorite():
 @bp.route('/history', methods=['GET'])
 @login_required
 def history():
-    weather_history = WeatherHistory.get_by_user_id(current_user.id)
-    return render_template('history.html', history=weather_history)
+    start, end = history_date_range()
+    cursor = request.args.get('cursor', type=int)
+    weather_history, next_cursor = WeatherHistory.get_page(current_user.id, cursor=cursor, limit=current_app.config['HISTORY_PAGE_SIZE'],
+                                                           start=start, end=end)
+    return render_template('history.html', history=weather_history, next_cursor=next_cursor,
+                           start=request.args.get('start', ''), end=request.args.get('end', ''))
+
+@bp.route('/api/history', methods=['GET'])
+@login_required
+def history_api():
+    start, end = history_date_range()
+    cursor = request.args.get('cursor', type=int)
+    limit = request.args.get('limit', type=int)
+    records = WeatherHistory.iter_records(current_user.id, cursor=cursor, start=start, end=end)
+
+    # Records are streamed as JSON lines while they are read page by page
+    def generate():
+        for count, record in enumerate(records):
+            if limit is not None and count >= limit:
+                return
+            yield json.dumps(record) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@bp.route('/api/history/stats', methods=['GET'])
+@login_required
+def history_stats():
+    # Temperatures of the user's searches overall and per most searched city
+    top = min(request.args.get('top', 10, type=int), 100)
+    return jsonify(WeatherHistory.get_stats(current_user.id, top=top))
+
+@bp.route('/api/cities/stats', methods=['GET'])
+@login_required
+def city_stats():
+    # Most searched cities of all users, or the temperatures of one of them
+    city = request.args.get('city')
+    country = request.args.get('country')
+    if city and country:
+        return jsonify(WeatherHistory.get_city_stats(city, country))
+    limit = min(request.args.get('limit', 10, type=int), 100)
+    return jsonify({'cities': WeatherHistory.get_top_cities(limit=limit)})
+
+def history_date_range():
+    # start and end are inclusive YYYY-MM-DD days, storage takes an exclusive end
+    try:
+        start = request.args.get('start')
+        end = request.args.get('end')
+        if start:
+            start = datetime.strptime(start, '%Y-%m-%d').strftime('%Y-%m-%d')
+        if end:
+            end = (datetime.strptime(end, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+    except ValueError:
+        abort(400, 'Dates must be in YYYY-MM-DD format')
+    return start or None, end or None
 
 @bp.route('/subscribe', methods=['POST'])
 @login_required
@@ -78,120 +149,381 @@ def unsubscribe():
     current_user.unsubscribe()
     return redirect(url_for('main.index'))
 
+@bp.route('/api/cache_stats', methods=['GET'])
+def cache_stats():
+    stats = current_app.extensions['weather_cache'].stats()
+    stats.update(current_app.extensions['single_flight'].stats())
+    return jsonify(stats)
+
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    registry = current_app.extensions.get('metrics')
+    if registry is None:
+        abort(404)
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+# Placeholders shown for a favorite whose upstream data is unavailable
+WEATHER_UNAVAILABLE = {'error': 'Invalid location or no data available'}
+HISTORY_UNAVAILABLE = [{'dt': None, 'temp': None, 'weather': [{'description': 'No historical data available'}]}]
+
 def get_weather_data(location=None, lat=None, lon=None):
-    api_key = current_app.config['WEATHER_API_KEY']
-    api_url = current_app.config['WEATHER_API_URL']
-    
-    
-    
-    params = {'appid': api_key, 'units': 'metric'}
-    if location:
-        params['q'] = location
-    elif lat and lon:
-        params['lat'] = lat
-        params['lon'] = lon
-    else:
-        return {'error': 'Location or coordinates are required'}
-    
-    response = requests.get(f'{api_url}/weather', params=params)
-    data = response.json()
-    
-    print("API Response Code:", response.status_code)
-    
-    if response.status_code != 200 or data.get('cod') != 200:
-        return {'error': 'Invalid location or no data available'}
-    
+    cache_key, url, params = weather_request(location, lat, lon)
+    if cache_key is None:
+        return params
+
+    data = cached_weather(cache_key, url, params, (lat, lon))
+    if data is None:
+        data = shared_fetch(cache_key, url, params)
+        if 'error' in data:
+            return data
+
+    # History is recorded per lookup, including lookups served from the cache
     if current_user.is_authenticated:
-        city_name = data['name']
-        country = data['sys']['country']
-        temperature = data['main']['temp']
-        description = data['weather'][0]['description']
-        date = datetime.utcnow()
-        WeatherHistory.add(current_user.id, city_name, country, temperature, description, date)
-    
+        record_weather_history(current_user.id, data)
+
     return data
 
-def get_weather_data(location=None, lat=None, lon=None):
+def weather_request(location=None, lat=None, lon=None):
+    # Returns the cache key, url and params of a lookup, or None and an error
     api_key = current_app.config['WEATHER_API_KEY']
     api_url = current_app.config['WEATHER_API_URL']
-    
-    
+
     params = {'appid': api_key, 'units': 'metric'}
     if location:
         params['q'] = location
+        cache_key = ('q', normalize_location(location))
     elif lat and lon:
-        params['lat'] = lat
-        params['lon'] = lon
+        try:
+            lat_cell, lon_cell, params['lat'], params['lon'] = snap_coordinates(
+                lat, lon, current_app.config['WEATHER_CACHE_GRID'])
+        except ValueError:
+            return None, None, {'error': 'Invalid location or no data available'}
+        cache_key = ('coord', lat_cell, lon_cell)
     else:
-        return {'error': 'Location or coordinates are required'}
-    
-    response = requests.get(f'{api_url}/weather', params=params)
-    data = response.json()
-    
-    # Debug output to console
-    print("API Response Code:", response.status_code)
-    
-    if response.status_code != 200 or data.get('cod') != 200:
+        return None, None, {'error': 'Location or coordinates are required'}
+    return cache_key, f'{api_url}/weather', params
+
+# Result of a batch item whose upstream call missed the deadline
+BATCH_UNAVAILABLE = {'error': 'Weather service is unavailable'}
+
+def shared_fetch(cache_key, url, params):
+    # Identical lookups running at the same time share one upstream call
+    return current_app.extensions['single_flight'].do(
+        cache_key, lambda: fetch_current_weather(cache_key, url, params))
+
+def get_weather_batch(items):
+    # Yields one result per item in request order. Items resolving to the same
+    # cache entry are looked up once, cache hits are answered directly and the
+    # misses are fetched concurrently. History is not recorded for batches.
+    executor = current_app.extensions['upstream_executor']
+    deadline = time.monotonic() + current_app.config['WEATHER_BATCH_DEADLINE']
+
+    lookups = {}
+    entries = []
+    for item in items:
+        location, lat, lon = batch_item_query(item)
+        cache_key, url, params = weather_request(location, lat, lon)
+        if cache_key is None:
+            entries.append((None, params))
+            continue
+        if cache_key not in lookups:
+            data = cached_weather(cache_key, url, params, (lat, lon))
+            if data is None:
+                data = executor.submit(copy_current_request_context(shared_fetch), cache_key, url, params)
+            lookups[cache_key] = data
+        entries.append((cache_key, None))
+
+    for cache_key, error in entries:
+        if cache_key is None:
+            yield error
+            continue
+        result = lookups[cache_key]
+        if isinstance(result, Future):
+            result = lookups[cache_key] = wait_for_result(result, deadline, BATCH_UNAVAILABLE)
+        yield result
+
+def batch_item_query(item):
+    # (location, lat, lon) of a batch item, coordinates as strings like query args
+    if isinstance(item, str):
+        return item, None, None
+    if isinstance(item, dict):
+        location = item.get('location')
+        lat, lon = item.get('lat'), item.get('lon')
+        return (location if isinstance(location, str) else None,
+                None if lat is None else str(lat),
+                None if lon is None else str(lon))
+    return None, None, None
+
+def fetch_current_weather(cache_key, url, params):
+    # The previous call for this key may have just filled the cache
+    data = current_app.extensions['weather_cache'].get(cache_key, count=False)
+    if data is not None:
+        return data
+    return request_current_weather(cache_key, url, params)
+
+def request_current_weather(cache_key, url, params):
+    try:
+        response = current_app.extensions['weather_client'].get(url, params=params, call='weather',
+                                                                 priority=upstream_priority())
+        data = response.json()
+    except (requests.RequestException, ValueError):
+        return stale_weather(cache_key)
+    if response.status_code in WeatherClient.RETRY_STATUSES:
+        return stale_weather(cache_key)
+    return store_current_weather(cache_key, response.status_code, data)
+
+def cached_weather(cache_key, url, params, point=None):
+    # A fresh entry, or one expired within the grace window, which is served
+    # right away while a background call replaces it (stale-while-revalidate).
+    # point is the (lat, lon) the caller asked for, before snapping.
+    cache = current_app.extensions['weather_cache']
+    data = cache.get(cache_key)
+    if data is not None:
+        return data
+    entry = cache.get_stale(cache_key, within=current_app.config['WEATHER_STALE_WHILE_REVALIDATE'])
+    if entry is None:
+        return nearby_weather(cache_key, point)
+    revalidate_weather(cache_key, url, params)
+    return stale_result(*entry)
+
+def nearby_weather(cache_key, point=None):
+    # For coordinates: the fresh observation of the closest cached grid cell
+    # within WEATHER_NEARBY_RADIUS_KM of the requested point, so visitors a
+    # few streets apart share one upstream call
+    radius = current_app.config['WEATHER_NEARBY_RADIUS_KM']
+    if cache_key[0] != 'coord' or radius <= 0:
+        return None
+    lat, lon = (float(point[0]), float(point[1])) if point else cell_center(cache_key)
+    cache = current_app.extensions['weather_cache']
+    index = current_app.extensions['geo_index']
+    for distance, key in index.nearby(lat, lon, radius):
+        entry = cache.get_stale(key, within=0)
+        if entry is None:
+            # Expired or evicted, the next fetch of that cell adds it again
+            index.discard(key)
+        elif entry[1] <= current_app.config['WEATHER_NEARBY_MAX_AGE']:
+            metrics = current_app.extensions.get('metrics')
+            if metrics is not None:
+                metrics.nearby_distance.observe(observation_distance(entry[0], lat, lon, distance))
+            return entry[0]
+    return None
+
+def observation_distance(data, lat, lon, cell_distance):
+    # How far the served observation is from the requested point: upstream
+    # reports where it was taken, without that its grid cell's centre is used
+    coord = data.get('coord') or {}
+    if coord.get('lat') is None or coord.get('lon') is None:
+        return cell_distance
+    return distance_km(lat, lon, coord['lat'], coord['lon'])
+
+def cell_center(cache_key):
+    grid = current_app.config['WEATHER_CACHE_GRID']
+    return cache_key[1] * grid, cache_key[2] * grid
+
+def revalidate_weather(cache_key, url, params):
+    if current_app.extensions['single_flight'].running(cache_key):
+        return
+    app = current_app._get_current_object()
+
+    def refresh():
+        with app.app_context():
+            shared_fetch(cache_key, url, params)
+
+    current_app.extensions['upstream_executor'].submit(refresh)
+
+def stale_weather(cache_key):
+    # When upstream fails or is over budget the last good value beats an
+    # error (stale-if-error)
+    entry = current_app.extensions['weather_cache'].get_stale(cache_key)
+    if entry is None:
+        return {'error': 'Weather service is unavailable'}
+    return stale_result(*entry)
+
+def stale_result(data, age):
+    # A flagged copy, so the frontend can show how old the data is
+    return dict(data, stale=True, age=int(age))
+
+def upstream_priority():
+    # Rate limiter class of an upstream call: /favorites pages give way to
+    # the other endpoints, and work outside of a request to both
+    if not has_request_context():
+        return 'background'
+    return 'favorites' if request.endpoint == 'main.favorites' else 'interactive'
+
+def store_current_weather(cache_key, status_code, data):
+    if status_code != 200 or data.get('cod') != 200:
         return {'error': 'Invalid location or no data available'}
-    
-    if current_user.is_authenticated:
-        city_name = data['name']
-        country = data['sys']['country']
-        temperature = data['main']['temp']
-        description = data['weather'][0]['description']
-        date = datetime.utcnow()
-        WeatherHistory.add(current_user.id, city_name, country, temperature, description, date)
-    
+    current_app.extensions['weather_cache'].set(cache_key, data)
+    if cache_key[0] == 'coord':
+        current_app.extensions['geo_index'].add(cache_key, *cell_center(cache_key))
     return data
 
+def record_weather_history(user_id, data):
+    city_name = data['name']
+    country = data['sys']['country']
+    temperature = data['main']['temp']
+    description = data['weather'][0]['description']
+    date = datetime.utcnow()
+    WeatherHistory.add(user_id, city_name, country, temperature, description, date)
+
+def get_favorites_weather(favorites):
+    # Upstream calls for all favorites run concurrently on the shared pool,
+    # each entry degrades on its own when it fails or misses the deadline
+    executor = current_app.extensions['upstream_executor']
+    deadline = time.monotonic() + current_app.config['FAVORITES_DEADLINE']
+
+    jobs = []
+    for favorite in favorites:
+        location = f"{favorite['city']},{favorite['country']}"
+        weather_future = executor.submit(copy_current_request_context(get_weather_data), location)
+        history_future = executor.submit(copy_current_request_context(get_weather_history), location)
+        jobs.append((favorite, weather_future, history_future))
+
+    favorite_weather = []
+    for favorite, weather_future, history_future in jobs:
+        favorite_weather.append({
+            'city': favorite['city'],
+            'country': favorite['country'],
+            'weather': wait_for_result(weather_future, deadline, WEATHER_UNAVAILABLE),
+            'history': wait_for_result(history_future, deadline, HISTORY_UNAVAILABLE)
+        })
+    return favorite_weather
+
+def mark_favorites_viewed(favorites):
+    # Recently viewed locations are refreshed first
+    refresher = current_app.extensions.get('favorites_refresher')
+    if refresher is not None:
+        refresher.mark_viewed(favorites)
+
+def wait_for_result(future, deadline, placeholder):
+    try:
+        return future.result(timeout=max(0, deadline - time.monotonic()))
+    except Exception:
+        future.cancel()
+        return placeholder
+
 def get_weather_history(location):
-    api_key = current_app.config['WEATHER_API_KEY']
-    history_url = current_app.config['WEATHER_HISTORY_URL']
-    
-    # Get current time and ensure we are getting data for the same hour each day
-    end_time = datetime.utcnow()
-    
     # Get coordinates for the location
-    geocode_url = "http://api.openweathermap.org/geo/1.0/direct"
-    geocode_params = {'q': location, 'appid': api_key}
-    geocode_response = requests.get(geocode_url, params=geocode_params)
-    geocode_data = geocode_response.json()
-    
+    geocode_data = geocode_location(location)
+    error = history_location_error(geocode_data)
+    if error:
+        return error
+
+    lat = geocode_data[0]['lat']
+    lon = geocode_data[0]['lon']
+    keys, records, missing = cached_history(lat, lon)
+    if missing:
+        url, params = history_range_request(lat, lon, [target for _, target in missing])
+        try:
+            response = current_app.extensions['weather_client'].get(url, params=params, call='history',
+                                                                     priority=upstream_priority())
+            hourly = response.json().get('list', []) if response.status_code == 200 else []
+        except (requests.RequestException, ValueError):
+            hourly = []
+        store_history(records, missing, hourly)
+
+    return history_result(keys, records)
+
+def history_location_error(geocode_data):
     if not geocode_data:
         return [{'dt': None, 'temp': None, 'weather': [{'description': 'No data available'}]}]
-
-    lat = geocode_data[0].get('lat')
-    lon = geocode_data[0].get('lon')
-    
-    if lat is None or lon is None:
+    if geocode_data[0].get('lat') is None or geocode_data[0].get('lon') is None:
         return [{'dt': None, 'temp': None, 'weather': [{'description': 'Invalid location'}]}]
+    return None
 
-    history_data = []
-    for days_ago in range(1, 6):
-        dt = end_time - timedelta(days=days_ago)
-        timestamp = int(dt.timestamp())
-        
-        history_params = {
-            'lat': lat,
-            'lon': lon,
-            'type': 'hour',
-            'start': timestamp,
-            'cnt': 1,
-            'appid': api_key,
-            'units': 'metric'
-        }
-        
-        request_url = requests.Request('GET', history_url, params=history_params).prepare().url
-        
-        response = requests.get(request_url)
-        
-        print(f"API Response: {response.status_code}")
-        if response.status_code == 200:
-            data = response.json()
-            if 'list' in data:
-                history_data.extend(data['list'])
-    
-    if not history_data:
-        return [{'dt': None, 'temp': None, 'weather': [{'description': 'No historical data available'}]}]
+def cached_history(lat, lon):
+    cache = current_app.extensions['history_cache']
+
+    # Get current time and ensure we are getting data for the same hour each day
+    end_time = int(time.time())
 
+    # Past UTC days never change, so each day is cached until it is too old to
+    # be requested again and only the days not cached yet are fetched, in a
+    # single ranged request
+    targets = [end_time - days_ago * 86400 for days_ago in range(1, 6)]
+    keys = [f'{lat:.2f},{lon:.2f},{target // 86400}' for target in targets]
+    records = {key: cache.get(key) for key in keys}
+    missing = [(key, target) for key, target in zip(keys, targets) if records[key] is None]
+    return keys, records, missing
+
+def history_range_request(lat, lon, targets):
+    history_params = {
+        'lat': lat,
+        'lon': lon,
+        'type': 'hour',
+        'start': min(targets),
+        'end': max(targets) + 3600,
+        'appid': current_app.config['WEATHER_API_KEY'],
+        'units': 'metric'
+    }
+    return current_app.config['WEATHER_HISTORY_URL'], history_params
+
+def store_history(records, missing, hourly):
+    cache = current_app.extensions['history_cache']
+    retention = current_app.config['HISTORY_CACHE_RETENTION']
+    # Pick the hourly record closest to each requested time
+    for key, target in missing:
+        nearest = min(hourly, key=lambda record: abs(record['dt'] - target), default=None)
+        if nearest is not None and abs(nearest['dt'] - target) <= 3600:
+            cache.set(key, nearest, ttl=retention)
+            records[key] = nearest
+
+def history_result(keys, records):
+    history_data = [records[key] for key in keys if records[key] is not None]
+    if not history_data:
+        return list(HISTORY_UNAVAILABLE)
     return history_data
+
+def geocode_location(location):
+    geocode_data = cached_geocode(location)
+    if geocode_data is not None:
+        return geocode_data
+
+    url, params = geocode_request(location)
+    try:
+        geocode_response = current_app.extensions['weather_client'].get(url, params=params, call='geocode',
+                                                                         priority=upstream_priority())
+        geocode_data = geocode_response.json()
+    except (requests.RequestException, ValueError):
+        return []
+    return store_geocode(location, geocode_response.status_code, geocode_data)
+
+def cached_geocode(location):
+    return current_app.extensions['geocode_cache'].get(normalize_location(location))
+
+def geocode_request(location):
+    geocode_params = {'q': location, 'appid': current_app.config['WEATHER_API_KEY']}
+    return current_app.config['WEATHER_GEOCODE_URL'], geocode_params
+
+def store_geocode(location, status_code, geocode_data):
+    if status_code != 200 or not isinstance(geocode_data, list):
+        return []
+
+    cache = current_app.extensions['geocode_cache']
+    cache_key = normalize_location(location)
+    if geocode_data:
+        geocode_data = [{'lat': geocode_data[0].get('lat'), 'lon': geocode_data[0].get('lon')}]
+    if geocode_data and geocode_data[0]['lat'] is not None and geocode_data[0]['lon'] is not None:
+        # Coordinates of a place don't change, only the first match is kept
+        cache.set(cache_key, geocode_data)
+    else:
+        cache.set(cache_key, geocode_data, ttl=current_app.config['GEOCODE_NEGATIVE_TTL'])
+    return geocode_data
+
+def warm_geocode_cache(app):
+    # Resolve all favorited locations in the background so the first
+    # /favorites views skip the geocoding round trip. Coordinates already in
+    # the location registry go straight into the cache.
+    def warm(city, country):
+        with app.app_context():
+            geocode_data = geocode_location(f"{city},{country}")
+            if not history_location_error(geocode_data):
+                FavoriteLocation.set_coordinates(city, country, geocode_data[0]['lat'], geocode_data[0]['lon'])
+
+    with app.app_context():
+        for location in FavoriteLocation.get_registry():
+            if location['lat'] is not None and location['lon'] is not None:
+                app.extensions['geocode_cache'].set(normalize_location(f"{location['city']},{location['country']}"),
+                                                    [{'lat': location['lat'], 'lon': location['lon']}])
+            else:
+                app.extensions['upstream_executor'].submit(warm, location['city'], location['country'])
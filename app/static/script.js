@@ -1,22 +1,37 @@
+function formatAge(seconds) {
+    if (seconds < 60) {
+        return `${seconds} s`;
+    }
+    if (seconds < 3600) {
+        return `${Math.round(seconds / 60)} min`;
+    }
+    return `${Math.round(seconds / 3600)} h`;
+}
+
+function showWeather(data) {
+    if (data.error) {
+        document.getElementById('weather-result').innerText = data.error;
+        return;
+    }
+    // Stale data comes from the cache while upstream is refreshed or unavailable
+    const age = data.stale ? `<p class="stale">Data from ${formatAge(data.age)} ago</p>` : '';
+    document.getElementById('weather-result').innerHTML = `
+        <p>City: ${data.name}</p>
+        <p>Country: ${data.sys.country}</p>
+        <p>Temperature: ${data.main.temp} °C</p>
+        <p>Description: ${data.weather[0].description}</p>
+        ${age}
+    `;
+}
+
 document.addEventListener('DOMContentLoaded', function() {
     if (navigator.geolocation) {
         navigator.geolocation.getCurrentPosition(function(position) {
             const lat = position.coords.latitude;
             const lon = position.coords.longitude;
-            fetch(`/api/current_weather?lat=${lat}&lon=${lon}`)
+            fetch(`/api/current_weather?lat=${lat}&lon=${lon}&view=slim`)
                 .then(response => response.json())
-                .then(data => {
-                    if (data.error) {
-                        document.getElementById('weather-output').innerText = data.error;
-                    } else {
-                        document.getElementById('weather-output').innerHTML = `
-                            <p>City: ${data.name}</p>
-                            <p>Country: ${data.sys.country}</p>
-                            <p>Temperature: ${data.main.temp} °C</p>
-                            <p>Description: ${data.weather[0].description}</p>
-                        `;
-                    }
-                })
+                .then(showWeather)
                 .catch(error => console.error('Error:', error));
         }, function(error) {
             console.error('Geolocation error:', error);
@@ -28,20 +43,9 @@ document.addEventListener('DOMContentLoaded', function() {
 
 document.getElementById('weather-form').addEventListener('submit', function(event) {
     event.preventDefault();
-    const city = document.getElementById('city').value;
-    fetch(`/api/current_weather?location=${encodeURIComponent(city)}`)
+    const location = document.getElementById('location').value;
+    fetch(`/api/current_weather?location=${encodeURIComponent(location)}&view=slim`)
         .then(response => response.json())
-        .then(data => {
-            if (data.error) {
-                document.getElementById('weather-output').innerText = data.error;
-            } else {
-                document.getElementById('weather-output').innerHTML = `
-                    <p>City: ${data.name}</p>
-                    <p>Country: ${data.sys.country}</p>
-                    <p>Temperature: ${data.main.temp} °C</p>
-                    <p>Description: ${data.weather[0].description}</p>
-                `;
-            }
-        })
+        .then(showWeather)
         .catch(error => console.error('Error:', error));
 });
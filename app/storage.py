@@ -0,0 +1,695 @@
+import json
+import os
+from bisect import bisect_left
+from collections import Counter
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows, only the in-process locks apply
+    fcntl = None
+
+
+@contextmanager
+def file_lock(file_path, shared=False):
+    # Advisory lock on a sidecar file so worker processes don't interleave
+    # their read-modify-write cycles
+    with open(file_path + '.lock', 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+
+def atomic_write(file_path, write):
+    # Write to a temporary file and swap it in, readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or '.',
+                                    prefix=os.path.basename(file_path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as file:
+            write(file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+# Initialize JSON files if they don't exist or are empty
+def initialize_json_file(file_path):
+    with file_lock(file_path):
+        if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
+            write_json_file(file_path, {})
+
+def read_json_file(file_path):
+    # A decode error means a corrupted file, it must not be treated as empty
+    # or the next write would wipe the data
+    if os.path.exists(file_path):
+        with open(file_path, 'r') as file:
+            return json.load(file)
+    return {}
+
+def write_json_file(file_path, data):
+    atomic_write(file_path, lambda file: json.dump(data, file, indent=4))
+
+
+def file_version(file_path):
+    # Rewrites go through os.replace and give the file a new inode, mtime and
+    # size catch appends. Takes a path or the descriptor of an open file.
+    stat = os.stat(file_path)
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+class JsonStorage:
+    def __init__(self, data_dir, compact_threshold=1000):
+        if not os.path.exists(data_dir):
+            os.makedirs(data_dir)
+        self.users_file = os.path.join(data_dir, 'users.json')
+        self.favorites_file = os.path.join(data_dir, 'favorites.json')
+        # Coordinates of favorited locations, {country: {city: {'lat': ..., 'lon': ...}}}
+        self.locations_file = os.path.join(data_dir, 'locations.json')
+        self.history_file = os.path.join(data_dir, 'history.json')
+        # New history records are appended here and compacted into history_file
+        self.history_log = os.path.join(data_dir, 'history.jsonl')
+        self.compact_threshold = compact_threshold
+        self._history_lock = threading.Lock()
+        # Per-user history in time order with a parallel list of dates to
+        # bisect on, rebuilt when another process changed the files
+        self._history = {}
+        self._history_dates = {}
+        self._history_version = None
+        # In-memory copy of users.json with an email index, reloaded when the file changes
+        self._users_lock = threading.Lock()
+        self._users = {}
+        self._email_index = {}
+        self._users_version = None
+        # favorites.json indexed in memory: each user's locations as an ordered
+        # set (a dict without values) and the registry of followed locations
+        self._favorites_lock = threading.Lock()
+        self._favorites = {}
+        self._locations = {}
+        self._favorites_version = None
+        # Open handles of the JSON files whose content is cached, see _pin
+        self._pinned = {}
+        initialize_json_file(self.users_file)
+        initialize_json_file(self.favorites_file)
+        initialize_json_file(self.locations_file)
+        initialize_json_file(self.history_file)
+        self._log_records = sum(1 for _ in self._read_history_log())
+
+    def get_user(self, user_id):
+        with self._users_lock:
+            return self._load_users().get(str(user_id))
+
+    def get_user_by_email(self, email):
+        with self._users_lock:
+            users = self._load_users()
+            user_id = self._email_index.get(email)
+            if user_id is None:
+                return None
+            return user_id, users[user_id]
+
+    def create_user(self, username, email, password_hash):
+        with self._users_lock, file_lock(self.users_file):
+            users = self._load_users()
+            user_id = self._allocate_user_id(users)
+            users[str(user_id)] = {'username': username, 'email': email, 'password_hash': password_hash, 'is_subscribed': False}
+            self._email_index.setdefault(email, str(user_id))
+            self._write_users(users)
+        return user_id
+
+    def set_subscribed(self, user_id, is_subscribed):
+        with self._users_lock, file_lock(self.users_file):
+            users = self._load_users()
+            users[str(user_id)]['is_subscribed'] = is_subscribed
+            self._write_users(users)
+
+    def set_password_hash(self, user_id, password_hash):
+        with self._users_lock, file_lock(self.users_file):
+            users = self._load_users()
+            users[str(user_id)]['password_hash'] = password_hash
+            self._write_users(users)
+
+    def _allocate_user_id(self, users):
+        # Ids only ever grow, the last one handed out is kept next to users.json
+        sequence_file = self.users_file + '.seq'
+        last_id = max([int(user_id) for user_id in users] + [0])
+        if os.path.exists(sequence_file):
+            with open(sequence_file, 'r') as file:
+                last_id = max(last_id, int(file.read().strip() or 0))
+        user_id = last_id + 1
+        atomic_write(sequence_file, lambda file: file.write(str(user_id)))
+        return user_id
+
+    def _pin(self, file_path):
+        # Opens the file and keeps it open while its content is cached. Its
+        # inode can't be freed and reused by a later rewrite then, so a
+        # rewrite by another worker always changes the version, even within
+        # one mtime tick and at the same size. Returns the version and the file.
+        file = open(file_path, 'r')
+        stale = self._pinned.get(file_path)
+        self._pinned[file_path] = file
+        if stale is not None:
+            stale.close()
+        return file_version(file.fileno()), file
+
+    def _load_users(self):
+        # Another worker may have written the file, so compare its version
+        if file_version(self.users_file) != self._users_version:
+            version, file = self._pin(self.users_file)
+            users = json.load(file)
+            email_index = {}
+            for user_id, user_data in users.items():
+                email_index.setdefault(user_data['email'], user_id)
+            self._users, self._email_index, self._users_version = users, email_index, version
+        return self._users
+
+    def _write_users(self, users):
+        write_json_file(self.users_file, users)
+        self._users_version = self._pin(self.users_file)[0]
+
+    def get_favorites(self, user_id):
+        with self._favorites_lock:
+            user_favorites = self._load_favorites().get(str(user_id), {})
+            return [{'city': city, 'country': country} for city, country in user_favorites]
+
+    def has_favorite(self, user_id, city, country):
+        with self._favorites_lock:
+            return (city, country) in self._load_favorites().get(str(user_id), {})
+
+    def get_favorite_locations(self):
+        with self._favorites_lock:
+            self._load_favorites()
+            return sorted(location for location, entry in self._locations.items() if entry['followers'] > 0)
+
+    def get_favorite_followers(self):
+        # (city, country) -> number of users following it
+        with self._favorites_lock:
+            self._load_favorites()
+            return {location: entry['followers'] for location, entry in self._locations.items()
+                    if entry['followers'] > 0}
+
+    def get_location_registry(self):
+        # One entry per followed location: city, country, lat, lon (None until
+        # known) and the number of followers
+        with self._favorites_lock:
+            self._load_favorites()
+            return [dict(self._locations[location]) for location in sorted(self._locations)
+                    if self._locations[location]['followers'] > 0]
+
+    def set_location_coordinates(self, city, country, lat, lon):
+        with self._favorites_lock, file_lock(self.favorites_file):
+            self._load_favorites()
+            entry = self._locations.get((city, country))
+            if entry is None or (entry['lat'], entry['lon']) == (lat, lon):
+                return
+            entry['lat'], entry['lon'] = lat, lon
+            coordinates = read_json_file(self.locations_file)
+            coordinates.setdefault(country, {})[city] = {'lat': lat, 'lon': lon}
+            write_json_file(self.locations_file, coordinates)
+            self._favorites_version = self._pin_favorites()[0]
+
+    def add_favorite(self, user_id, city, country):
+        # Returns False when the user already follows the location, nothing is written then
+        with self._favorites_lock, file_lock(self.favorites_file):
+            user_favorites = self._load_favorites().setdefault(str(user_id), {})
+            if (city, country) in user_favorites:
+                return False
+            user_favorites[(city, country)] = None
+            self._follow(city, country, 1)
+            self._write_favorites()
+        return True
+
+    def delete_favorite(self, user_id, city, country):
+        with self._favorites_lock, file_lock(self.favorites_file):
+            user_favorites = self._load_favorites().get(str(user_id), {})
+            if (city, country) not in user_favorites:
+                return False
+            del user_favorites[(city, country)]
+            self._follow(city, country, -1)
+            self._write_favorites()
+        return True
+
+    def _follow(self, city, country, change):
+        entry = self._locations.get((city, country))
+        if entry is None:
+            entry = self._locations[(city, country)] = {'city': city, 'country': country, 'lat': None, 'lon': None,
+                                                        'followers': 0}
+        # Like the SQLite locations table, an entry without followers is kept
+        # with its coordinates for when someone follows it again
+        entry['followers'] += change
+
+    def _pin_favorites(self):
+        favorites_version, favorites_file = self._pin(self.favorites_file)
+        locations_version, locations_file = self._pin(self.locations_file)
+        return favorites_version + locations_version, favorites_file, locations_file
+
+    def _load_favorites(self):
+        # Another worker may have written the files, so compare their versions
+        if file_version(self.favorites_file) + file_version(self.locations_file) != self._favorites_version:
+            version, favorites_file, locations_file = self._pin_favorites()
+            self._favorites, self._locations = {}, {}
+            for country, cities in json.load(locations_file).items():
+                for city, known in cities.items():
+                    self._locations[(city, country)] = {'city': city, 'country': country, 'lat': known['lat'],
+                                                        'lon': known['lon'], 'followers': 0}
+            for user_id, user_favorites in json.load(favorites_file).items():
+                # dict.fromkeys drops duplicates older versions could store
+                locations = dict.fromkeys((f['city'], f['country']) for f in user_favorites)
+                self._favorites[user_id] = locations
+                for city, country in locations:
+                    self._follow(city, country, 1)
+            self._favorites_version = version
+        return self._favorites
+
+    def _write_favorites(self):
+        favorites = {user_id: [{'city': city, 'country': country} for city, country in user_favorites]
+                     for user_id, user_favorites in self._favorites.items()}
+        write_json_file(self.favorites_file, favorites)
+        self._favorites_version = self._pin_favorites()[0]
+
+    def get_history(self, user_id, offset=0):
+        # offset skips the user's oldest records, history only ever grows
+        with self._history_lock, file_lock(self.history_file, shared=True):
+            return [dict(record) for record in self._load_history().get(str(user_id), [])[offset:]]
+
+    def get_history_page(self, user_id, cursor=None, limit=50, start=None, end=None):
+        # Newest first; cursor is the position in the user's history where
+        # the previous page stopped, start and end bound the date (end exclusive)
+        user_id = str(user_id)
+        with self._history_lock, file_lock(self.history_file, shared=True):
+            records = self._load_history().get(user_id, [])
+            dates = self._history_dates.get(user_id, [])
+            low = bisect_left(dates, start) if start else 0
+            high = bisect_left(dates, end) if end else len(dates)
+            if cursor is not None:
+                high = min(high, cursor)
+            first = max(low, high - limit)
+            page = [dict(record) for record in reversed(records[first:high])]
+        return page, (first if first > low else None)
+
+    def get_all_history(self):
+        with self._history_lock, file_lock(self.history_file, shared=True):
+            history = self._load_history()
+            return [(user_id, dict(record)) for user_id, records in history.items() for record in records]
+
+    def get_history_stats(self, user_id, top=10):
+        return history_stats(self.get_history(user_id), top)
+
+    def get_city_stats(self, city, country):
+        with self._history_lock, file_lock(self.history_file, shared=True):
+            temperatures = [record['temperature'] for records in self._load_history().values() for record in records
+                            if record['city'] == city and record['country'] == country]
+        return summarize_history(len(temperatures), [t for t in temperatures if t is not None])
+
+    def get_top_cities(self, limit=10):
+        with self._history_lock, file_lock(self.history_file, shared=True):
+            counts = Counter((record['city'], record['country'])
+                             for records in self._load_history().values() for record in records)
+        return top_cities(counts, limit)
+
+    def add_history(self, user_id, record):
+        self.add_history_batch([(user_id, record)])
+
+    def add_history_batch(self, records):
+        lines = ''.join(json.dumps(dict(record, user_id=str(user_id))) + '\n' for user_id, record in records)
+        with self._history_lock, file_lock(self.history_file):
+            history = self._load_history()
+            with open(self.history_log, 'a') as file:
+                file.write(lines)
+            for user_id, record in records:
+                history.setdefault(str(user_id), []).append(record)
+                self._history_dates.setdefault(str(user_id), []).append(record['date'])
+            self._log_records += len(records)
+            if self._log_records >= self.compact_threshold:
+                self._compact_history()
+            self._history_version = self._pin_history()[0]
+
+    def compact_history(self):
+        with self._history_lock, file_lock(self.history_file):
+            self._compact_history()
+            self._history_version = self._pin_history()[0]
+
+    def _compact_history(self):
+        history = read_json_file(self.history_file)
+        for user_id, record in self._read_history_log():
+            history.setdefault(user_id, []).append(record)
+        write_json_file(self.history_file, history)
+        open(self.history_log, 'w').close()
+        self._log_records = 0
+
+    def _history_log_version(self):
+        # The log is only appended to and truncated in place
+        return file_version(self.history_log) if os.path.exists(self.history_log) else None
+
+    def _pin_history(self):
+        snapshot_version, snapshot = self._pin(self.history_file)
+        return (snapshot_version, self._history_log_version()), snapshot
+
+    def _load_history(self):
+        if (file_version(self.history_file), self._history_log_version()) != self._history_version:
+            version, snapshot = self._pin_history()
+            history = json.load(snapshot)
+            for user_id, record in self._read_history_log():
+                history.setdefault(user_id, []).append(record)
+            self._history = history
+            self._history_dates = {user_id: [record['date'] for record in user_history]
+                                   for user_id, user_history in history.items()}
+            self._history_version = version
+        return self._history
+
+    def _read_history_log(self):
+        if not os.path.exists(self.history_log):
+            return
+        with open(self.history_log, 'r') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Skip a line left half-written by a crash
+                    continue
+                yield record.pop('user_id'), record
+
+
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL,
+    email TEXT NOT NULL,
+    password_hash TEXT NOT NULL,
+    is_subscribed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_users_email ON users (email);
+
+CREATE TABLE IF NOT EXISTS favorites (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    city TEXT NOT NULL,
+    country TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_favorites_user_id ON favorites (user_id);
+
+-- Registry of favorited locations shared by their followers
+CREATE TABLE IF NOT EXISTS locations (
+    city TEXT NOT NULL,
+    country TEXT NOT NULL,
+    lat REAL,
+    lon REAL,
+    followers INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (city, country)
+);
+
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    city TEXT NOT NULL,
+    country TEXT NOT NULL,
+    temperature REAL,
+    description TEXT,
+    date TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_history_user_id ON history (user_id, id);
+CREATE INDEX IF NOT EXISTS idx_history_user_date ON history (user_id, date);
+'''
+
+SCHEMA_VERSION = 2
+
+
+class SqliteStorage:
+    def __init__(self, db_path, migrate_from=None):
+        directory = os.path.dirname(db_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.db_path = db_path
+        self._local = threading.local()
+        self._initialize(migrate_from)
+
+    def _connection(self):
+        # sqlite3 connections must not be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _initialize(self, migrate_from):
+        conn = self._connection()
+        conn.executescript(SQLITE_SCHEMA)
+        # BEGIN IMMEDIATE serializes workers starting at the same time so the
+        # JSON import runs exactly once
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version == 0 and migrate_from:
+                migrate_json_to_sqlite(migrate_from, conn)
+            if version < 2:
+                migrate_favorites_registry(conn)
+            if version < SCHEMA_VERSION:
+                conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def get_user(self, user_id):
+        row = self._connection().execute(
+            'SELECT username, email, password_hash, is_subscribed FROM users WHERE id = ?',
+            (int(user_id),)).fetchone()
+        if row is None:
+            return None
+        return {'username': row['username'], 'email': row['email'],
+                'password_hash': row['password_hash'], 'is_subscribed': bool(row['is_subscribed'])}
+
+    def get_user_by_email(self, email):
+        row = self._connection().execute(
+            'SELECT id, username, email, password_hash, is_subscribed FROM users WHERE email = ? ORDER BY id LIMIT 1',
+            (email,)).fetchone()
+        if row is None:
+            return None
+        return row['id'], {'username': row['username'], 'email': row['email'],
+                           'password_hash': row['password_hash'], 'is_subscribed': bool(row['is_subscribed'])}
+
+    def create_user(self, username, email, password_hash):
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute(
+                'INSERT INTO users (username, email, password_hash, is_subscribed) VALUES (?, ?, ?, 0)',
+                (username, email, password_hash))
+        return cursor.lastrowid
+
+    def set_subscribed(self, user_id, is_subscribed):
+        conn = self._connection()
+        with conn:
+            conn.execute('UPDATE users SET is_subscribed = ? WHERE id = ?', (int(is_subscribed), int(user_id)))
+
+    def set_password_hash(self, user_id, password_hash):
+        conn = self._connection()
+        with conn:
+            conn.execute('UPDATE users SET password_hash = ? WHERE id = ?', (password_hash, int(user_id)))
+
+    def get_favorites(self, user_id):
+        rows = self._connection().execute(
+            'SELECT city, country FROM favorites WHERE user_id = ? ORDER BY id', (int(user_id),))
+        return [{'city': row['city'], 'country': row['country']} for row in rows]
+
+    def has_favorite(self, user_id, city, country):
+        row = self._connection().execute(
+            'SELECT 1 FROM favorites WHERE user_id = ? AND city = ? AND country = ?',
+            (int(user_id), city, country)).fetchone()
+        return row is not None
+
+    def get_favorite_locations(self):
+        rows = self._connection().execute(
+            'SELECT city, country FROM locations WHERE followers > 0 ORDER BY city, country')
+        return [(row['city'], row['country']) for row in rows]
+
+    def get_favorite_followers(self):
+        rows = self._connection().execute('SELECT city, country, followers FROM locations WHERE followers > 0')
+        return {(row['city'], row['country']): row['followers'] for row in rows}
+
+    def get_location_registry(self):
+        rows = self._connection().execute(
+            'SELECT city, country, lat, lon, followers FROM locations WHERE followers > 0 ORDER BY city, country')
+        return [dict(row) for row in rows]
+
+    def set_location_coordinates(self, city, country, lat, lon):
+        conn = self._connection()
+        with conn:
+            conn.execute('UPDATE locations SET lat = ?, lon = ? WHERE city = ? AND country = ?',
+                         (lat, lon, city, country))
+
+    def add_favorite(self, user_id, city, country):
+        # Returns False when the user already follows the location
+        conn = self._connection()
+        with conn:
+            added = conn.execute('INSERT OR IGNORE INTO favorites (user_id, city, country) VALUES (?, ?, ?)',
+                                 (int(user_id), city, country)).rowcount == 1
+            if added:
+                conn.execute('INSERT OR IGNORE INTO locations (city, country) VALUES (?, ?)', (city, country))
+                conn.execute('UPDATE locations SET followers = followers + 1 WHERE city = ? AND country = ?',
+                             (city, country))
+        return added
+
+    def delete_favorite(self, user_id, city, country):
+        # The location row keeps its coordinates when the last follower leaves
+        conn = self._connection()
+        with conn:
+            deleted = conn.execute('DELETE FROM favorites WHERE user_id = ? AND city = ? AND country = ?',
+                                   (int(user_id), city, country)).rowcount > 0
+            if deleted:
+                conn.execute('UPDATE locations SET followers = followers - 1 WHERE city = ? AND country = ?',
+                             (city, country))
+        return deleted
+
+    def get_history(self, user_id, offset=0):
+        rows = self._connection().execute(
+            'SELECT city, country, temperature, description, date FROM history WHERE user_id = ? ORDER BY id '
+            'LIMIT -1 OFFSET ?', (int(user_id), offset))
+        return [dict(row) for row in rows]
+
+    def get_history_page(self, user_id, cursor=None, limit=50, start=None, end=None):
+        # Newest first; cursor is the id of the last record of the previous page
+        query = 'SELECT id, city, country, temperature, description, date FROM history WHERE user_id = ?'
+        args = [int(user_id)]
+        if cursor is not None:
+            query += ' AND id < ?'
+            args.append(int(cursor))
+        if start:
+            query += ' AND date >= ?'
+            args.append(start)
+        if end:
+            query += ' AND date < ?'
+            args.append(end)
+        query += ' ORDER BY id DESC LIMIT ?'
+        args.append(limit + 1)
+        rows = self._connection().execute(query, args).fetchall()
+        next_cursor = rows[limit - 1]['id'] if len(rows) > limit else None
+        page = [{'city': row['city'], 'country': row['country'], 'temperature': row['temperature'],
+                 'description': row['description'], 'date': row['date']} for row in rows[:limit]]
+        return page, next_cursor
+
+    def get_all_history(self):
+        rows = self._connection().execute(
+            'SELECT user_id, city, country, temperature, description, date FROM history ORDER BY id')
+        for row in rows:
+            yield str(row['user_id']), {'city': row['city'], 'country': row['country'], 'temperature': row['temperature'],
+                                        'description': row['description'], 'date': row['date']}
+
+    def get_history_stats(self, user_id, top=10):
+        conn = self._connection()
+        row = conn.execute(f'SELECT {SQLITE_SUMMARY} FROM history WHERE user_id = ?', (int(user_id),)).fetchone()
+        stats = summary_row(row)
+        rows = conn.execute(
+            f'SELECT city, country, {SQLITE_SUMMARY} FROM history WHERE user_id = ? GROUP BY city, country '
+            'ORDER BY count DESC, city, country LIMIT ?', (int(user_id), top))
+        stats['cities'] = [dict(summary_row(row), city=row['city'], country=row['country']) for row in rows]
+        return stats
+
+    def get_city_stats(self, city, country):
+        row = self._connection().execute(f'SELECT {SQLITE_SUMMARY} FROM history WHERE city = ? AND country = ?',
+                                         (city, country)).fetchone()
+        return summary_row(row)
+
+    def get_top_cities(self, limit=10):
+        rows = self._connection().execute(
+            'SELECT city, country, COUNT(*) AS count FROM history GROUP BY city, country '
+            'ORDER BY count DESC, city, country LIMIT ?', (limit,))
+        return [{'city': row['city'], 'country': row['country'], 'count': row['count']} for row in rows]
+
+    def add_history(self, user_id, record):
+        self.add_history_batch([(user_id, record)])
+
+    def add_history_batch(self, records):
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                'INSERT INTO history (user_id, city, country, temperature, description, date) VALUES (?, ?, ?, ?, ?, ?)',
+                [(int(user_id), r['city'], r['country'], r['temperature'], r['description'], r['date'])
+                 for user_id, r in records])
+
+
+SQLITE_SUMMARY = ('COUNT(*) AS count, MIN(temperature) AS min_temperature, MAX(temperature) AS max_temperature, '
+                  'AVG(temperature) AS avg_temperature')
+
+
+def summary_row(row):
+    return {'count': row['count'], 'min_temperature': row['min_temperature'], 'max_temperature': row['max_temperature'],
+            'avg_temperature': None if row['avg_temperature'] is None else round(row['avg_temperature'], 2)}
+
+
+def summarize_history(count, temperatures):
+    # Aggregates of a set of history records, same shape for every backend
+    if not temperatures:
+        return {'count': count, 'min_temperature': None, 'max_temperature': None, 'avg_temperature': None}
+    return {'count': count, 'min_temperature': min(temperatures), 'max_temperature': max(temperatures),
+            'avg_temperature': round(sum(temperatures) / len(temperatures), 2)}
+
+
+def history_stats(records, top=10):
+    # Per user aggregates computed from the records themselves
+    by_city = {}
+    for record in records:
+        by_city.setdefault((record['city'], record['country']), []).append(record['temperature'])
+    stats = summarize_history(len(records), [r['temperature'] for r in records if r['temperature'] is not None])
+    stats['cities'] = []
+    for city in top_cities(Counter({location: len(temps) for location, temps in by_city.items()}), top):
+        temperatures = by_city[(city['city'], city['country'])]
+        city.update(summarize_history(len(temperatures), [t for t in temperatures if t is not None]))
+        stats['cities'].append(city)
+    return stats
+
+
+def top_cities(counts, limit):
+    ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+    return [{'city': city, 'country': country, 'count': count} for (city, country), count in ranked[:limit]]
+
+
+def migrate_json_to_sqlite(data_dir, conn):
+    # User ids are kept so favorites and history stay attached to their owners
+    users = read_json_file(os.path.join(data_dir, 'users.json'))
+    conn.executemany(
+        'INSERT INTO users (id, username, email, password_hash, is_subscribed) VALUES (?, ?, ?, ?, ?)',
+        [(int(user_id), u['username'], u['email'], u['password_hash'], int(u.get('is_subscribed', False)))
+         for user_id, u in users.items()])
+
+    favorites = read_json_file(os.path.join(data_dir, 'favorites.json'))
+    conn.executemany(
+        'INSERT INTO favorites (user_id, city, country) VALUES (?, ?, ?)',
+        [(int(user_id), f['city'], f['country'])
+         for user_id, user_favorites in favorites.items() for f in user_favorites])
+
+    coordinates = read_json_file(os.path.join(data_dir, 'locations.json'))
+    conn.executemany(
+        'INSERT INTO locations (city, country, lat, lon) VALUES (?, ?, ?, ?)',
+        [(city, country, c['lat'], c['lon']) for country, cities in coordinates.items() for city, c in cities.items()])
+
+    # Read through JsonStorage so records still in the history.jsonl log are imported too
+    conn.executemany(
+        'INSERT INTO history (user_id, city, country, temperature, description, date) VALUES (?, ?, ?, ?, ?, ?)',
+        [(int(user_id), r['city'], r['country'], r['temperature'], r['description'], r['date'])
+         for user_id, r in JsonStorage(data_dir).get_all_history()])
+
+
+def migrate_favorites_registry(conn):
+    # Schema version 2: a user follows a location at most once and the
+    # locations table counts the followers
+    conn.execute('DELETE FROM favorites WHERE id NOT IN (SELECT MIN(id) FROM favorites GROUP BY user_id, city, country)')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_favorites_user_location ON favorites (user_id, city, country)')
+    conn.execute('INSERT OR IGNORE INTO locations (city, country) SELECT DISTINCT city, country FROM favorites')
+    conn.execute('UPDATE locations SET followers = (SELECT COUNT(*) FROM favorites '
+                 'WHERE favorites.city = locations.city AND favorites.country = locations.country)')
+
+
+def create_storage(config):
+    backend = config.get('STORAGE_BACKEND', 'json')
+    data_dir = config.get('DATA_DIR', 'data')
+    if backend == 'sqlite':
+        return SqliteStorage(config['DATABASE_PATH'], migrate_from=data_dir)
+    if backend == 'json':
+        return JsonStorage(data_dir, compact_threshold=config.get('HISTORY_COMPACT_THRESHOLD', 1000))
+    raise ValueError(f'Unknown storage backend: {backend}')
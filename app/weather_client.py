@@ -0,0 +1,125 @@
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from app.rate_limit import TokenBucket
+
+
+class CircuitOpenError(requests.RequestException):
+    pass
+
+
+class RateLimitedError(requests.RequestException):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            # After the timeout a single trial call is let through (half-open)
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+
+class WeatherClient:
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, pool_size=32, connect_timeout=3.05, read_timeout=10, retries=2, backoff=0.2,
+                 failure_threshold=5, reset_timeout=30, metrics=None, limiter=None):
+        self.timeout = (connect_timeout, read_timeout)
+        self.metrics = metrics
+        self.limiter = limiter
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        # One keep-alive connection pool shared by all threads of the worker
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @classmethod
+    def from_config(cls, config, metrics=None):
+        limiter = None
+        if config['UPSTREAM_RATE_LIMIT'] > 0:
+            limiter = TokenBucket(config['UPSTREAM_RATE_LIMIT'], config['UPSTREAM_RATE_BURST'],
+                                  config['UPSTREAM_RATE_LIMIT_PATH'])
+        return cls(pool_size=config['UPSTREAM_POOL_SIZE'],
+                   connect_timeout=config['UPSTREAM_CONNECT_TIMEOUT'],
+                   read_timeout=config['UPSTREAM_READ_TIMEOUT'],
+                   retries=config['UPSTREAM_RETRIES'],
+                   backoff=config['UPSTREAM_BACKOFF'],
+                   failure_threshold=config['CIRCUIT_FAILURE_THRESHOLD'],
+                   reset_timeout=config['CIRCUIT_RESET_TIMEOUT'],
+                   metrics=metrics,
+                   limiter=limiter)
+
+    def get(self, url, params=None, call='other', priority='interactive'):
+        # call names the upstream API (weather, geocode, history) in the metrics,
+        # priority is the rate limiter class (interactive, favorites, background)
+        started = time.perf_counter()
+        if not self.breaker.allow():
+            self.observe(call, started, 'circuit_open')
+            raise CircuitOpenError(f'Circuit open, not calling {url}')
+
+        response, error = None, None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                # Exponential backoff with jitter so workers don't retry in lockstep
+                time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+            if not self.acquire(priority):
+                if attempt:
+                    # Retries count against the budget too, the last failure stands
+                    break
+                self.observe(call, started, 'rate_limited')
+                raise RateLimitedError(f'Rate limit reached, not calling {url}')
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                response, error = None, e
+                continue
+            if response.status_code not in self.RETRY_STATUSES:
+                self.breaker.record_success()
+                self.observe(call, started, str(response.status_code))
+                return response
+
+        self.breaker.record_failure()
+        if response is not None:
+            self.observe(call, started, str(response.status_code))
+            return response
+        self.observe(call, started, 'error')
+        raise error
+
+    def acquire(self, priority):
+        return self.limiter is None or self.limiter.try_acquire(priority)
+
+    def observe(self, call, started, outcome):
+        if self.metrics is not None:
+            self.metrics.observe_upstream(call, started, outcome)
@@ -0,0 +1,4 @@
+from app.asgi import create_asgi_app
+
+# Async entry point, run with: uvicorn asgi:app
+app = create_asgi_app()
@@ -0,0 +1,57 @@
+"""Compare the sync (WSGI) and async (ASGI) serving paths.
+
+Both run in a single process against the stub upstream with artificial
+latency. The sync server handles one request at a time like a sync
+gunicorn worker. Every request uses a distinct location, so each one pays
+the upstream latency.
+
+    python -m benchmarks.bench_async --latency 0.05 --requests 400 --concurrency 50
+"""
+import argparse
+import logging
+import sys
+import tempfile
+from contextlib import redirect_stdout
+
+from benchmarks.common import emit, run_load, run_metadata, serve_async, serve_sync, stub_config
+from tests.stub_server import StubUpstream
+
+
+def run(args):
+    stub = StubUpstream(latency=args.latency).start()
+    # Users and history written by the app stay out of the tracked data/ files
+    data_dir = tempfile.TemporaryDirectory()
+    config = stub_config(stub, DATA_DIR=data_dir.name)
+    results = {'meta': run_metadata(benchmark='async', latency_s=args.latency), 'scenarios': {}}
+    try:
+        for name, serve in (('sync', serve_sync), ('async', serve_async)):
+            base_url, stop = serve(config)
+            try:
+                results['scenarios'][name] = run_load(
+                    lambda session, i: session.get(f'{base_url}/api/current_weather?location={name}-city-{i}'),
+                    args.requests, args.concurrency)
+            finally:
+                stop()
+    finally:
+        stub.stop()
+        data_dir.cleanup()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--latency', type=float, default=0.05, help='stub upstream latency in seconds')
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    # Anything the app prints goes to stderr, stdout is kept for the results
+    with redirect_stdout(sys.stderr):
+        results = run(args)
+    emit(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""End-to-end throughput and latency of the main endpoints.
+
+The app runs on a temporary data directory against the stub upstream with
+configurable latency and error rate. Scenarios:
+
+- current_weather_hot: one location over and over, served from the cache
+- current_weather_slim: the same with ?view=slim, as the frontend asks
+- current_weather_cold: a new location on every request, each one goes upstream
+- favorites: a subscribed user with several favorites (weather and history per favorite)
+- history: the first /history page of a user with many records
+- login: posting valid credentials on a fresh session
+- login_attack: credential stuffing against one account, with every tenth
+  request a valid login of another user; the attack is spread over many
+  addresses, so only the per-email throttle applies
+
+    python -m benchmarks.bench_endpoints --server threaded --latency 0.02 --error-rate 0.01
+    python -m benchmarks.bench_endpoints --no-login-throttle --output unthrottled.json
+"""
+import argparse
+import logging
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+
+import requests
+
+from benchmarks.common import SERVERS, emit, run_load, run_metadata, stub_config
+from app import models
+from app.models import User
+from config import Config
+from tests.stub_server import StubUpstream
+
+PASSWORD = 'benchmark'
+FAVORITES = [('Prague', 'CZ'), ('Brno', 'CZ'), ('Vienna', 'AT'), ('Berlin', 'DE'), ('Paris', 'FR')]
+
+
+def seed_users(history_records):
+    # Runs after create_app(), so the models use the benchmark's storage
+    user = User.create('bench', 'bench@example.com', PASSWORD)
+    User.create('victim', 'victim@example.com', 'not-in-any-list')
+    models.storage.set_subscribed(user.id, True)
+    for city, country in FAVORITES:
+        models.storage.add_favorite(user.id, city, country)
+    first = datetime.now() - timedelta(minutes=10 * history_records)
+    records = [(user.id, {'city': 'Prague', 'country': 'CZ', 'temperature': 15.0, 'description': 'clear sky',
+                          'date': (first + timedelta(minutes=10 * i)).strftime('%Y-%m-%d %H:%M:%S')})
+               for i in range(history_records)]
+    for offset in range(0, len(records), 10000):
+        models.storage.add_history_batch(records[offset:offset + 10000])
+    return user
+
+
+def attack_login(i):
+    if i % 10 == 0:
+        return {'email': 'bench@example.com', 'password': PASSWORD}
+    return {'email': 'victim@example.com', 'password': f'guess{i}'}
+
+
+def logged_in_session(base_url):
+    def factory():
+        session = requests.Session()
+        session.post(f'{base_url}/auth/login', data={'email': 'bench@example.com', 'password': PASSWORD},
+                     allow_redirects=False)
+        return session
+    return factory
+
+
+def run(args):
+    stub = StubUpstream(latency=args.latency, error_rate=args.error_rate).start()
+    data_dir = tempfile.TemporaryDirectory()
+    config = stub_config(stub, DATA_DIR=data_dir.name, STORAGE_BACKEND=args.backend,
+                         DATABASE_PATH=f'{data_dir.name}/weather.db', HISTORY_WRITE_BEHIND=True,
+                         PASSWORD_HASH_METHOD=args.password_method, LOGIN_MAX_FAILURES_PER_IP=0,
+                         LOGIN_MAX_FAILURES_PER_EMAIL=0 if args.no_login_throttle else Config.LOGIN_MAX_FAILURES_PER_EMAIL)
+    base_url, stop = SERVERS[args.server](config)
+    seed_users(args.history_records)
+    session = logged_in_session(base_url)
+
+    scenarios = {
+        'current_weather_hot': dict(
+            send=lambda s, i: s.get(f'{base_url}/api/current_weather?location=Prague')),
+        'current_weather_slim': dict(
+            send=lambda s, i: s.get(f'{base_url}/api/current_weather?location=Prague&view=slim')),
+        'current_weather_cold': dict(
+            send=lambda s, i: s.get(f'{base_url}/api/current_weather?location=cold-{time.time_ns()}-{i}')),
+        'favorites': dict(
+            send=lambda s, i: s.get(f'{base_url}/favorites', allow_redirects=False), session_factory=session),
+        'history': dict(
+            send=lambda s, i: s.get(f'{base_url}/history', allow_redirects=False), session_factory=session),
+        'login': dict(
+            send=lambda s, i: requests.post(f'{base_url}/auth/login', allow_redirects=False,
+                                            data={'email': 'bench@example.com', 'password': PASSWORD}),
+            expect=302),
+        # A failed login redirects back to the form as well
+        'login_attack': dict(
+            send=lambda s, i: requests.post(f'{base_url}/auth/login', allow_redirects=False, data=attack_login(i)),
+            expect=(302, 429)),
+    }
+
+    results = {'meta': run_metadata(benchmark='endpoints', server=args.server, backend=args.backend,
+                                    latency_s=args.latency, error_rate=args.error_rate,
+                                    history_records=args.history_records, password_method=args.password_method,
+                                    login_throttle=not args.no_login_throttle),
+               'scenarios': {}}
+    try:
+        for name, scenario in scenarios.items():
+            results['scenarios'][name] = run_load(total=args.requests, concurrency=args.concurrency, **scenario)
+        results['upstream_calls'] = dict(stub.hits)
+    finally:
+        stop()
+        stub.stop()
+        data_dir.cleanup()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--server', choices=sorted(SERVERS), default='threaded')
+    parser.add_argument('--backend', choices=('json', 'sqlite'), default='sqlite')
+    parser.add_argument('--latency', type=float, default=0.02, help='stub upstream latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of stub calls answered with a 500')
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--history-records', type=int, default=10000)
+    parser.add_argument('--password-method', default=Config.PASSWORD_HASH_METHOD,
+                        help='PASSWORD_HASH_METHOD of the app and the seeded users')
+    parser.add_argument('--no-login-throttle', action='store_true', help='turn the failed login throttle off')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    # Anything the app prints goes to stderr, stdout is kept for the results
+    with redirect_stdout(sys.stderr):
+        results = run(args)
+    emit(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Cost of reading and rendering the history of a user with a long history.
+
+One user is seeded with --records history records and the app is driven
+in-process through the Flask test client, so only the app's own work is
+timed. Operations:
+
+- history_page: GET /history, the newest page rendered
+- history_page_older: GET /history with a cursor halfway through the history
+- history_page_by_date: GET /history limited to one day in the middle
+- get_by_user_id: WeatherHistory.get_by_user_id, the whole history decoded
+- get_by_user_id_after_add: a new record followed by get_by_user_id
+
+Only public routes and model methods are used, so the script also runs
+against older revisions for a before/after comparison:
+
+    python -m benchmarks.bench_history --records 50000 --output after.json
+    python -m benchmarks.compare before.json after.json
+"""
+import argparse
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+
+from benchmarks.bench_storage import time_operation
+from benchmarks.common import emit, run_metadata
+from app import create_app, models
+from app.models import User, WeatherHistory
+from config import TestConfig
+
+PASSWORD = 'benchmark'
+FIRST_DATE = datetime(2024, 1, 1)
+
+
+def seed_user(records):
+    user = User.create('bench', 'bench@example.com', PASSWORD)
+    batch = [(user.id, {'city': 'Prague', 'country': 'CZ', 'temperature': 15.0, 'description': 'clear sky',
+                        'date': (FIRST_DATE + timedelta(minutes=10 * i)).strftime('%Y-%m-%d %H:%M:%S')})
+             for i in range(records)]
+    for offset in range(0, len(batch), 10000):
+        models.storage.add_history_batch(batch[offset:offset + 10000])
+    return user
+
+
+def bench_backend(backend, records, repeat):
+    with tempfile.TemporaryDirectory() as directory:
+        config = type('BenchConfig', (TestConfig,), {
+            'DATA_DIR': directory, 'STORAGE_BACKEND': backend, 'DATABASE_PATH': f'{directory}/weather.db',
+            'HISTORY_WRITE_BEHIND': True})
+        app = create_app(config)
+        user = seed_user(records)
+        client = app.test_client()
+        client.post('/auth/login', data={'email': 'bench@example.com', 'password': PASSWORD})
+
+        _, cursor = WeatherHistory.get_page(user.id, limit=records // 2)
+        day = (FIRST_DATE + timedelta(minutes=5 * records)).strftime('%Y-%m-%d')
+
+        def add_and_read(i):
+            WeatherHistory.add(user.id, 'Brno', 'CZ', 12.0, 'rain', datetime.utcnow())
+            WeatherHistory.get_by_user_id(user.id)
+
+        operations = {
+            'history_page': lambda i: client.get('/history'),
+            'history_page_older': lambda i: client.get(f'/history?cursor={cursor}'),
+            'history_page_by_date': lambda i: client.get(f'/history?start={day}&end={day}'),
+            'get_by_user_id': lambda i: WeatherHistory.get_by_user_id(user.id),
+            'get_by_user_id_after_add': add_and_read,
+        }
+        results = {}
+        for name, operation in operations.items():
+            results[name] = time_operation(operation, repeat)
+        if models.history_writer is not None:
+            models.history_writer.stop()
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--records', type=int, default=50000, help='history records of the user')
+    parser.add_argument('--backends', default='json,sqlite')
+    parser.add_argument('--repeat', type=int, default=20, help='calls per operation')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+    backends = args.backends.split(',')
+
+    results = {'meta': run_metadata(benchmark='history', records=args.records, repeat=args.repeat),
+               'backends': {}}
+    # Anything the app prints goes to stderr, stdout is kept for the results
+    with redirect_stdout(sys.stderr):
+        for backend in backends:
+            results['backends'][backend] = bench_backend(backend, args.records, args.repeat)
+    emit(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
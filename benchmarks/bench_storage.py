@@ -0,0 +1,163 @@
+"""Micro-benchmarks of the storage operations behind app/models.py.
+
+Each backend is seeded in a temporary directory with the given number of
+history records, spread over one user per 100 records with three favorites
+each, then every operation is timed on its own.
+
+    python -m benchmarks.bench_storage --sizes 1000,100000,1000000 --backends json,sqlite,archive
+
+The archive backend is the JSON backend with history in the columnar
+history archive (app/history_archive.py).
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from benchmarks.common import emit, run_metadata, summarize
+from app.history_archive import archive_history
+from app.storage import JsonStorage, SqliteStorage, write_json_file
+
+RECORDS_PER_USER = 100
+CITIES = [('Prague', 'CZ'), ('Brno', 'CZ'), ('Vienna', 'AT'), ('Berlin', 'DE'), ('Paris', 'FR'),
+          ('London', 'GB'), ('Madrid', 'ES'), ('Rome', 'IT'), ('Warsaw', 'PL'), ('Oslo', 'NO')]
+FIRST_DATE = datetime(2024, 1, 1)
+
+
+def history_record(i):
+    city, country = CITIES[i % len(CITIES)]
+    return {
+        'city': city,
+        'country': country,
+        'temperature': round(10 + i % 20 * 0.5, 1),
+        'description': 'clear sky',
+        'date': (FIRST_DATE + timedelta(minutes=10 * i)).strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+
+def seed_records(size):
+    users = max(1, size // RECORDS_PER_USER)
+    # Records are handed out round-robin, so each user's history is in time order
+    return users, [(i % users + 1, history_record(i)) for i in range(size)]
+
+
+def seed_json(directory, size):
+    users, records = seed_records(size)
+    # Written straight to the files, going through create_user would rewrite
+    # users.json once per user
+    write_json_file(os.path.join(directory, 'users.json'), {
+        str(user_id): {'username': f'user{user_id}', 'email': f'user{user_id}@example.com',
+                       'password_hash': 'x', 'is_subscribed': True}
+        for user_id in range(1, users + 1)})
+    write_json_file(os.path.join(directory, 'favorites.json'), {
+        str(user_id): [{'city': city, 'country': country} for city, country in CITIES[:3]]
+        for user_id in range(1, users + 1)})
+    history = {}
+    for user_id, record in records:
+        history.setdefault(str(user_id), []).append(record)
+    write_json_file(os.path.join(directory, 'history.json'), history)
+    return users, lambda: JsonStorage(directory)
+
+
+def seed_sqlite(directory, size):
+    users, records = seed_records(size)
+    db_path = os.path.join(directory, 'weather.db')
+    storage = SqliteStorage(db_path)
+    for user_id in range(1, users + 1):
+        storage.create_user(f'user{user_id}', f'user{user_id}@example.com', 'x')
+        for city, country in CITIES[:3]:
+            storage.add_favorite(user_id, city, country)
+    for offset in range(0, len(records), 10000):
+        storage.add_history_batch(records[offset:offset + 10000])
+    return users, lambda: SqliteStorage(db_path)
+
+
+def seed_archive(directory, size):
+    # Imported from the JSON files by the first open, which is timed as part of seeding
+    users, open_json = seed_json(directory, size)
+    archive_dir = os.path.join(directory, 'archive')
+    archive_history(open_json(), archive_dir)
+    return users, lambda: archive_history(open_json(), archive_dir)
+
+
+SEEDERS = {'json': seed_json, 'sqlite': seed_sqlite, 'archive': seed_archive}
+
+
+def time_operation(operation, repeat):
+    latencies = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        operation(i)
+        latencies.append(time.perf_counter() - started)
+    result = {'calls': repeat}
+    result.update(summarize(latencies))
+    return result
+
+
+def bench_backend(backend, size, repeat, write_repeat):
+    with tempfile.TemporaryDirectory() as directory:
+        started = time.perf_counter()
+        users, open_storage = SEEDERS[backend](directory, size)
+        seed_s = time.perf_counter() - started
+
+        # First open plus first read pays for loading or indexing the data
+        started = time.perf_counter()
+        storage = open_storage()
+        storage.get_history_page(1)
+        cold_ms = (time.perf_counter() - started) * 1000
+
+        pick = random.Random(0)
+        random_user = lambda _: pick.randint(1, users)
+        middle = (FIRST_DATE + timedelta(minutes=5 * size)).strftime('%Y-%m-%d')
+        operations = {
+            'get_user': lambda i: storage.get_user(random_user(i)),
+            'get_user_by_email': lambda i: storage.get_user_by_email(f'user{random_user(i)}@example.com'),
+            'get_favorites': lambda i: storage.get_favorites(random_user(i)),
+            'get_favorite_locations': lambda i: storage.get_favorite_locations(),
+            'get_location_registry': lambda i: storage.get_location_registry(),
+            'has_favorite': lambda i: storage.has_favorite(random_user(i), *CITIES[i % 5]),
+            'get_history': lambda i: storage.get_history(random_user(i)),
+            'get_history_page': lambda i: storage.get_history_page(random_user(i)),
+            'get_history_page_by_date': lambda i: storage.get_history_page(random_user(i), start=middle),
+            'get_history_stats': lambda i: storage.get_history_stats(random_user(i)),
+            'get_city_stats': lambda i: storage.get_city_stats(*CITIES[i % len(CITIES)]),
+            'get_top_cities': lambda i: storage.get_top_cities(),
+        }
+        writes = {
+            'add_history': lambda i: storage.add_history(random_user(i), history_record(size + i)),
+            'add_favorite': lambda i: storage.add_favorite(random_user(i), 'Lisbon', 'PT'),
+            'create_user': lambda i: storage.create_user(f'new{i}', f'new{i}@example.com', 'x'),
+        }
+
+        results = {'users': users, 'seed_s': round(seed_s, 2), 'cold_read_ms': round(cold_ms, 2)}
+        for name, operation in operations.items():
+            results[name] = time_operation(operation, repeat)
+        for name, operation in writes.items():
+            results[name] = time_operation(operation, write_repeat)
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000,100000,1000000', help='comma separated history record counts')
+    parser.add_argument('--backends', default='json,sqlite,archive')
+    parser.add_argument('--repeat', type=int, default=200, help='calls per read operation')
+    parser.add_argument('--write-repeat', type=int, default=20, help='calls per write operation')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    backends = args.backends.split(',')
+    results = {'meta': run_metadata(benchmark='storage', repeat=args.repeat, write_repeat=args.write_repeat),
+               'backends': {}}
+    for backend in backends:
+        results['backends'][backend] = {
+            str(size): bench_backend(backend, size, args.repeat, args.write_repeat) for size in sizes}
+
+    emit(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""Helpers shared by the benchmark scripts.
+
+Every script prints one JSON document (or writes it to --output) with a
+``meta`` block describing the run, so two runs can be diffed with
+``python -m benchmarks.compare``.
+"""
+import json
+import platform
+import socket
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import requests
+import uvicorn
+from werkzeug.serving import make_server
+
+from app import create_app
+from app.asgi import create_asgi_app
+from config import TestConfig
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def summarize(latencies):
+    # Latencies in seconds, reported in milliseconds
+    return {
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def run_load(send, total, concurrency, expect=200, session_factory=requests.Session):
+    # send(session, i) issues the i-th request; each worker thread keeps its
+    # own session so keep-alive and login cookies persist. expect is the
+    # status of a successful request or a tuple of them.
+    expected = expect if isinstance(expect, tuple) else (expect,)
+    local = threading.local()
+
+    def one(i):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = session_factory()
+        started = time.perf_counter()
+        try:
+            status = send(session, i).status_code
+        except requests.RequestException:
+            status = None
+        return time.perf_counter() - started, status
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(total)))
+    elapsed = time.perf_counter() - started
+
+    result = {
+        'requests': total,
+        'concurrency': concurrency,
+        'errors': sum(1 for _, status in results if status not in expected),
+        'rps': round(total / elapsed, 1),
+    }
+    result.update(summarize([latency for latency, _ in results]))
+    return result
+
+
+def stub_config(stub, base=TestConfig, **overrides):
+    # Config class pointing every upstream URL at the stub server
+    settings = dict(stub.urls())
+    settings.update(overrides)
+    return type('BenchConfig', (base,), settings)
+
+
+def serve_sync(config, threaded=False):
+    # threaded=False handles one request at a time like a sync gunicorn worker
+    server = make_server('127.0.0.1', 0, create_app(config), threaded=threaded)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}', server.shutdown
+
+
+def serve_threaded(config):
+    return serve_sync(config, threaded=True)
+
+
+def serve_async(config):
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(create_asgi_app(config), host='127.0.0.1', port=port,
+                                           log_level='warning', lifespan='on'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+
+    def stop():
+        server.should_exit = True
+    return f'http://127.0.0.1:{port}', stop
+
+
+SERVERS = {'sync': serve_sync, 'threaded': serve_threaded, 'async': serve_async}
+
+
+def run_metadata(**settings):
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                  text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    meta = {
+        'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'revision': revision,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+    }
+    meta.update(settings)
+    return meta
+
+
+def emit(results, output=None):
+    text = json.dumps(results, indent=2)
+    if output:
+        with open(output, 'w') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
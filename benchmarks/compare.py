@@ -0,0 +1,60 @@
+"""Compare two result files written by the benchmark scripts.
+
+Prints every numeric value present in both runs with its relative change.
+With --threshold only changes at least that large (in percent) are listed.
+
+    python -m benchmarks.compare baseline.json current.json --threshold 10
+"""
+import argparse
+import json
+
+
+def flatten(results, prefix=''):
+    values = {}
+    for key, value in results.items():
+        path = f'{prefix}.{key}' if prefix else key
+        if isinstance(value, dict):
+            values.update(flatten(value, path))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[path] = value
+    return values
+
+
+def compare(baseline, current, threshold=0.0):
+    # The run settings in 'meta' are not measurements
+    baseline = flatten({key: value for key, value in baseline.items() if key != 'meta'})
+    current = flatten({key: value for key, value in current.items() if key != 'meta'})
+    rows = []
+    for path in sorted(baseline.keys() & current.keys()):
+        old, new = baseline[path], current[path]
+        change = (new - old) / old * 100 if old else None
+        if change is None or abs(change) >= threshold:
+            rows.append({'metric': path, 'baseline': old, 'current': new,
+                         'change_pct': None if change is None else round(change, 1)})
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=0.0, help='hide changes smaller than this many percent')
+    parser.add_argument('--json', action='store_true', help='print the rows as JSON')
+    args = parser.parse_args()
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.current) as file:
+        current = json.load(file)
+    rows = compare(baseline, current, args.threshold)
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    for row in rows:
+        change = 'n/a' if row['change_pct'] is None else f"{row['change_pct']:+.1f}%"
+        print(f"{row['metric']:<60} {row['baseline']:>12} {row['current']:>12} {change:>9}")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,107 @@ import os
 
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
+    # werkzeug generate_password_hash method, e.g. 'scrypt:16384:8:1' or
+    # 'pbkdf2:sha256:600000'; older hashes are replaced on the next login
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+    # Failed logins allowed per client address and per email within the
+    # window before /auth/login answers 429 (0 turns a limit off)
+    LOGIN_MAX_FAILURES_PER_IP = int(os.environ.get('LOGIN_MAX_FAILURES_PER_IP', 20))
+    LOGIN_MAX_FAILURES_PER_EMAIL = int(os.environ.get('LOGIN_MAX_FAILURES_PER_EMAIL', 5))
+    LOGIN_THROTTLE_WINDOW = int(os.environ.get('LOGIN_THROTTLE_WINDOW', 300))
+    # Proxies in front of the app trusted to append the client address to
+    # X-Forwarded-For. Azure App Service puts one front end before the app,
+    # without it every client would share the front end's address (and its
+    # per-address login limit). Set to 0 when the app is reached directly,
+    # otherwise clients can pick their own address.
+    PROXY_FIX_X_FOR = int(os.environ.get('PROXY_FIX_X_FOR', 1))
     WEATHER_API_KEY = os.environ.get('WEATHER_API_KEY')
     WEATHER_API_URL = 'http://api.openweathermap.org/data/2.5'
     WEATHER_HISTORY_URL = 'http://history.openweathermap.org/data/2.5/history/city'
+    WEATHER_GEOCODE_URL = 'http://api.openweathermap.org/geo/1.0/direct'
+    DATA_DIR = os.environ.get('DATA_DIR') or 'data'
+    # 'sqlite' imports the JSON files from DATA_DIR once, on first start
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND') or 'sqlite'
+    DATABASE_PATH = os.environ.get('DATABASE_PATH') or os.path.join(DATA_DIR, 'weather.db')
+    # History records are queued and written in batches by a background thread
+    HISTORY_WRITE_BEHIND = (os.environ.get('HISTORY_WRITE_BEHIND') or '1') == '1'
+    HISTORY_BATCH_SIZE = int(os.environ.get('HISTORY_BATCH_SIZE', 100))
+    HISTORY_FLUSH_INTERVAL = float(os.environ.get('HISTORY_FLUSH_INTERVAL', 1.0))
+    # Number of appended history records after which the JSON log is compacted
+    HISTORY_COMPACT_THRESHOLD = int(os.environ.get('HISTORY_COMPACT_THRESHOLD', 1000))
+    HISTORY_PAGE_SIZE = int(os.environ.get('HISTORY_PAGE_SIZE', 50))
+    # Directory of the columnar history archive, when set weather history is
+    # kept there instead of the storage backend (imported from it on first
+    # start); every HISTORY_SEGMENT_SIZE records become a memory-mapped segment
+    HISTORY_ARCHIVE_PATH = os.environ.get('HISTORY_ARCHIVE_PATH')
+    HISTORY_SEGMENT_SIZE = int(os.environ.get('HISTORY_SEGMENT_SIZE', 16384))
+    WEATHER_CACHE_TTL = int(os.environ.get('WEATHER_CACHE_TTL', 600))
+    WEATHER_CACHE_SIZE = int(os.environ.get('WEATHER_CACHE_SIZE', 1024))
+    # Seconds past expiry a lookup is still answered from the cache while it is
+    # refreshed in the background, and seconds past expiry the last good value
+    # is served when upstream fails or is over budget
+    WEATHER_STALE_WHILE_REVALIDATE = int(os.environ.get('WEATHER_STALE_WHILE_REVALIDATE', 300))
+    WEATHER_STALE_TTL = int(os.environ.get('WEATHER_STALE_TTL', 3600))
+    # Seconds between observations published by upstream, the Cache-Control max-age of
+    # /api/current_weather counts down to the next one
+    WEATHER_UPDATE_INTERVAL = int(os.environ.get('WEATHER_UPDATE_INTERVAL', 600))
+    # Coordinates are snapped to this grid (in degrees) before caching
+    WEATHER_CACHE_GRID = float(os.environ.get('WEATHER_CACHE_GRID', 0.01))
+    # A coordinate lookup whose grid cell is not cached is answered from the
+    # nearest cached coordinate lookup within this many km if it was fetched
+    # at most WEATHER_NEARBY_MAX_AGE seconds ago (0 km turns it off)
+    WEATHER_NEARBY_RADIUS_KM = float(os.environ.get('WEATHER_NEARBY_RADIUS_KM', 3))
+    WEATHER_NEARBY_MAX_AGE = int(os.environ.get('WEATHER_NEARBY_MAX_AGE', 600))
+    # Coordinates of looked up places, kept on disk across restarts
+    GEOCODE_CACHE_PATH = os.environ.get('GEOCODE_CACHE_PATH') or os.path.join(DATA_DIR, 'geocode.db')
+    # Seconds an unknown place is remembered before it is looked up again
+    GEOCODE_NEGATIVE_TTL = int(os.environ.get('GEOCODE_NEGATIVE_TTL', 86400))
+    GEOCODE_WARM_ON_STARTUP = True
+    # Hourly history records of past days, which never change
+    HISTORY_CACHE_PATH = os.environ.get('HISTORY_CACHE_PATH') or os.path.join(DATA_DIR, 'history_cache.db')
+    # Seconds a cached history day is kept, only the last five days are ever requested
+    HISTORY_CACHE_RETENTION = int(os.environ.get('HISTORY_CACHE_RETENTION', 7 * 86400))
+    UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', 32))
+    UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 3.05))
+    UPSTREAM_READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', 10))
+    # Retries on connection errors, 429 and 5xx, with jittered exponential backoff
+    UPSTREAM_RETRIES = int(os.environ.get('UPSTREAM_RETRIES', 2))
+    UPSTREAM_BACKOFF = float(os.environ.get('UPSTREAM_BACKOFF', 0.2))
+    # Consecutive failed calls after which upstream is skipped for CIRCUIT_RESET_TIMEOUT seconds
+    CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 5))
+    CIRCUIT_RESET_TIMEOUT = float(os.environ.get('CIRCUIT_RESET_TIMEOUT', 30))
+    # Upstream calls a second, in bursts of up to UPSTREAM_RATE_BURST, shared by
+    # all worker processes through the UPSTREAM_RATE_LIMIT_PATH file ('0' switches
+    # the limit off). The default matches the free OpenWeatherMap plan.
+    UPSTREAM_RATE_LIMIT = float(os.environ.get('UPSTREAM_RATE_LIMIT', 1.0))
+    UPSTREAM_RATE_BURST = int(os.environ.get('UPSTREAM_RATE_BURST', 60))
+    UPSTREAM_RATE_LIMIT_PATH = os.environ.get('UPSTREAM_RATE_LIMIT_PATH') or os.path.join(DATA_DIR, 'upstream_bucket')
+    # Connections the ASGI entry point (asgi.py) keeps open to the upstream API
+    ASYNC_UPSTREAM_POOL_SIZE = int(os.environ.get('ASYNC_UPSTREAM_POOL_SIZE', 100))
+    UPSTREAM_MAX_WORKERS = int(os.environ.get('UPSTREAM_MAX_WORKERS', 16))
+    # Seconds the /favorites page waits for upstream data before falling back
+    FAVORITES_DEADLINE = float(os.environ.get('FAVORITES_DEADLINE', 10))
+    # Refresh weather and history of all favorited locations in the background
+    # every FAVORITES_REFRESH_INTERVAL seconds, spending at most
+    # FAVORITES_REFRESH_BUDGET upstream calls per interval
+    FAVORITES_REFRESH_ENABLED = (os.environ.get('FAVORITES_REFRESH_ENABLED') or '1') == '1'
+    FAVORITES_REFRESH_INTERVAL = float(os.environ.get('FAVORITES_REFRESH_INTERVAL', 300))
+    FAVORITES_REFRESH_BUDGET = int(os.environ.get('FAVORITES_REFRESH_BUDGET', 120))
+    # Most locations accepted by /api/current_weather/batch and seconds it waits for upstream
+    WEATHER_BATCH_MAX_ITEMS = int(os.environ.get('WEATHER_BATCH_MAX_ITEMS', 100))
+    WEATHER_BATCH_DEADLINE = float(os.environ.get('WEATHER_BATCH_DEADLINE', 10))
+    # Latency histograms and counters served on /metrics, '0' switches them off
+    METRICS_ENABLED = (os.environ.get('METRICS_ENABLED') or '1') == '1'
 
 class TestConfig(Config):
     TESTING = True
     WEATHER_API_KEY = 'test_api_key'
+    STORAGE_BACKEND = 'json'
+    GEOCODE_CACHE_PATH = None
+    GEOCODE_WARM_ON_STARTUP = False
+    FAVORITES_REFRESH_ENABLED = False
+    HISTORY_CACHE_PATH = None
+    UPSTREAM_BACKOFF = 0
+    UPSTREAM_RATE_LIMIT = 0
+    UPSTREAM_RATE_LIMIT_PATH = None
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
@@ -0,0 +1,111 @@
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class StubUpstream:
+    # Local stand-in for the OpenWeatherMap weather, geocoding and history
+    # endpoints that counts the calls it gets. error_rate is the share of
+    # calls answered with a 500.
+    def __init__(self, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.hits = Counter()
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}'
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+            # The default backlog of 5 drops connections under load
+            request_queue_size = 1024
+
+        self._server = Server(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def handle(self, request):
+        url = urlparse(request.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        with self._lock:
+            self.hits[url.path] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        if self.error_rate and random.random() < self.error_rate:
+            status, body = 500, {'cod': 500, 'message': 'stub error'}
+        elif url.path == '/data/2.5/weather':
+            status, body = 200, self.weather(params)
+        elif url.path == '/geo/1.0/direct':
+            status, body = 200, self.geocode(params)
+        elif url.path == '/data/2.5/history/city':
+            status, body = 200, self.history(params)
+        else:
+            status, body = 404, {'cod': '404', 'message': 'not found'}
+
+        payload = json.dumps(body).encode()
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(payload)))
+        request.end_headers()
+        request.wfile.write(payload)
+
+    def weather(self, params):
+        name = params.get('q', 'Stubville').split(',')[0]
+        return {
+            'cod': 200,
+            'dt': int(time.time()) // 600 * 600,
+            'name': name,
+            'coord': {'lat': float(params.get('lat', 50.0)), 'lon': float(params.get('lon', 14.0))},
+            'sys': {'country': 'CZ'},
+            'main': {'temp': 15.0},
+            'weather': [{'description': 'clear sky'}]
+        }
+
+    def geocode(self, params):
+        name = params.get('q', '').split(',')[0]
+        if not name or name.lower().startswith('unknown'):
+            return []
+        # Stable made-up coordinates per place name
+        seed = sum(ord(char) for char in name)
+        return [{'name': name, 'lat': round(seed % 180 - 90 + 0.5, 4), 'lon': round(seed % 360 - 180 + 0.5, 4)}]
+
+    def history(self, params):
+        start = int(params['start']) // 3600 * 3600
+        end = int(params.get('end', start + 3600))
+        return {'cod': '200', 'list': [
+            {'dt': dt, 'main': {'temp': 10.0 + dt % 7}, 'weather': [{'description': 'cloudy'}]}
+            for dt in range(start, end + 1, 3600)
+        ]}
+
+    def urls(self):
+        # Config values pointing the app at this stub
+        return {
+            'WEATHER_API_URL': self.url + '/data/2.5',
+            'WEATHER_GEOCODE_URL': self.url + '/geo/1.0/direct',
+            'WEATHER_HISTORY_URL': self.url + '/data/2.5/history/city',
+        }
@@ -1,15 +1,35 @@
 import pytest
 from app import create_app
+from config import TestConfig
 from flask import g, session, current_app
 from datetime import datetime, timedelta
 import json
+import time
+import os
+import multiprocessing
 from unittest.mock import patch
 from app.models import User, FavoriteLocation, WeatherHistory
-from app.routes import get_weather_history, get_weather_data
+from app.routes import get_weather_history, get_weather_data, get_favorites_weather, warm_geocode_cache
+from app.cache import GeoIndex, TTLCache, PersistentCache, SingleFlight
+from app.storage import JsonStorage, SqliteStorage, read_json_file
+from app.history_archive import HistoryArchive, archive_history
+from app.history_writer import HistoryWriter
+from app.weather_client import WeatherClient, CircuitOpenError, RateLimitedError
+from app.rate_limit import LoginThrottle, TokenBucket
+import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import make_server
+from tests.stub_server import StubUpstream
+import asyncio
+import contextvars
+import httpx
+from app.asgi import AsyncSingleFlight, AsyncWeatherApp, create_asgi_app
+from app.refresher import FavoritesRefresher
 
 @pytest.fixture
 def client():
-    app = create_app()
+    app = create_app(TestConfig)
     app.config['TESTING'] = True
     app.config['WTF_CSRF_ENABLED'] = False
     app.config['SECRET_KEY'] = 'test'
@@ -199,7 +219,7 @@ def test_get_weather_history_success(client):
     }
     
     with client.application.app_context():
-        with patch('requests.get') as mock_get:
+        with patch('requests.Session.get') as mock_get:
             # Mock the geocode response
             mock_get.side_effect = [
                 MockResponse(geocode_response, 200),
@@ -221,7 +241,7 @@ def test_get_weather_history_no_geocode_data(client):
     location = 'Invalid Location'
     
     with client.application.app_context():
-        with patch('requests.get') as mock_get:
+        with patch('requests.Session.get') as mock_get:
             # Mock the geocode response with no data
             mock_get.side_effect = [
                 MockResponse([], 200)
@@ -237,7 +257,7 @@ def test_get_weather_history_invalid_location(client):
     geocode_response = [{'lat': None, 'lon': None}]
     
     with client.application.app_context():
-        with patch('requests.get') as mock_get:
+        with patch('requests.Session.get') as mock_get:
             # Mock the geocode response with invalid data
             mock_get.side_effect = [
                 MockResponse(geocode_response, 200)
@@ -254,7 +274,7 @@ def test_get_weather_history_no_history_data(client):
     history_response = {}
     
     with client.application.app_context():
-        with patch('requests.get') as mock_get:
+        with patch('requests.Session.get') as mock_get:
             # Mock the geocode and history responses
             mock_get.side_effect = [
                 MockResponse(geocode_response, 200),
@@ -284,7 +304,7 @@ def test_get_weather_data_invalid_location(client):
     weather_response = {'cod': '404', 'message': 'city not found'}
     
     with client.application.app_context():
-        with patch('requests.get') as mock_get:
+        with patch('requests.Session.get') as mock_get:
             mock_get.return_value = MockResponse(weather_response, 404)
             
             result = get_weather_data(location=location)
@@ -299,3 +319,1321 @@ class MockResponse:
 
     def json(self):
         return self.json_data
+
+# Tests for the current weather cache
+
+WEATHER_RESPONSE = {
+    'cod': 200,
+    'name': 'Prague',
+    'sys': {'country': 'CZ'},
+    'main': {'temp': 15.0},
+    'weather': [{'description': 'clear sky'}]
+}
+
+def test_get_weather_data_cache_hit(client):
+    with client.application.test_request_context(), patch('requests.Session.get') as mock_get:
+        mock_get.return_value = MockResponse(WEATHER_RESPONSE, 200)
+
+        first = get_weather_data(location='Prague')
+        second = get_weather_data(location='  prague ')
+
+        assert first == second
+        assert mock_get.call_count == 1
+
+    stats = client.application.extensions['weather_cache'].stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+
+def test_get_weather_data_errors_not_cached(client):
+    with client.application.test_request_context(), patch('requests.Session.get') as mock_get:
+        mock_get.return_value = MockResponse({'cod': '404', 'message': 'city not found'}, 404)
+
+        get_weather_data(location='Nowhere')
+        get_weather_data(location='Nowhere')
+
+        assert mock_get.call_count == 2
+
+def test_get_weather_data_nearby_coordinates_share_entry(client):
+    with client.application.test_request_context(), patch('requests.Session.get') as mock_get:
+        mock_get.return_value = MockResponse(WEATHER_RESPONSE, 200)
+
+        get_weather_data(lat='50.07551', lon='14.43781')
+        get_weather_data(lat='50.07612', lon='14.43702')
+
+        assert mock_get.call_count == 1
+        assert mock_get.call_args.kwargs['params']['lat'] == 50.08
+        assert mock_get.call_args.kwargs['params']['lon'] == 14.44
+
+def test_current_weather_rejects_non_finite_coordinates(client):
+    with patch('requests.Session.get') as mock_get:
+        for lat, lon in (('inf', '14.4'), ('50.1', '-inf'), ('1e400', '14.4'), ('nan', '14.4')):
+            rv = client.get(f'/api/current_weather?lat={lat}&lon={lon}')
+            assert rv.status_code == 200
+            assert rv.get_json() == {'error': 'Invalid location or no data available'}
+        rv = client.post('/api/current_weather/batch', json=[{'lat': 'inf', 'lon': 14.4}, {'lat': 1e400, 'lon': 0}])
+        assert rv.get_json()['results'] == [{'error': 'Invalid location or no data available'}] * 2
+    assert mock_get.call_count == 0
+
+def test_get_weather_data_served_from_nearby_cell(client):
+    client.application.config['WEATHER_NEARBY_MAX_AGE'] = 600
+    with client.application.test_request_context(), patch('requests.Session.get') as mock_get:
+        mock_get.return_value = MockResponse(WEATHER_RESPONSE, 200)
+
+        first = get_weather_data(lat='50.0755', lon='14.4378')
+        # About 1.5 km away, in another grid cell
+        assert get_weather_data(lat='50.0855', lon='14.4478') is first
+        assert mock_get.call_count == 1
+        # Out of the radius, or nothing cached recently enough
+        get_weather_data(lat='50.2', lon='14.4378')
+        client.application.config['WEATHER_NEARBY_MAX_AGE'] = -1
+        get_weather_data(lat='50.0655', lon='14.4278')
+        assert mock_get.call_count == 3
+
+    metrics = client.get('/metrics').get_data(as_text=True)
+    assert 'weather_app_weather_nearby_distance_km_count 1' in metrics
+
+def test_nearby_distance_measured_from_requested_point(client):
+    # Upstream's station is a little off the cell the first lookup was snapped to
+    observation = dict(WEATHER_RESPONSE, coord={'lat': 50.076, 'lon': 14.436})
+    with client.application.test_request_context(), patch('requests.Session.get') as mock_get:
+        mock_get.return_value = MockResponse(observation, 200)
+        get_weather_data(lat='50.0781', lon='14.4412')
+        assert get_weather_data(lat='50.087', lon='14.446')['coord'] == observation['coord']
+
+    # From the requested point to where the observation was taken, not
+    # between the centres of the two grid cells
+    metrics = client.get('/metrics').get_data(as_text=True)
+    observed = float(metrics.split('weather_app_weather_nearby_distance_km_sum ')[1].split()[0])
+    assert observed == pytest.approx(1.42, abs=0.01)
+
+def test_geo_index_nearest_first_and_bounded():
+    index = GeoIndex(cell_km=3, maxsize=3)
+    index.add('prague', 50.08, 14.44)
+    index.add('karlin', 50.09, 14.45)
+    index.add('brno', 49.2, 16.61)
+    assert [key for _, key in index.nearby(50.085, 14.447, 3)] == ['karlin', 'prague']
+    assert index.nearby(50.085, 14.447, 3)[0][0] == pytest.approx(0.6, abs=0.01)
+    # Found across the antimeridian
+    index.add('fiji', -17.0, 179.99)
+    assert [key for _, key in index.nearby(-17.0, -179.99, 3)] == ['fiji']
+    assert len(index) == 3 and index.nearby(50.08, 14.44, 0.1) == []
+    index.discard('fiji')
+    assert index.nearby(-17.0, 179.99, 3) == []
+
+def test_get_weather_data_invalid_coordinates(client):
+    result = get_weather_data(lat='north', lon='14.4')
+    assert result['error'] == 'Invalid location or no data available'
+
+def test_get_weather_data_records_history_on_cache_hit(client):
+    register(client, 'cacheuser', 'cache@example.com', 'testpassword')
+    login(client, 'cache@example.com', 'testpassword')
+    user = User.get_by_email('cache@example.com')
+    before = len(WeatherHistory.get_by_user_id(user.id))
+
+    with patch('requests.Session.get') as mock_get:
+        mock_get.return_value = MockResponse(WEATHER_RESPONSE, 200)
+
+        client.get('/api/current_weather?location=Prague')
+        client.get('/api/current_weather?location=Prague')
+
+        assert mock_get.call_count == 1
+
+    history = WeatherHistory.get_by_user_id(user.id)
+    assert len(history) == before + 2
+
+def test_ttl_cache_lru_eviction_and_expiry():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1
+
+    cache = TTLCache(maxsize=2, ttl=0)
+    cache.set('a', 1)
+    assert cache.get('a') is None
+
+def test_favorites_fan_out_keeps_order_and_degrades_slow_entries(client, monkeypatch):
+    client.application.config['FAVORITES_DEADLINE'] = 0.5
+
+    def mock_get_weather_data(location=None, lat=None, lon=None):
+        if location.startswith('Slowtown'):
+            time.sleep(2)
+        if location.startswith('Brokenville'):
+            raise RuntimeError('upstream failed')
+        return {"weather": [{"description": "clear sky"}], "main": {"temp": len(location)}, "name": location}
+
+    def mock_get_weather_history(location):
+        return [{"dt": datetime(2021, 1, 1, 12, 0).timestamp(), "main": {"temp": 10.0}, "weather": [{"description": "cloudy"}]}]
+
+    monkeypatch.setattr('app.routes.get_weather_data', mock_get_weather_data)
+    monkeypatch.setattr('app.routes.get_weather_history', mock_get_weather_history)
+
+    favorites = [
+        {'city': 'Prague', 'country': 'CZ'},
+        {'city': 'Slowtown', 'country': 'CZ'},
+        {'city': 'Brokenville', 'country': 'CZ'},
+        {'city': 'Liberec', 'country': 'CZ'},
+    ]
+    with client.application.test_request_context():
+        started = time.monotonic()
+        result = get_favorites_weather(favorites)
+        assert time.monotonic() - started < 1.5
+
+    assert [entry['city'] for entry in result] == ['Prague', 'Slowtown', 'Brokenville', 'Liberec']
+    assert result[0]['weather']['main']['temp'] == len('Prague,CZ')
+    assert result[1]['weather'] == {'error': 'Invalid location or no data available'}
+    assert result[2]['weather'] == {'error': 'Invalid location or no data available'}
+    assert result[3]['weather']['main']['temp'] == len('Liberec,CZ')
+    assert result[1]['history'][0]['weather'][0]['description'] == 'cloudy'
+
+# Tests for the SQLite storage backend
+
+def test_sqlite_storage_migrates_json_once(tmp_path):
+    data_dir = tmp_path / 'data'
+    data_dir.mkdir()
+    (data_dir / 'users.json').write_text(json.dumps({
+        '7': {'username': 'old', 'email': 'old@example.com', 'password_hash': 'hash', 'is_subscribed': True}
+    }))
+    (data_dir / 'favorites.json').write_text(json.dumps({'7': [{'city': 'Paris', 'country': 'France'}]}))
+    (data_dir / 'history.json').write_text(json.dumps({'7': [
+        {'city': 'Paris', 'country': 'FR', 'temperature': 12.5, 'description': 'rain', 'date': '2024-05-20 18:53:09'}
+    ]}))
+
+    db_path = str(tmp_path / 'weather.db')
+    storage = SqliteStorage(db_path, migrate_from=str(data_dir))
+    SqliteStorage(db_path, migrate_from=str(data_dir))
+
+    assert storage.get_user(7)['email'] == 'old@example.com'
+    assert storage.get_user_by_email('old@example.com')[0] == 7
+    assert storage.get_favorites(7) == [{'city': 'Paris', 'country': 'France'}]
+    assert len(storage.get_history('7')) == 1
+    assert storage.create_user('new', 'new@example.com', 'hash') == 8
+    assert storage._connection().execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+def test_sqlite_migration_imports_uncompacted_history_log(tmp_path):
+    data_dir = tmp_path / 'data'
+    JsonStorage(str(data_dir)).add_history_batch([('7', history_record('Liberec')), ('7', history_record('Brno'))])
+    assert (data_dir / 'history.jsonl').read_text()
+
+    storage = SqliteStorage(str(tmp_path / 'weather.db'), migrate_from=str(data_dir))
+    assert [r['city'] for r in storage.get_history(7)] == ['Liberec', 'Brno']
+
+def test_models_with_sqlite_storage(tmp_path, monkeypatch):
+    monkeypatch.setattr('app.models.storage', SqliteStorage(str(tmp_path / 'weather.db')))
+    monkeypatch.setattr('app.models.history_writer', None)
+
+    user = User.create('sqliteuser', 'sqlite@example.com', 'testpassword')
+    assert User.get_by_email('sqlite@example.com').id == user.id
+    user.subscribe()
+    assert User.get(str(user.id)).is_subscribed
+
+    FavoriteLocation.add(user.id, 'Paris', 'France')
+    FavoriteLocation.add(user.id, 'Berlin', 'Germany')
+    FavoriteLocation.delete(user.id, 'Paris', 'France')
+    assert FavoriteLocation.get_by_user_id(user.id) == [{'city': 'Berlin', 'country': 'Germany'}]
+
+    WeatherHistory.add(user.id, 'Berlin', 'Germany', 20.0, 'sunny', datetime(2024, 5, 20, 12, 0))
+    history = WeatherHistory.get_by_user_id(user.id)
+    assert history[0]['date'] == datetime(2024, 5, 20, 12, 0)
+    assert history[0]['temperature'] == 20.0
+
+def test_weather_history_records_parse_dates_lazily(tmp_path, monkeypatch):
+    storage = JsonStorage(str(tmp_path))
+    monkeypatch.setattr('app.models.storage', storage)
+    monkeypatch.setattr('app.models.history_writer', None)
+    WeatherHistory.add(1, 'Berlin', 'Germany', 20.0, 'sunny', datetime(2024, 5, 20, 12, 0))
+    storage.add_history(1, {'city': 'Brno', 'country': 'CZ', 'temperature': None,
+                            'description': 'rain', 'date': '2024-05-21 06:30:00'})
+
+    history = WeatherHistory.get_by_user_id(1)
+    assert history[0].timestamp == 1716206400 and history[0]._date is None
+    assert [record.city for record in history] == ['Berlin', 'Brno']
+    assert history[1]['date'] == datetime(2024, 5, 21, 6, 30)
+    assert storage.get_history(1, offset=1) == [{'city': 'Brno', 'country': 'CZ', 'temperature': None,
+                                                 'description': 'rain', 'date': '2024-05-21 06:30:00'}]
+
+# Tests for the write-behind history pipeline
+
+def history_record(city):
+    return {'city': city, 'country': 'CZ', 'temperature': 10.0, 'description': 'rain', 'date': '2024-05-20 18:53:09'}
+
+def test_json_history_log_appends_and_compacts(tmp_path):
+    storage = JsonStorage(str(tmp_path), compact_threshold=3)
+    storage.add_history_batch([('1', history_record('Liberec')), ('2', history_record('Prague'))])
+
+    assert json.loads((tmp_path / 'history.json').read_text()) == {}
+    assert len((tmp_path / 'history.jsonl').read_text().splitlines()) == 2
+    assert [r['city'] for r in storage.get_history(1)] == ['Liberec']
+
+    storage.add_history(1, history_record('Brno'))
+
+    assert (tmp_path / 'history.jsonl').read_text() == ''
+    assert [r['city'] for r in storage.get_history(1)] == ['Liberec', 'Brno']
+    assert [r['city'] for r in JsonStorage(str(tmp_path)).get_history(2)] == ['Prague']
+
+def test_history_writer_merges_pending_and_drains_on_stop(tmp_path):
+    storage = JsonStorage(str(tmp_path))
+    writer = HistoryWriter(storage, batch_size=1000, flush_interval=60).start()
+
+    writer.enqueue(1, history_record('Liberec'))
+    writer.enqueue(1, history_record('Prague'))
+    writer.enqueue(2, history_record('Brno'))
+
+    assert storage.get_history(1) == []
+    assert [r['city'] for r in writer.read(1, lambda queued: storage.get_history(1) + queued)] == ['Liberec', 'Prague']
+
+    writer.stop()
+
+    assert [r['city'] for r in storage.get_history(1)] == ['Liberec', 'Prague']
+    assert [r['city'] for r in storage.get_history(2)] == ['Brno']
+
+def test_history_writer_reads_concurrently_and_retries_on_flush(tmp_path):
+    storage = JsonStorage(str(tmp_path))
+    writer = HistoryWriter(storage, batch_size=1000, flush_interval=60)
+    writer.enqueue(1, history_record('Liberec'))
+
+    # Reads don't wait for each other
+    def slow_read(queued):
+        time.sleep(0.2)
+        return queued
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(lambda _: writer.read(1, slow_read), range(4)))
+    assert time.monotonic() - started < 0.5
+    assert all([r['city'] for r in result] == ['Liberec'] for result in results)
+
+    # A flush landing while storage is read makes the read start over
+    calls = []
+    def read(queued):
+        calls.append(len(queued))
+        if len(calls) == 1:
+            writer.flush()
+        return storage.get_history(1) + queued
+    assert [r['city'] for r in writer.read(1, read)] == ['Liberec']
+    assert calls == [1, 0]
+
+def test_history_writer_flushes_full_batches(tmp_path):
+    storage = JsonStorage(str(tmp_path))
+    writer = HistoryWriter(storage, batch_size=2, flush_interval=60).start()
+
+    writer.enqueue(1, history_record('Liberec'))
+    writer.enqueue(1, history_record('Prague'))
+
+    for _ in range(100):
+        if len(storage.get_history(1)) == 2:
+            break
+        time.sleep(0.01)
+    assert len(storage.get_history(1)) == 2
+    writer.stop()
+
+def test_history_writer_logs_and_counts_failed_flushes(tmp_path, caplog):
+    storage = JsonStorage(str(tmp_path))
+    writer = HistoryWriter(storage, batch_size=1, flush_interval=60)
+    writer.enqueue(1, history_record('Liberec'))
+
+    with patch.object(storage, 'add_history_batch', side_effect=OSError('disk full')):
+        writer.start()
+        for _ in range(100):
+            if writer.failures:
+                break
+            time.sleep(0.01)
+        assert writer.stats()['pending'] == 1
+
+    assert writer.failures >= 1
+    assert 'History flush failed, 1 records stay queued' in caplog.text
+    assert 'disk full' in caplog.text
+    # The queued record is written once the storage recovers
+    writer.stop()
+    assert [r['city'] for r in storage.get_history(1)] == ['Liberec']
+
+def test_json_storage_email_index(tmp_path):
+    storage = JsonStorage(str(tmp_path))
+    user_id = storage.create_user('indexed', 'indexed@example.com', 'hash')
+
+    assert storage.get_user_by_email('indexed@example.com') == (str(user_id), storage.get_user(user_id))
+    assert storage.get_user_by_email('missing@example.com') is None
+
+    storage.set_subscribed(user_id, True)
+    assert storage.get_user(user_id)['is_subscribed']
+
+def test_json_storage_reloads_users_changed_on_disk(tmp_path):
+    storage = JsonStorage(str(tmp_path))
+    storage.create_user('first', 'first@example.com', 'hash')
+    assert storage.get_user_by_email('other@example.com') is None
+
+    # Simulate a write from another worker process
+    other = JsonStorage(str(tmp_path))
+    other.create_user('other', 'other@example.com', 'hash')
+    os.utime(other.users_file, ns=(0, 1))
+
+    assert storage.get_user_by_email('other@example.com')[0] == '2'
+
+def test_json_storage_notices_same_size_rewrite_within_mtime_tick(tmp_path):
+    storage = JsonStorage(str(tmp_path))
+    storage.add_favorite(1, 'Brno', 'CZ')
+    assert storage.has_favorite(1, 'Brno', 'CZ')
+    before = os.stat(storage.favorites_file)
+
+    # Another worker swaps Brno for Oslo: same size, same mtime
+    other = JsonStorage(str(tmp_path))
+    other.delete_favorite(1, 'Brno', 'CZ')
+    other.add_favorite(1, 'Oslo', 'CZ')
+    os.utime(other.favorites_file, ns=(before.st_atime_ns, before.st_mtime_ns))
+    assert os.stat(other.favorites_file).st_size == before.st_size
+
+    assert storage.get_favorites(1) == [{'city': 'Oslo', 'country': 'CZ'}]
+
+# Multi-process stress test for the JSON storage
+
+def json_storage_worker(data_dir, worker, count):
+    storage = JsonStorage(data_dir, compact_threshold=7)
+    for i in range(count):
+        storage.create_user(f'user-{worker}-{i}', f'user-{worker}-{i}@example.com', 'hash')
+        storage.add_favorite(1, f'City {worker}-{i}', 'CZ')
+        storage.add_history(1, history_record(f'City {worker}-{i}'))
+
+def test_json_storage_concurrent_writers_lose_nothing(tmp_path):
+    workers, count = 6, 25
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=json_storage_worker, args=(str(tmp_path), worker, count))
+                 for worker in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+
+    storage = JsonStorage(str(tmp_path))
+    users = json.loads((tmp_path / 'users.json').read_text())
+    assert len(users) == workers * count
+    assert sorted(int(user_id) for user_id in users) == list(range(1, workers * count + 1))
+    assert len(storage.get_favorites(1)) == workers * count
+    history = storage.get_history(1)
+    assert len(history) == workers * count
+    assert len({record['city'] for record in history}) == workers * count
+
+def test_json_storage_allocates_monotonic_ids(tmp_path):
+    storage = JsonStorage(str(tmp_path))
+    storage.create_user('a', 'a@example.com', 'hash')
+    storage.create_user('b', 'b@example.com', 'hash')
+
+    # Removing the newest user must not hand its id out again
+    users = json.loads((tmp_path / 'users.json').read_text())
+    del users['2']
+    (tmp_path / 'users.json').write_text(json.dumps(users))
+
+    assert storage.create_user('c', 'c@example.com', 'hash') == 3
+
+def test_read_json_file_rejects_corrupted_file(tmp_path):
+    path = tmp_path / 'users.json'
+    path.write_text('{"1": {"username": ')
+    with pytest.raises(json.JSONDecodeError):
+        read_json_file(str(path))
+
+# Tests for the geocoding cache
+
+def test_get_weather_history_reuses_cached_coordinates(client):
+    history_response = {'list': [{'dt': 1, 'main': {'temp': 25}, 'weather': [{'description': 'Clear sky'}]}]}
+
+    with patch('requests.Session.get') as mock_get:
+        mock_get.side_effect = [MockResponse([{'lat': 10.0, 'lon': 20.0, 'name': 'Test'}], 200)] + \
+            [MockResponse(history_response, 200)] * 10
+
+        get_weather_history('Cached Town')
+        get_weather_history(' cached  town')
+
+        geocode_calls = [c for c in mock_get.call_args_list if c.args[0] == TestConfig.WEATHER_GEOCODE_URL]
+        assert len(geocode_calls) == 1
+
+def test_geocode_negative_cache(client):
+    client.application.config['GEOCODE_NEGATIVE_TTL'] = 0
+
+    with patch('requests.Session.get') as mock_get:
+        mock_get.return_value = MockResponse([], 200)
+
+        assert get_weather_history('Atlantis')[0]['weather'][0]['description'] == 'No data available'
+        assert get_weather_history('Atlantis')[0]['weather'][0]['description'] == 'No data available'
+        assert mock_get.call_count == 2
+
+    client.application.config['GEOCODE_NEGATIVE_TTL'] = 3600
+
+    with patch('requests.Session.get') as mock_get:
+        mock_get.return_value = MockResponse([], 200)
+
+        get_weather_history('El Dorado')
+        get_weather_history('El Dorado')
+        assert mock_get.call_count == 1
+
+def test_persistent_cache_survives_restart(tmp_path):
+    path = str(tmp_path / 'geocode.db')
+    cache = PersistentCache(path)
+    cache.set('liberec,cz', [{'lat': 50.77, 'lon': 15.06}])
+    cache.set('atlantis', [], ttl=3600)
+    cache.set('gone', [], ttl=-1)
+
+    restarted = PersistentCache(path)
+    assert restarted.get('liberec,cz') == [{'lat': 50.77, 'lon': 15.06}]
+    assert restarted.get('atlantis') == []
+    assert restarted.get('gone') is None
+    assert restarted.get('missing') is None
+
+def test_persistent_cache_purges_expired_rows(tmp_path):
+    path = str(tmp_path / 'geocode.db')
+    cache = PersistentCache(path, purge_interval=3600)
+    cache.set('gone', [], ttl=-1)
+    cache.set('also gone', [], ttl=-1)
+    cache.set('kept', [{'lat': 1.0, 'lon': 2.0}])
+    cache.set('negative', [], ttl=3600)
+
+    def keys():
+        return sorted(key for key, in cache._connection().execute('SELECT key FROM cache'))
+    # The first write purged, the next ones wait for the interval
+    assert keys() == ['also gone', 'kept', 'negative']
+    cache.purge_interval = 0
+    cache.set('another', [], ttl=3600)
+    assert keys() == ['another', 'kept', 'negative']
+
+def test_warm_geocode_cache_resolves_favorites(client, tmp_path, monkeypatch):
+    app = client.application
+    monkeypatch.setattr('app.models.storage', JsonStorage(str(tmp_path)))
+    FavoriteLocation.add(1, 'Liberec', 'CZ')
+    FavoriteLocation.add(2, 'Brno', 'CZ')
+    with patch('requests.Session.get') as mock_get:
+        mock_get.return_value = MockResponse([{'lat': 1.0, 'lon': 2.0}], 200)
+
+        warm_geocode_cache(app)
+        app.extensions['upstream_executor'].shutdown(wait=True)
+
+        assert mock_get.call_count == 2
+    assert app.extensions['geocode_cache'].get('liberec,cz') == [{'lat': 1.0, 'lon': 2.0}]
+    assert FavoriteLocation.get_registry()[0] == {'city': 'Brno', 'country': 'CZ', 'lat': 1.0, 'lon': 2.0,
+                                                  'followers': 1}
+
+    # After a restart the registry fills the cache without upstream calls
+    app.extensions['geocode_cache'].memory.clear()
+    with patch('requests.Session.get') as mock_get:
+        warm_geocode_cache(app)
+        assert mock_get.call_count == 0
+    assert app.extensions['geocode_cache'].get('brno,cz') == [{'lat': 1.0, 'lon': 2.0}]
+
+# Tests for the daily history cache
+
+def hourly_history(now, days):
+    return {'list': [
+        {'dt': now - days_ago * 86400 + 600, 'main': {'temp': days_ago}, 'weather': [{'description': 'cloudy'}]}
+        for days_ago in days
+    ]}
+
+def test_get_weather_history_single_ranged_request_then_cached(client):
+    now = int(time.time())
+    geocode_response = MockResponse([{'lat': 50.0, 'lon': 14.0}], 200)
+
+    with patch('requests.Session.get') as mock_get:
+        mock_get.side_effect = [geocode_response, MockResponse(hourly_history(now, range(1, 6)), 200)]
+
+        result = get_weather_history('Prague')
+
+        assert [record['main']['temp'] for record in result] == [1, 2, 3, 4, 5]
+        assert mock_get.call_count == 2
+        history_params = mock_get.call_args.kwargs['params']
+        assert history_params['type'] == 'hour'
+        assert history_params['end'] - history_params['start'] == 4 * 86400 + 3600
+
+    with patch('requests.Session.get') as mock_get:
+        assert get_weather_history('Prague') == result
+        assert mock_get.call_count == 0
+
+def test_get_weather_history_fetches_only_missing_days(client):
+    now = int(time.time())
+
+    with patch('requests.Session.get') as mock_get:
+        mock_get.side_effect = [MockResponse([{'lat': 50.0, 'lon': 14.0}], 200),
+                                MockResponse(hourly_history(now, [1, 2, 3]), 200)]
+        assert len(get_weather_history('Prague')) == 3
+
+    with patch('requests.Session.get') as mock_get:
+        mock_get.return_value = MockResponse(hourly_history(now, [4, 5]), 200)
+
+        result = get_weather_history('Prague')
+
+        assert [record['main']['temp'] for record in result] == [1, 2, 3, 4, 5]
+        assert mock_get.call_count == 1
+        history_params = mock_get.call_args.kwargs['params']
+        assert history_params['end'] - history_params['start'] == 86400 + 3600
+
+def test_current_weather_etag_and_conditional_get(client):
+    observation = dict(WEATHER_RESPONSE, id=3067696, dt=int(time.time()))
+    with patch('requests.Session.get') as mock_get:
+        mock_get.return_value = MockResponse(observation, 200)
+
+        rv = client.get('/api/current_weather?location=Prague')
+        assert rv.status_code == 200
+        assert rv.cache_control.public and 60 <= rv.cache_control.max_age <= 600
+        etag = rv.headers['ETag']
+        assert etag.startswith('W/')
+
+        rv = client.get('/api/current_weather?location=Prague', headers={'If-None-Match': etag})
+        assert rv.status_code == 304
+        assert rv.data == b''
+        assert rv.headers['ETag'] == etag
+
+        # A newer observation gets a new tag
+        mock_get.return_value = MockResponse(dict(observation, dt=observation['dt'] + 600), 200)
+        client.application.extensions['weather_cache'].clear()
+        rv = client.get('/api/current_weather?location=Prague', headers={'If-None-Match': etag})
+        assert rv.status_code == 200
+
+def test_current_weather_slim_view_reuses_encoded_body(client):
+    observation = dict(WEATHER_RESPONSE, id=3067696, dt=int(time.time()), coord={'lat': 50.09, 'lon': 14.42},
+                       wind={'speed': 3.1})
+    with patch('requests.Session.get') as mock_get:
+        mock_get.return_value = MockResponse(observation, 200)
+
+        slim = client.get('/api/current_weather?location=Prague&view=slim')
+        again = client.get('/api/current_weather?location=Prague&view=slim')
+        full = client.get('/api/current_weather?location=Prague')
+
+    assert slim.get_json() == {'name': 'Prague', 'sys': {'country': 'CZ'}, 'main': {'temp': 15.0},
+                               'weather': [{'description': 'clear sky'}], 'dt': observation['dt']}
+    assert again.data == slim.data
+    assert len(slim.data) < len(full.data)
+    assert full.get_json()['wind'] == {'speed': 3.1}
+    assert client.application.extensions['response_cache'].stats()['hits'] == 1
+    assert client.get('/api/current_weather?location=Prague&view=tiny').status_code == 400
+
+def test_static_urls_are_fingerprinted_and_cached_long(client):
+    rv = client.get('/')
+    assert rv.cache_control.no_cache and rv.headers['ETag']
+    assert client.get('/', headers={'If-None-Match': rv.headers['ETag']}).status_code == 304
+
+    url = next(line.split('"')[1] for line in rv.get_data(as_text=True).splitlines() if 'script.js' in line)
+    assert '?v=' in url
+    static = client.get(url)
+    assert static.cache_control.immutable and static.cache_control.max_age == 365 * 86400
+    static.close()
+
+    outdated = client.get('/static/script.js?v=0123456789ab')
+    assert not outdated.cache_control.immutable
+    outdated.close()
+
+# Tests for the upstream HTTP client
+
+def test_weather_client_retries_server_errors():
+    client = WeatherClient(retries=2, backoff=0, connect_timeout=1, read_timeout=2)
+    with patch('requests.Session.get') as mock_get:
+        mock_get.side_effect = [MockResponse({}, 503), MockResponse({}, 429), MockResponse({'cod': 200}, 200)]
+
+        response = client.get('http://upstream/weather', params={'q': 'Prague'})
+
+        assert response.status_code == 200
+        assert mock_get.call_count == 3
+        assert mock_get.call_args.kwargs['timeout'] == (1, 2)
+
+def test_weather_client_circuit_breaker_fails_fast():
+    client = WeatherClient(retries=0, backoff=0, failure_threshold=2, reset_timeout=60)
+    with patch('requests.Session.get') as mock_get:
+        mock_get.side_effect = requests.ConnectionError('down')
+
+        for _ in range(2):
+            with pytest.raises(requests.ConnectionError):
+                client.get('http://upstream/weather')
+        with pytest.raises(CircuitOpenError):
+            client.get('http://upstream/weather')
+
+        assert mock_get.call_count == 2
+
+    client.breaker.reset_timeout = 0
+    with patch('requests.Session.get') as mock_get:
+        mock_get.return_value = MockResponse({'cod': 200}, 200)
+        assert client.get('http://upstream/weather').status_code == 200
+        assert not client.breaker.is_open
+
+def test_token_bucket_drains_lower_priorities_first(tmp_path):
+    bucket = TokenBucket(rate=0, burst=4)
+    assert [bucket.try_acquire('background') for _ in range(3)] == [True, True, False]
+    assert [bucket.try_acquire('favorites') for _ in range(2)] == [True, False]
+    assert [bucket.try_acquire('interactive') for _ in range(2)] == [True, False]
+    assert bucket.stats()[('background', 'denied')] == 1
+
+    # Buckets on the same file share one budget, like worker processes do
+    path = str(tmp_path / 'bucket')
+    first, second = TokenBucket(rate=0, burst=2, path=path), TokenBucket(rate=0, burst=2, path=path)
+    assert first.try_acquire() and second.try_acquire()
+    assert not first.try_acquire()
+    assert first.tokens() == 0
+
+def test_weather_client_rate_limit_fails_fast():
+    client = WeatherClient(retries=2, backoff=0, limiter=TokenBucket(rate=0, burst=2))
+    with patch('requests.Session.get') as mock_get:
+        mock_get.return_value = MockResponse({}, 503)
+
+        # The retries draw from the same budget
+        assert client.get('http://upstream/weather').status_code == 503
+        with pytest.raises(RateLimitedError):
+            client.get('http://upstream/weather')
+
+        assert mock_get.call_count == 2
+
+def test_get_weather_data_over_rate_limit_serves_stale_entry(client):
+    app = client.application
+    app.extensions['weather_client'].limiter = TokenBucket(rate=0, burst=0)
+    # Expired past the revalidation window, so only stale-if-error applies
+    app.extensions['weather_cache'].set(('q', 'prague'), WEATHER_RESPONSE, ttl=-600)
+    with app.test_request_context(), patch('requests.Session.get') as mock_get:
+        result = get_weather_data(location='Prague')
+        assert result['stale'] is True and result['age'] >= 0
+        assert result['main'] == WEATHER_RESPONSE['main']
+        assert get_weather_data(location='Brno') == {'error': 'Weather service is unavailable'}
+        assert mock_get.call_count == 0
+
+def test_get_weather_data_serves_stale_while_revalidating(client):
+    app = client.application
+    cache = app.extensions['weather_cache']
+    cache.set(('q', 'prague'), WEATHER_RESPONSE, ttl=0)
+    updated = dict(WEATHER_RESPONSE, main={'temp': 18.0})
+    with app.test_request_context(), patch('requests.Session.get') as mock_get:
+        mock_get.return_value = MockResponse(updated, 200)
+
+        result = get_weather_data(location='Prague')
+        assert result['stale'] is True
+        assert result['main']['temp'] == 15.0
+
+        # The refresh runs on the upstream executor
+        deadline = time.monotonic() + 5
+        while cache.get(('q', 'prague'), count=False) is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert get_weather_data(location='Prague') == updated
+        assert mock_get.call_count == 1
+
+def test_get_weather_data_upstream_errors_serve_last_good_value(client):
+    app = client.application
+    app.extensions['weather_cache'].set(('q', 'prague'), WEATHER_RESPONSE, ttl=-600)
+    with app.test_request_context(), patch('requests.Session.get') as mock_get:
+        mock_get.return_value = MockResponse({}, 503)
+
+        result = get_weather_data(location='Prague')
+
+        assert result['stale'] is True
+        assert result['name'] == 'Prague'
+        assert 'stale' not in app.extensions['weather_cache'].get_stale(('q', 'prague'))[0]
+
+def test_get_weather_data_upstream_unavailable(client):
+    with client.application.test_request_context(), patch('requests.Session.get') as mock_get:
+        mock_get.side_effect = requests.Timeout('timed out')
+
+        result = get_weather_data(location='Prague')
+
+        assert result == {'error': 'Weather service is unavailable'}
+
+# Request coalescing against a local stub upstream
+
+def test_single_flight_shares_one_call():
+    flight = SingleFlight()
+    calls = []
+
+    def slow_call():
+        calls.append(1)
+        time.sleep(0.2)
+        return 'result'
+
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        results = list(pool.map(lambda _: flight.do('key', slow_call), range(10)))
+
+    assert results == ['result'] * 10
+    assert len(calls) == 1
+    assert flight.stats() == {'executed': 1, 'coalesced': 9}
+
+def test_parallel_identical_lookups_hit_upstream_once():
+    stub = StubUpstream(latency=0.3).start()
+
+    class StubConfig(TestConfig):
+        WEATHER_API_URL = stub.url + '/data/2.5'
+
+    app = create_app(StubConfig)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/api/current_weather?location=Prague'
+
+    try:
+        with ThreadPoolExecutor(max_workers=50) as pool:
+            responses = list(pool.map(lambda _: requests.get(url), range(50)))
+    finally:
+        server.shutdown()
+        stub.stop()
+
+    assert all(response.status_code == 200 for response in responses)
+    assert all(response.json()['name'] == 'Prague' for response in responses)
+    assert stub.hits['/data/2.5/weather'] == 1
+    stats = app.extensions['single_flight'].stats()
+    assert stats['executed'] == 1
+    assert stats['coalesced'] + app.extensions['weather_cache'].stats()['hits'] == 49
+
+# Tests for the ASGI entry point
+
+def test_asgi_current_weather_serves_concurrent_lookups():
+    stub = StubUpstream(latency=0.3).start()
+
+    class StubConfig(TestConfig):
+        WEATHER_API_URL = stub.url + '/data/2.5'
+
+    asgi_app = create_asgi_app(StubConfig)
+
+    async def run():
+        transport = httpx.ASGITransport(app=asgi_app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://testserver') as http:
+            started = time.monotonic()
+            responses = await asyncio.gather(*[
+                http.get('/api/current_weather', params={'location': f'City{i % 20}'}) for i in range(40)
+            ])
+            elapsed = time.monotonic() - started
+            missing = await http.get('/api/current_weather')
+            index = await http.get('/')
+        await asgi_app.client.aclose()
+        return responses, elapsed, missing, index
+
+    try:
+        responses, elapsed, missing, index = asyncio.run(run())
+    finally:
+        stub.stop()
+
+    assert [response.json()['name'] for response in responses] == [f'City{i % 20}' for i in range(40)]
+    # 20 distinct upstream calls of 0.3s each overlap on the event loop
+    assert elapsed < 2
+    assert stub.hits['/data/2.5/weather'] == 20
+    assert asgi_app.flight.coalesced == 20
+    assert missing.status_code == 400
+    assert index.status_code == 200
+
+def test_asgi_favorites_fan_out(client):
+    register(client, 'asgiuser', 'asgi@example.com', 'testpassword')
+    user = User.get_by_email('asgi@example.com')
+    user.subscribe()
+    FavoriteLocation.add(user.id, 'Liberec', 'CZ')
+    FavoriteLocation.add(user.id, 'Brno', 'CZ')
+
+    asgi_app = AsyncWeatherApp(client.application)
+
+    async def fake_weather(location=None, lat=None, lon=None):
+        return {'main': {'temp': 21.5}, 'weather': [{'description': f'sunny in {location}'}]}
+
+    async def fake_history(location):
+        return [{'dt': 1609502400, 'main': {'temp': 3.0}, 'weather': [{'description': 'snow'}]}]
+
+    asgi_app.get_weather_data = fake_weather
+    asgi_app.get_weather_history = fake_history
+
+    async def run():
+        transport = httpx.ASGITransport(app=asgi_app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://testserver') as http:
+            await http.post('/auth/login', data={'email': 'asgi@example.com', 'password': 'testpassword'})
+            return await http.get('/favorites')
+
+    response = asyncio.run(run())
+    assert response.status_code == 200
+    assert response.text.index('sunny in Liberec,CZ') < response.text.index('sunny in Brno,CZ')
+
+def test_async_single_flight_survives_cancelled_leader():
+    flight = AsyncSingleFlight()
+    calls = []
+
+    async def slow_call():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return 'result'
+
+    async def run():
+        leader = asyncio.ensure_future(flight.do('key', slow_call))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.do('key', slow_call))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        result = await follower
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return result
+
+    assert asyncio.run(run()) == 'result'
+    assert calls == [1]
+    assert (flight.executed, flight.coalesced) == (1, 1)
+    assert flight._calls == {}
+
+def test_asgi_blocking_work_runs_off_the_event_loop(client):
+    asgi_app = AsyncWeatherApp(client.application)
+    threads = []
+
+    def slow_acquire(priority):
+        threads.append(threading.get_ident())
+        time.sleep(0.2)
+        return False
+
+    def slow_geocode(location):
+        threads.append(threading.get_ident())
+        time.sleep(0.2)
+        return [{'lat': None, 'lon': None}]
+
+    asgi_app.client.acquire = slow_acquire
+
+    async def run():
+        with client.application.test_request_context():
+            ticks = []
+
+            async def tick():
+                while True:
+                    ticks.append(time.monotonic())
+                    await asyncio.sleep(0.01)
+
+            ticker = asyncio.ensure_future(tick())
+            with patch('app.asgi.cached_geocode', slow_geocode):
+                await asgi_app.geocode_location('Prague')
+            with pytest.raises(RateLimitedError):
+                await asgi_app.client.get('http://upstream.invalid')
+            ticker.cancel()
+            return ticks
+
+    ticks = asyncio.run(run())
+    assert len(threads) == 2 and threading.get_ident() not in threads
+    # The loop kept running while both calls were blocked
+    assert len(ticks) > 20
+
+def test_asgi_flask_fallback_on_kept_alive_connection(client):
+    asgi_app = AsyncWeatherApp(client.application)
+    statuses = []
+
+    async def serve(remaining, done):
+        # Like uvicorn, the connection's next request runs in the context
+        # captured while the previous response was being sent
+        captured = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                statuses.append(message['status'])
+            elif not message.get('more_body'):
+                captured.append(contextvars.copy_context())
+
+        scope = {'type': 'http', 'method': 'GET', 'path': '/auth/login', 'query_string': b'', 'headers': [],
+                 'http_version': '1.1', 'scheme': 'http', 'server': ('testserver', 80), 'root_path': ''}
+        await asgi_app(scope, receive, send)
+        if remaining:
+            asyncio.get_running_loop().call_soon(
+                lambda: asyncio.ensure_future(serve(remaining - 1, done)), context=captured[0])
+        else:
+            done.set_result(None)
+
+    async def run():
+        done = asyncio.get_running_loop().create_future()
+        await serve(3, done)
+        await asyncio.wait_for(done, timeout=10)
+
+    asyncio.run(run())
+    assert statuses == [200, 200, 200, 200]
+
+# Tests for paginated history
+
+def dated_record(day, hour):
+    return {'city': f'City {day}-{hour}', 'country': 'CZ', 'temperature': float(hour), 'description': 'rain',
+            'date': f'2024-05-{day:02d} {hour:02d}:00:00'}
+
+def history_storage(tmp_path, backend):
+    if backend == 'json':
+        return JsonStorage(str(tmp_path), compact_threshold=7)
+    if backend == 'sqlite':
+        return SqliteStorage(str(tmp_path / 'weather.db'))
+    # Small segments so the rows are spread over segment files and the tail
+    return HistoryArchive(str(tmp_path / 'archive'), segment_size=4)
+
+@pytest.mark.parametrize('backend', ['json', 'sqlite', 'archive'])
+def test_history_pages_and_date_range(tmp_path, backend):
+    storage = history_storage(tmp_path, backend)
+    storage.add_history_batch([(1, dated_record(day, hour)) for day in range(10, 15) for hour in (8, 20)])
+    storage.add_history(2, dated_record(12, 9))
+
+    page, cursor = storage.get_history_page(1, limit=4)
+    assert [r['date'] for r in page] == ['2024-05-14 20:00:00', '2024-05-14 08:00:00',
+                                         '2024-05-13 20:00:00', '2024-05-13 08:00:00']
+    seen = [r['date'] for r in page]
+    while cursor is not None:
+        page, cursor = storage.get_history_page(1, cursor=cursor, limit=4)
+        seen.extend(r['date'] for r in page)
+    assert len(seen) == 10 and seen == sorted(seen, reverse=True)
+
+    page, cursor = storage.get_history_page(1, limit=10, start='2024-05-11', end='2024-05-13')
+    assert [r['date'] for r in page] == ['2024-05-12 20:00:00', '2024-05-12 08:00:00',
+                                         '2024-05-11 20:00:00', '2024-05-11 08:00:00']
+    assert cursor is None
+
+    page, cursor = storage.get_history_page(1, limit=3, start='2024-05-11', end='2024-05-13')
+    assert len(page) == 3
+    page, cursor = storage.get_history_page(1, cursor=cursor, limit=3, start='2024-05-11', end='2024-05-13')
+    assert [r['date'] for r in page] == ['2024-05-11 08:00:00'] and cursor is None
+
+    assert [r['date'] for r in storage.get_history(1, offset=8)] == ['2024-05-14 08:00:00', '2024-05-14 20:00:00']
+    assert storage.get_history(2, offset=1) == []
+
+@pytest.mark.parametrize('backend', ['json', 'sqlite', 'archive'])
+def test_history_aggregates(tmp_path, backend):
+    storage = history_storage(tmp_path, backend)
+    storage.add_history_batch([(1, dict(dated_record(day, 8), city='Brno')) for day in range(10, 13)])
+    storage.add_history_batch([(1, dict(dated_record(day, 20), city='Oslo', country='NO')) for day in range(10, 12)])
+    storage.add_history(2, dict(dated_record(12, 9), city='Oslo', country='NO', temperature=None))
+
+    stats = storage.get_history_stats(1, top=1)
+    assert stats['count'] == 5
+    assert (stats['min_temperature'], stats['max_temperature'], stats['avg_temperature']) == (8.0, 20.0, 12.8)
+    assert stats['cities'] == [{'city': 'Brno', 'country': 'CZ', 'count': 3, 'min_temperature': 8.0,
+                                'max_temperature': 8.0, 'avg_temperature': 8.0}]
+    assert storage.get_city_stats('Oslo', 'NO') == {'count': 3, 'min_temperature': 20.0, 'max_temperature': 20.0,
+                                                     'avg_temperature': 20.0}
+    assert storage.get_city_stats('Lima', 'PE')['count'] == 0
+    # Ties are ordered by name
+    assert storage.get_top_cities() == [{'city': 'Brno', 'country': 'CZ', 'count': 3},
+                                        {'city': 'Oslo', 'country': 'NO', 'count': 3}]
+
+def test_history_archive_reopens_and_imports_once(tmp_path):
+    json_storage = JsonStorage(str(tmp_path / 'json'))
+    records = [(user_id, dated_record(day, hour)) for day in range(10, 15) for hour in (8, 20) for user_id in (1, 2)]
+    json_storage.add_history_batch(records)
+
+    storage = archive_history(json_storage, str(tmp_path / 'archive'), segment_size=8)
+    assert storage.get_history(1) == json_storage.get_history(1)
+    storage.add_history(1, dated_record(15, 8))
+    assert sorted(os.listdir(tmp_path / 'archive')) == ['00000000.seg', '00000001.seg', '00000002.tail',
+                                                        'archive.lock', 'imported', 'strings.jsonl']
+
+    # Segments are mapped again and the tail replayed, nothing is imported twice
+    reopened = archive_history(json_storage, str(tmp_path / 'archive'), segment_size=8)
+    assert len(reopened.get_history(1)) == 11
+    assert reopened.get_history(2) == json_storage.get_history(2)
+    assert reopened.get_history_page(1, limit=1)[0][0]['date'] == '2024-05-15 08:00:00'
+    # Rows written through one instance show up in the other
+    storage.add_history(2, dated_record(15, 9))
+    assert len(reopened.get_history(2)) == 11
+    assert reopened.get_favorites(1) == []
+    # City stats combine the location index of the segments with the tail
+    json_storage.add_history_batch([(1, dated_record(15, 8)), (2, dated_record(15, 9))])
+    for day, hour in ((10, 8), (14, 20), (15, 9)):
+        city = dated_record(day, hour)['city']
+        assert reopened.get_city_stats(city, 'CZ') == json_storage.get_city_stats(city, 'CZ')
+    assert reopened.get_top_cities(30) == json_storage.get_top_cities(30)
+
+def test_history_reads_merge_queued_records_without_flushing(tmp_path, monkeypatch):
+    storage = JsonStorage(str(tmp_path))
+    writer = HistoryWriter(storage, batch_size=1000, flush_interval=60)
+    monkeypatch.setattr('app.models.storage', storage)
+    monkeypatch.setattr('app.models.history_writer', writer)
+    storage.add_history_batch([(1, dated_record(1, hour)) for hour in range(4)])
+    for hour in (10, 11):
+        WeatherHistory.add(1, f'Queued {hour}', 'CZ', 5.0, 'rain', datetime(2024, 5, 2, hour))
+
+    with patch.object(writer, 'flush', wraps=writer.flush) as flush:
+        history = WeatherHistory.get_by_user_id(1)
+        page, cursor = WeatherHistory.get_page(1, limit=3)
+        older, _ = WeatherHistory.get_page(1, cursor=cursor, limit=3)
+        same_day, _ = WeatherHistory.get_page(1, limit=3, start='2024-05-01', end='2024-05-02')
+        streamed = list(WeatherHistory.iter_records(1, page_size=2))
+    assert flush.call_count == 0
+    assert storage.get_history(1, offset=4) == []
+
+    assert [record.city for record in history[-3:]] == ['City 1-3', 'Queued 10', 'Queued 11']
+    assert [record.city for record in page] == ['Queued 11', 'Queued 10', 'City 1-3']
+    assert [record.city for record in older] == ['City 1-2', 'City 1-1', 'City 1-0']
+    assert [record.city for record in same_day] == ['City 1-3', 'City 1-2', 'City 1-1']
+    assert [record['city'] for record in streamed] == ['Queued 11', 'Queued 10'] + [f'City 1-{h}' for h in (3, 2, 1, 0)]
+
+    # More queued records than a page holds are written first, so the cursor can reach them
+    page, cursor = WeatherHistory.get_page(1, limit=2)
+    assert [record.city for record in page] == ['Queued 11', 'Queued 10'] and cursor is not None
+    assert len(storage.get_history(1)) == 6
+    assert WeatherHistory.get_by_user_id(1)[-1].city == 'Queued 11'
+
+def test_history_stats_endpoints(client):
+    register(client, 'stats', 'stats@example.com', 'testpassword')
+    login(client, 'stats@example.com', 'testpassword')
+    user = User.get_by_email('stats@example.com')
+    for day in (10, 11):
+        WeatherHistory.add(user.id, 'Tromso', 'NO', -2.0 + day, 'snow', datetime(2024, 1, day, 8))
+    # Aggregates count records once the write-behind writer has stored them
+    from app import models
+    assert client.get('/api/history/stats').get_json()['count'] == 0
+    models.history_writer.flush()
+
+    stats = client.get('/api/history/stats').get_json()
+    assert stats['count'] == 2 and stats['avg_temperature'] == 8.5
+    assert stats['cities'][0]['city'] == 'Tromso'
+    assert client.get('/api/cities/stats?city=Tromso&country=NO').get_json()['max_temperature'] == 9.0
+    assert {'city': 'Tromso', 'country': 'NO', 'count': 2} in client.get('/api/cities/stats').get_json()['cities']
+
+def test_history_views_paginate_and_stream(client):
+    register(client, 'pager', 'pager@example.com', 'testpassword')
+    login(client, 'pager@example.com', 'testpassword')
+    user = User.get_by_email('pager@example.com')
+    for day in range(1, 8):
+        WeatherHistory.add(user.id, f'Town{day}', 'CZ', 10.0, 'rain', datetime(2024, 6, day, 12, 0))
+    client.application.config['HISTORY_PAGE_SIZE'] = 3
+
+    rv = client.get('/history')
+    assert b'Town7' in rv.data and b'Town5' in rv.data and b'Town4' not in rv.data
+    assert b'cursor=' in rv.data
+
+    rv = client.get('/history?start=2024-06-02&end=2024-06-03')
+    assert b'Town2' in rv.data and b'Town3' in rv.data and b'Town4' not in rv.data
+    assert client.get('/history?start=yesterday').status_code == 400
+
+    rv = client.get('/api/history?start=2024-06-02')
+    lines = [json.loads(line) for line in rv.data.decode().splitlines()]
+    assert rv.mimetype == 'application/x-ndjson'
+    assert [record['city'] for record in lines] == [f'Town{day}' for day in range(7, 1, -1)]
+
+    rv = client.get('/api/history?limit=2')
+    assert len(rv.data.decode().splitlines()) == 2
+
+# Tests for the /metrics endpoint
+
+def test_metrics_endpoint_reports_requests_upstream_storage_and_caches(client):
+    register(client, 'metric', 'metric@example.com', 'testpassword')
+    login(client, 'metric@example.com', 'testpassword')
+    with patch('requests.Session.get') as mock_get:
+        mock_get.return_value = MockResponse(WEATHER_RESPONSE, 200)
+        client.get('/api/current_weather?location=Prague')
+        client.get('/api/current_weather?location=Prague')
+    client.get('/no-such-page')
+
+    rv = client.get('/metrics')
+    assert rv.status_code == 200
+    assert rv.mimetype == 'text/plain'
+    text = rv.data.decode()
+    assert 'weather_app_request_duration_seconds_count{endpoint="main.current_weather",method="GET"} 2' in text
+    assert 'weather_app_responses_total{endpoint="unmatched",method="GET",status="404"} 1' in text
+    assert 'weather_app_upstream_duration_seconds_bucket{call="weather",le="+Inf"} 1' in text
+    assert 'weather_app_upstream_requests_total{call="weather",outcome="200"} 1' in text
+    assert 'weather_app_storage_duration_seconds_count{operation="get_user_by_email"}' in text
+    assert 'weather_app_cache_hit_ratio{cache="weather_cache"} 0.5' in text
+    assert '# TYPE weather_app_cache_hits_total counter' in text
+
+def test_metrics_can_be_switched_off():
+    class NoMetricsConfig(TestConfig):
+        METRICS_ENABLED = False
+
+    app = create_app(NoMetricsConfig)
+    from app import models
+    assert 'metrics' not in app.extensions
+    assert isinstance(models.storage, JsonStorage)
+    assert app.test_client().get('/metrics').status_code == 404
+
+# Tests for login hashing and throttling
+
+def test_login_rehashes_password_with_new_parameters(client, monkeypatch):
+    register(client, 'rehash', 'rehash@example.com', 'testpassword')
+    assert User.get_by_email('rehash@example.com').password_hash.startswith('pbkdf2:sha256:1000$')
+
+    monkeypatch.setattr('app.models.password_hash_method', 'pbkdf2:sha256:2000')
+    login(client, 'rehash@example.com', 'wrongpassword')
+    assert User.get_by_email('rehash@example.com').password_hash.startswith('pbkdf2:sha256:1000$')
+    login(client, 'rehash@example.com', 'testpassword')
+    rehashed = User.get_by_email('rehash@example.com')
+    assert rehashed.password_hash.startswith('pbkdf2:sha256:2000$')
+    assert rehashed.check_password('testpassword')
+
+def test_login_throttle_refuses_before_hashing(client):
+    register(client, 'victim', 'victim@example.com', 'testpassword')
+    for _ in range(5):
+        assert client.post('/auth/login', data={'email': 'victim@example.com', 'password': 'guess'}).status_code == 302
+
+    with patch('app.models.check_password_hash') as check:
+        rv = client.post('/auth/login', data={'email': ' Victim@example.com', 'password': 'testpassword'})
+        assert rv.status_code == 429 and 0 < int(rv.headers['Retry-After']) <= 300
+        assert check.call_count == 0
+    # Other accounts from the same address are still served
+    register(client, 'other', 'other@example.com', 'testpassword')
+    assert client.post('/auth/login', data={'email': 'other@example.com', 'password': 'testpassword'}).status_code == 302
+    assert 'weather_app_login_throttled_total 1' in client.get('/metrics').get_data(as_text=True)
+
+def test_login_throttle_limits_client_behind_proxy(client):
+    client.application.extensions['login_throttle'].limits['ip'] = 2
+    for email in ('a@example.com', 'b@example.com'):
+        client.post('/auth/login', data={'email': email, 'password': 'guess'},
+                    headers={'X-Forwarded-For': '203.0.113.5'})
+
+    # The proxy's own address is shared by everyone, the limit follows the client
+    rv = client.post('/auth/login', data={'email': 'c@example.com', 'password': 'guess'},
+                     headers={'X-Forwarded-For': '203.0.113.5'})
+    assert rv.status_code == 429
+    rv = client.post('/auth/login', data={'email': 'c@example.com', 'password': 'guess'},
+                     headers={'X-Forwarded-For': '198.51.100.7'})
+    assert rv.status_code == 302
+
+def test_login_throttle_per_address_window_and_reset():
+    throttle = LoginThrottle(ip_limit=3, email_limit=2, window=0.2)
+    throttle.failed('10.0.0.1', 'a@example.com')
+    throttle.failed('10.0.0.1', 'b@example.com')
+    assert throttle.retry_after('10.0.0.1', 'c@example.com') == 0
+    throttle.failed('10.0.0.1', 'a@example.com')
+    # Three from the address, two for a@
+    assert throttle.retry_after('10.0.0.1', 'c@example.com') == 1
+    assert throttle.retry_after('10.0.0.2', 'a@example.com') == 1
+    assert throttle.retry_after('10.0.0.2', 'b@example.com') == 0
+    throttle.succeeded('A@example.com')
+    assert throttle.retry_after('10.0.0.2', 'a@example.com') == 0
+
+    time.sleep(0.25)
+    assert throttle.retry_after('10.0.0.1', 'c@example.com') == 0
+    assert throttle.stats()['rejected'] == 2
+
+# Tests for the favorites refresher
+
+@pytest.mark.parametrize('backend', ['json', 'sqlite'])
+def test_favorite_followers_count_each_user_once(tmp_path, backend):
+    storage = JsonStorage(str(tmp_path)) if backend == 'json' else SqliteStorage(str(tmp_path / 'weather.db'))
+    storage.add_favorite(1, 'Brno', 'CZ')
+    storage.add_favorite(1, 'Brno', 'CZ')
+    storage.add_favorite(2, 'Brno', 'CZ')
+    storage.add_favorite(2, 'Oslo', 'NO')
+    assert storage.get_favorite_followers() == {('Brno', 'CZ'): 2, ('Oslo', 'NO'): 1}
+
+@pytest.mark.parametrize('backend', ['json', 'sqlite'])
+def test_favorites_are_sets_with_a_shared_location_registry(tmp_path, backend):
+    def open_storage():
+        return JsonStorage(str(tmp_path)) if backend == 'json' else SqliteStorage(str(tmp_path / 'weather.db'))
+    storage = open_storage()
+    assert storage.add_favorite(1, 'Brno', 'CZ') is True
+    assert storage.add_favorite(1, 'Brno', 'CZ') is False
+    storage.add_favorite(1, 'Oslo', 'NO')
+    storage.add_favorite(2, 'Brno', 'CZ')
+    assert storage.get_favorites(1) == [{'city': 'Brno', 'country': 'CZ'}, {'city': 'Oslo', 'country': 'NO'}]
+    assert storage.has_favorite(2, 'Brno', 'CZ') and not storage.has_favorite(2, 'Oslo', 'NO')
+
+    storage.set_location_coordinates('Brno', 'CZ', 49.2, 16.61)
+    assert storage.delete_favorite(1, 'Oslo', 'NO') is True
+    assert storage.delete_favorite(1, 'Oslo', 'NO') is False
+    assert storage.get_location_registry() == [{'city': 'Brno', 'country': 'CZ', 'lat': 49.2, 'lon': 16.61,
+                                                'followers': 2}]
+
+    # Coordinates outlive the last follower, another worker sees the changes
+    storage.delete_favorite(1, 'Brno', 'CZ')
+    storage.delete_favorite(2, 'Brno', 'CZ')
+    assert storage.get_favorite_locations() == []
+    reopened = open_storage()
+    reopened.add_favorite(3, 'Brno', 'CZ')
+    assert storage.get_location_registry() == [{'city': 'Brno', 'country': 'CZ', 'lat': 49.2, 'lon': 16.61,
+                                                'followers': 1}]
+
+@pytest.mark.parametrize('backend', ['json', 'sqlite'])
+def test_location_coordinates_survive_unfollow_and_refollow(tmp_path, backend):
+    storage = JsonStorage(str(tmp_path)) if backend == 'json' else SqliteStorage(str(tmp_path / 'weather.db'))
+    storage.add_favorite(1, 'Brno', 'CZ')
+    storage.set_location_coordinates('Brno', 'CZ', 49.2, 16.61)
+    storage.delete_favorite(1, 'Brno', 'CZ')
+    assert storage.get_location_registry() == [] and storage.get_favorite_followers() == {}
+
+    storage.add_favorite(2, 'Brno', 'CZ')
+    assert storage.get_location_registry() == [{'city': 'Brno', 'country': 'CZ', 'lat': 49.2, 'lon': 16.61,
+                                                'followers': 1}]
+
+def test_sqlite_migration_drops_duplicate_favorites(tmp_path):
+    storage = SqliteStorage(str(tmp_path / 'weather.db'))
+    conn = storage._connection()
+    with conn:
+        # A version 1 database, where favorites could repeat
+        conn.execute('DROP INDEX idx_favorites_user_location')
+        conn.execute('DELETE FROM locations')
+        conn.executemany('INSERT INTO favorites (user_id, city, country) VALUES (?, ?, ?)',
+                         [(1, 'Brno', 'CZ'), (1, 'Brno', 'CZ'), (2, 'Brno', 'CZ'), (1, 'Oslo', 'NO')])
+        conn.execute('PRAGMA user_version = 1')
+
+    migrated = SqliteStorage(str(tmp_path / 'weather.db'))
+    assert migrated.get_favorites(1) == [{'city': 'Brno', 'country': 'CZ'}, {'city': 'Oslo', 'country': 'NO'}]
+    assert migrated.get_favorite_followers() == {('Brno', 'CZ'): 2, ('Oslo', 'NO'): 1}
+    assert migrated.add_favorite(1, 'Brno', 'CZ') is False
+
+def test_favorites_refresher_prioritizes_and_keeps_to_budget(tmp_path):
+    stub = StubUpstream().start()
+
+    class RefreshConfig(TestConfig):
+        DATA_DIR = str(tmp_path)
+        WEATHER_API_URL = stub.url + '/data/2.5'
+        WEATHER_GEOCODE_URL = stub.url + '/geo/1.0/direct'
+        WEATHER_HISTORY_URL = stub.url + '/data/2.5/history/city'
+
+    try:
+        app = create_app(RefreshConfig)
+        for user_id, city in [(1, 'Brno'), (2, 'Brno'), (3, 'Brno'), (1, 'Oslo'), (2, 'Oslo'), (1, 'Lyon'), (3, 'Lyon')]:
+            FavoriteLocation.add(user_id, city, 'XX')
+        refresher = FavoritesRefresher(app, interval=300, budget=6)
+        # A fresh view doubles Lyon's weight and puts it ahead of Brno
+        refresher.mark_viewed([{'city': 'Lyon', 'country': 'XX'}])
+        assert refresher.prioritized() == [('Lyon', 'XX'), ('Brno', 'XX'), ('Oslo', 'XX')]
+
+        # Cold locations cost three calls each (weather, geocode, history)
+        assert refresher.refresh_once() == 6
+        assert refresher.stats() == {'refreshed': 2, 'skipped': 1, 'errors': 0}
+        assert stub.hits['/data/2.5/weather'] == 2
+
+        with app.test_request_context():
+            stub.hits.clear()
+            favorite_weather = get_favorites_weather([{'city': 'Brno', 'country': 'XX'}, {'city': 'Lyon', 'country': 'XX'}])
+            assert [entry['weather']['name'] for entry in favorite_weather] == ['Brno', 'Lyon']
+            assert sum(stub.hits.values()) == 0
+    finally:
+        stub.stop()
+
+def test_favorites_refresher_counts_failures(tmp_path, caplog):
+    class RefreshConfig(TestConfig):
+        DATA_DIR = str(tmp_path)
+
+    app = create_app(RefreshConfig)
+    FavoriteLocation.add(1, 'Brno', 'CZ')
+    app.extensions['favorites_refresher'] = refresher = FavoritesRefresher(app, budget=10)
+    with patch('app.refresher.request_current_weather', side_effect=RuntimeError('upstream down')):
+        refresher.refresh_once()
+
+    assert refresher.stats() == {'refreshed': 0, 'skipped': 0, 'errors': 1}
+    assert 'Favorites refresh of Brno,CZ failed' in caplog.text
+    assert 'upstream down' in caplog.text
+    metrics = app.test_client().get('/metrics').get_data(as_text=True)
+    assert 'weather_app_favorites_refresh_errors_total 1' in metrics
+
+# Tests for the batch weather endpoint
+
+def batch_upstream(url, params=None, timeout=None):
+    if params.get('q') == 'Atlantis':
+        return MockResponse({'cod': '404', 'message': 'city not found'}, 404)
+    name = params.get('q') or f"{params['lat']},{params['lon']}"
+    return MockResponse(dict(WEATHER_RESPONSE, name=name), 200)
+
+def test_current_weather_batch_dedupes_and_keeps_order(client):
+    with patch('requests.Session.get', side_effect=batch_upstream) as mock_get:
+        client.get('/api/current_weather?location=Brno')
+        mock_get.reset_mock()
+
+        rv = client.post('/api/current_weather/batch', json={'locations': [
+            'Prague', ' prague', {'lat': 50.0755, 'lon': 14.4378}, 'Atlantis', 'Brno', {'lat': 'north'}, 42,
+            {'lat': 50.0756, 'lon': 14.4379}]})
+
+    assert rv.status_code == 200
+    results = rv.get_json()['results']
+    assert [result.get('name') for result in results] == [
+        'Prague', 'Prague', '50.08,14.44', None, 'Brno', None, None, '50.08,14.44']
+    assert results[3] == {'error': 'Invalid location or no data available'}
+    assert results[5] == results[6] == {'error': 'Location or coordinates are required'}
+    # Prague, the coordinates and Atlantis once each, Brno came from the cache
+    assert mock_get.call_count == 3
+
+def test_current_weather_batch_streams_ndjson_and_validates(client):
+    with patch('requests.Session.get', side_effect=batch_upstream):
+        rv = client.post('/api/current_weather/batch?format=ndjson', json=['Oslo', 'Atlantis', 'Lyon'])
+        lines = [json.loads(line) for line in rv.data.decode().splitlines()]
+
+    assert rv.mimetype == 'application/x-ndjson'
+    assert [line.get('name', 'error') for line in lines] == ['Oslo', 'error', 'Lyon']
+
+    assert client.post('/api/current_weather/batch', json={'locations': []}).status_code == 400
+    assert client.post('/api/current_weather/batch', data='Prague').status_code == 400
+    client.application.config['WEATHER_BATCH_MAX_ITEMS'] = 2
+    assert client.post('/api/current_weather/batch', json=['a', 'b', 'c']).status_code == 400